@@ -3,7 +3,9 @@ __all__ = ['disk3d','disk2d',
            'snapshot',
            'paramfile',
            'powerlaw_sigma','similarity_sigma','powerlaw_cavity_sigma','similarity_cavity_sigma',
-           'rotate_disk'
+           'rotate_disk',
+           'RadialProfileTable','adaptive_radial_zones',
+           'VerticalStructureTable'
            ]
 
 from .disk_structure_3d import disk3d, disk_mesh3d
@@ -12,6 +14,8 @@ from .disk_snapshot import snapshot
 from .disk_density_profiles import powerlaw_sigma, similarity_sigma, powerlaw_cavity_sigma, similarity_cavity_sigma
 from .disk_parameter_files import paramfile
 from .disk_rotation import rotate_disk
+from .disk_radial_profiles import RadialProfileTable, adaptive_radial_zones
+from .disk_vertical_profiles import VerticalStructureTable
 
 
 from . import disk_hdf5
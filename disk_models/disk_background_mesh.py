@@ -0,0 +1,153 @@
+from __future__ import print_function
+"""
+Graded background meshes filling the computational box around a disk
+
+
+"""
+
+import numpy as np
+
+
+def graded_box_fill(BoxSize,Rmax,delta_in,zmax=None,growth=0.25,Npoints=None,gap=0.5):
+    """
+    Mesh-generating points filling a box of side BoxSize, centered on the
+    origin, around the region R <= Rmax (and |z| <= zmax in 3D) occupied
+    by the disk.
+
+    The points are the centers of the leaves of a quadtree (2D) or octree
+    (3D) over the box, refined until the side s of every leaf is at most
+    the target spacing h(d) = delta_in + growth * d at the smallest
+    distance d of the leaf from the disk: the spacing grows geometrically
+    from shell to shell away from the disk. Leaves inside the disk are
+    discarded as the tree is built, so only the points that are kept are
+    allocated, and points closer than gap * delta_in to the disk are
+    left out. Since h changes by less than a factor 2 across a leaf and
+    its neighbours for growth <= 0.5, the sides of neighbouring leaves
+    differ by at most a factor 2.
+
+    If the target spacing needs more than Npoints points, the spacing
+    next to the disk is increased instead, h(d) = t * delta_in + growth * d
+    with t > 1, which keeps the gradation, and the leaves that are the
+    furthest from that spacing are split until exactly Npoints points are
+    produced.
+
+    Parameters
+    ----------
+    BoxSize : float
+    side of the box
+    Rmax : float
+    radius of the disk
+    delta_in : float
+    spacing of the points next to the disk
+    zmax : float, optional
+    half-thickness of the disk, None for a 2D mesh
+    growth : float, optional
+    increase of the spacing per unit distance from the disk, at most 0.5
+    Npoints : int, optional
+    largest number of points
+    gap : float, optional
+    smallest distance of the points from the disk in units of delta_in
+
+    Returns
+    -------
+    x, y[, z] : ndarray
+    coordinates of the points
+    """
+    tree = _GradedTree(BoxSize,Rmax,zmax,delta_in,min(growth,0.5),gap * delta_in)
+
+    if (Npoints is not None): Npoints = int(Npoints)
+    leaves = tree.leaves(1.0,Npoints)
+    if (leaves is not None):
+        return tuple(leaves[0][tree.kept(leaves[0])].T)
+
+    # bisect the spacing next to the disk over its logarithm: tree.leaves(t_hi)
+    # has at most Npoints points, tree.leaves(t_lo) more
+    t_lo, t_hi = 1.0, 2 * BoxSize/delta_in
+    for iteration in range(60):
+        t = np.sqrt(t_lo * t_hi)
+        if (tree.leaves(t,Npoints) is None): t_lo = t
+        else: t_hi = t
+        if (t_hi < t_lo * (1 + 1.0e-6)): break
+    centers, sizes = tree.leaves(t_hi)
+    kept = tree.kept(centers)
+
+    # split the leaves split by tree.leaves(t_lo), with the largest s/h first,
+    # until the budget is used, the last of them keeping only the children
+    # it has room for
+    ratio = tree.ratio(centers,sizes,t_lo)
+    order = np.argsort(-ratio,kind='mergesort')
+    order = order[ratio[order] > 1]
+    children = [tree.children(centers[i:i+1],sizes[i]) for i in order]
+    children = [c[tree.kept(c)] for c in children]
+    added = np.array([c.shape[0] for c in children],dtype=int) - kept[order]
+    deficit = Npoints - np.count_nonzero(kept)
+    over = np.cumsum(added) > deficit
+    Nsplit = np.argmax(over) if over.any() else order.shape[0]
+    deficit -= np.sum(added[:Nsplit])
+    new = children[:Nsplit]
+    if (Nsplit < order.shape[0]) & (deficit + kept[order[Nsplit]] > 0):
+        new.append(children[Nsplit][:deficit + kept[order[Nsplit]]])
+        Nsplit += 1
+    kept[order[:Nsplit]] = False
+    points = np.concatenate([centers[kept]] + new)
+    return tuple(points.T)
+
+
+class _GradedTree(object):
+    """
+    Quadtree or octree over the box, refined towards the disk; cells are
+    handled one level at a time as arrays of centers, and split while their
+    side is larger than the spacing h(d) = t * delta_in + growth * d
+    """
+
+    def __init__(self,BoxSize,Rmax,zmax,delta_in,growth,gap):
+        self.BoxSize, self.Rmax, self.zmax = BoxSize, Rmax, zmax
+        self.delta_in, self.growth, self.gap = delta_in, growth, gap
+        self.dims = 2 if zmax is None else 3
+        corners = np.array(np.meshgrid(*([[-1,1]] * self.dims),indexing='ij'))
+        self.offsets = corners.reshape(self.dims,-1).T
+
+    def distance(self,centers,halfsize=0.0):
+        # distance from the disk of the points (halfsize = 0) or, as a lower
+        # bound, of the cells of half-side halfsize around them
+        dR = np.sqrt(centers[:,0]**2 + centers[:,1]**2) - self.Rmax
+        if (self.dims == 2): d = np.maximum(dR,0)
+        else: d = np.sqrt(np.maximum(dR,0)**2 + np.maximum(np.abs(centers[:,2]) - self.zmax,0)**2)
+        return np.maximum(d - halfsize * np.sqrt(self.dims),0)
+
+    def inside(self,centers,halfsize):
+        # cells that lie entirely within the disk
+        far = np.abs(centers) + halfsize
+        inside = np.sqrt(far[:,0]**2 + far[:,1]**2) <= self.Rmax
+        if (self.dims == 3): inside &= far[:,2] <= self.zmax
+        return inside
+
+    def ratio(self,centers,size,t):
+        # side of the cells over the target spacing
+        return size/(t * self.delta_in + self.growth * self.distance(centers,0.5 * size))
+
+    def kept(self,centers):
+        return self.distance(centers) > self.gap
+
+    def children(self,centers,size):
+        children = centers[:,None,:] + 0.25 * size * self.offsets[None,:,:]
+        children = children.reshape(-1,self.dims)
+        return children[~self.inside(children,0.25 * size)]
+
+    def leaves(self,t,limit=None):
+        """
+        Centers and sides of the leaves; None as soon as more than `limit`
+        points are kept
+        """
+        centers, size = np.zeros((1,self.dims)), float(self.BoxSize)
+        leaf_centers, leaf_sizes = [], []
+        Nkept = 0
+        while (centers.shape[0] > 0) & (size > 1.0e-3 * self.delta_in):
+            split = self.ratio(centers,size,t) > 1
+            Nkept += np.count_nonzero(self.kept(centers[~split]))
+            if (limit is not None) and (Nkept > limit): return None
+            leaf_centers.append(centers[~split])
+            leaf_sizes.append(np.full(np.count_nonzero(~split),size))
+            centers = self.children(centers[split],size)
+            size = 0.5 * size
+        return np.concatenate(leaf_centers), np.concatenate(leaf_sizes)
@@ -0,0 +1,172 @@
+from __future__ import print_function
+"""
+Parameter fingerprints and caches for disk model evaluations
+
+
+"""
+
+import functools
+import hashlib
+import types
+from collections import OrderedDict
+
+import numpy as np
+
+
+def parameter_fingerprint(obj):
+    """
+    Deterministic hash of the parameters of a disk model (or of any
+    object), which changes whenever one of its attributes changes.
+
+    The public attributes (those not starting with an underscore) are
+    hashed recursively, so that changes to nested objects, such as
+    `disk.sigma_disk.sigma0`, are also detected. Classes can leave out
+    attributes that do not change the model by listing them in
+    `_fingerprint_exclude`. Arrays are hashed by content, and functions by
+    their code, constants, default arguments, closures and the data
+    (numbers, strings, arrays) they read from their module globals;
+    `functools.partial` objects by their function and bound arguments, and
+    builtin functions, ufuncs and classes by their qualified name. Objects
+    of any other type cannot be hashed reliably, and make the whole object
+    uncacheable.
+
+    Returns
+    -------
+    fingerprint : str or None
+    hexadecimal digest, None if the object is uncacheable
+    """
+    digest = hashlib.sha1()
+    try:
+        _update_fingerprint(digest,obj,set())
+    except _Uncacheable:
+        return None
+    return digest.hexdigest()
+
+
+def array_fingerprint(a):
+    """
+    Hash of the contents of an array, None for None
+    """
+    if (a is None):
+        return None
+    a = np.ascontiguousarray(a,dtype=float)
+    return hashlib.sha1(a.tobytes()).hexdigest() + str(a.shape)
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def _update_fingerprint(digest,obj,seen):
+
+    def update(text):
+        digest.update(text.encode('utf-8'))
+
+    if (obj is None) or isinstance(obj,(bool,int,float,complex,str,bytes)):
+        update(repr((type(obj).__name__,obj)))
+    elif isinstance(obj,np.generic):
+        update(repr((type(obj).__name__,obj.item())))
+    elif isinstance(obj,np.ndarray):
+        update(str((obj.dtype.str,obj.shape)))
+        if (obj.dtype == object):
+            for item in obj.flat:
+                _update_fingerprint(digest,item,seen)
+        else:
+            digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj,(list,tuple)):
+        update('%s%d' % (type(obj).__name__,len(obj)))
+        for item in obj:
+            _update_fingerprint(digest,item,seen)
+    elif isinstance(obj,dict):
+        update('dict%d' % len(obj))
+        for key in sorted(obj,key=repr):
+            _update_fingerprint(digest,key,seen)
+            _update_fingerprint(digest,obj[key],seen)
+    elif isinstance(obj,types.FunctionType):
+        if id(obj) in seen: return
+        seen.add(id(obj))
+        update(getattr(obj,'__module__','') or '')
+        update(getattr(obj,'__qualname__',obj.__name__))
+        _update_code_fingerprint(digest,obj.__code__,seen)
+        _update_fingerprint(digest,obj.__defaults__,seen)
+        for cell in (obj.__closure__ or ()):
+            try:
+                _update_fingerprint(digest,cell.cell_contents,seen)
+            except ValueError:
+                update('empty cell')
+        for name in _code_names(obj.__code__):
+            value = obj.__globals__.get(name)
+            if isinstance(value,(bool,int,float,complex,str,np.generic,np.ndarray)):
+                update(name)
+                _update_fingerprint(digest,value,seen)
+    elif isinstance(obj,types.MethodType):
+        _update_fingerprint(digest,obj.__func__,seen)
+        _update_fingerprint(digest,obj.__self__,seen)
+    elif isinstance(obj,functools.partial):
+        update('partial')
+        _update_fingerprint(digest,obj.func,seen)
+        _update_fingerprint(digest,obj.args,seen)
+        _update_fingerprint(digest,obj.keywords or {},seen)
+    elif isinstance(obj,(types.BuiltinFunctionType,np.ufunc,type)):
+        update(repr((type(obj).__name__,getattr(obj,'__module__',None) or '',
+                     getattr(obj,'__qualname__',obj.__name__))))
+    elif hasattr(obj,'__dict__'):
+        if id(obj) in seen: return
+        seen.add(id(obj))
+        update(type(obj).__name__)
+        exclude = getattr(obj,'_fingerprint_exclude',())
+        _update_fingerprint(digest,dict((key,value) for key, value in vars(obj).items()
+                                        if not (key.startswith('_') or key in exclude)),seen)
+    else:
+        # reprs may hold memory addresses or hide the contents of the object
+        raise _Uncacheable(type(obj).__name__)
+
+
+def _update_code_fingerprint(digest,code,seen):
+    digest.update(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const,types.CodeType):
+            _update_code_fingerprint(digest,const,seen)
+        else:
+            _update_fingerprint(digest,const,seen)
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const,types.CodeType):
+            names |= _code_names(const)
+    return sorted(names)
+
+
+class LRUCache(object):
+    """
+    Dictionary holding at most `maxsize` entries, discarding the least
+    recently used one when full.
+    """
+
+    def __init__(self,maxsize=32):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self,key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self,key,default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def put(self,key,value):
+        self.data.pop(key,None)
+        self.data[key] = value
+        while (len(self.data) > self.maxsize):
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
@@ -1,6 +1,10 @@
 from __future__ import print_function
 import numpy as np
+import scipy.special as special
+import scipy.interpolate as interpolate
 from .disk_spline_kernels import *
+from .disk_other_functions import cumulative_integral
+from .disk_cache import parameter_fingerprint
 
 
 def powerlaw_sigma(R,sigma0,p,R0):
@@ -36,6 +40,65 @@ def ring_sigma(R,sigma0,gamma,Rinner,Router):
                                                                            
 
 
+def upper_incomplete_gamma(a,x):
+    """
+    Non-normalized upper incomplete gamma function Gamma(a,x) for x > 0
+    and any real a, including a <= 0 (reached through the recurrence
+    Gamma(a,x) = (Gamma(a+1,x) - x^a exp(-x))/a).
+    """
+    x = np.asarray(x,dtype=float)
+    if (a > 0):
+        return special.gammaincc(a,x) * special.gamma(a)
+    if (a == 0):
+        return special.exp1(x)
+    return np.maximum((upper_incomplete_gamma(a + 1,x) - x**a * np.exp(-x))/a,0.0)
+
+
+class sigma_profile(object):
+    """
+    Methods shared by the axisymmetric surface density profiles.
+
+    Profiles with a closed-form cumulative mass override
+    `cumulative_mass`; the rest integrate their surface density numerically.
+    """
+
+    @property
+    def has_analytic_mass(self):
+        return False
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the profile parameters, changes whenever any of them changes
+        """
+        return parameter_fingerprint(self)
+
+    def cumulative_mass(self,R):
+        """
+        Mass enclosed within radius R, int_0^R 2 pi R' sigma(R') dR'
+        """
+        return cumulative_integral(lambda x: 2 * np.pi * x * self.evaluate(x),R)
+
+    def dlnsigma_dlnR(self,R):
+        """
+        Logarithmic slope dln(sigma)/dlnR, by central differences in ln R
+        """
+        R, h = np.asarray(R,dtype=float), 1.0e-4
+        return (np.log(self.evaluate(R * np.exp(h))) - np.log(self.evaluate(R * np.exp(-h))))/ 2 / h
+
+    def _floored(self,R,slope):
+        # the slope vanishes where the surface density floor applies
+        return np.where(self.evaluate(R) > self.floor,slope,0.0)
+
+    def normalize_to_mass(self,Mdisk,Rin,Rout):
+        """
+        Rescale sigma0 so that the mass between Rin and Rout equals Mdisk
+        """
+        mass = np.diff(self.cumulative_mass(np.array([Rin,Rout])))[0]
+        self.sigma0 = self.sigma0 * Mdisk / mass
+        return self.sigma0
+
+
 def SplineProfile(R,h):
     r2 = R*R
     h_inv = 1.0 / h
@@ -85,7 +148,27 @@ def SplineDerivative(R,h):
   return fac
 
 
-class powerlaw_disk(object):
+SPLINE_PROFILE_PIECES = [(0.5,{0: 2.8, 2: -5.333333333333, 4: 9.6, 5: -6.4}),
+                         (1.0,{0: 3.2, -1: -0.066666666667, 2: -10.666666666667,
+                               3: 16.0, 4: -9.6, 5: 2.133333333333}),
+                         (np.inf,{-1: 1.0})]
+
+SPLINE_DERIVATIVE_PIECES = [(0.5,{0: 10.666666666667, 2: -38.4, 3: 32.0}),
+                            (1.0,{0: 21.333333333333, 1: -48.0, 2: 38.4,
+                                  3: -10.666666666667, -3: -0.066666666667}),
+                            (np.inf,{-3: 1.0})]
+
+def dlnSplineProfile_dlnR(R,h):
+    return piecewise_power_log_slopes(R / h,SPLINE_PROFILE_PIECES)[0]
+
+def dlnSplineDerivative_dlnR(R,h):
+    return piecewise_power_log_slopes(R / h,SPLINE_DERIVATIVE_PIECES)[0]
+
+def d2lnSplineDerivative_dlnR2(R,h):
+    return piecewise_power_log_slopes(R / h,SPLINE_DERIVATIVE_PIECES)[1]
+
+
+class powerlaw_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
 
         self.sigma0 = kwargs.get("sigma0")
@@ -106,7 +189,19 @@ class powerlaw_disk(object):
     def evaluate(self,R):
         return np.maximum(self.floor,powerlaw_sigma(R,self.sigma0,self.p,self.R0))
 
-class similarity_disk(object):
+    def dlnsigma_dlnR(self,R):
+        return self._floored(R,-self.p * np.ones(np.shape(R)))
+
+    @property
+    def has_analytic_mass(self):
+        return self.floor == 0
+
+    def cumulative_mass(self,R):
+        if (self.p >= 2):
+            return np.where(np.asarray(R) > 0,np.inf,0.0)
+        return 2 * np.pi * self.sigma0 * self.R0**self.p * np.asarray(R,dtype=float)**(2.0 - self.p) / (2.0 - self.p)
+
+class similarity_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
         self.sigma0 = kwargs.get("sigma0")
         self.gamma = kwargs.get("gamma")
@@ -127,7 +222,21 @@ class similarity_disk(object):
     def evaluate(self,R):
         return np.maximum(self.floor,similarity_sigma(R,self.sigma0,self.gamma,self.Rc))
 
-class similarity_softened_disk(object):
+    def dlnsigma_dlnR(self,R):
+        x = np.asarray(R,dtype=float)/self.Rc
+        return self._floored(R,-self.gamma - (2.0 - self.gamma) * x**(2.0 - self.gamma))
+
+    @property
+    def has_analytic_mass(self):
+        return self.floor == 0
+
+    def cumulative_mass(self,R):
+        if (self.gamma >= 2):
+            return np.where(np.asarray(R) > 0,np.inf,0.0)
+        x = np.asarray(R,dtype=float)/self.Rc
+        return 2 * np.pi * self.sigma0 * self.Rc**2 / (2.0 - self.gamma) * (-np.expm1(-x**(2.0 - self.gamma)))
+
+class similarity_softened_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
         self.sigma0 = kwargs.get("sigma0")
         self.gamma = kwargs.get("gamma")
@@ -150,8 +259,12 @@ class similarity_softened_disk(object):
     def evaluate(self,R):
         return np.maximum(self.floor,similarity_softened_sigma(R,self.sigma0,self.gamma,self.Rc,self.sigma_soft))
 
+    def dlnsigma_dlnR(self,R):
+        x = np.asarray(R,dtype=float)/self.Rc
+        return self._floored(R,self.gamma * dlnSplineProfile_dlnR(R,self.sigma_soft) - (2.0 - self.gamma) * x**(2.0 - self.gamma))
+
 
-class similarity_hole_disk(object):
+class similarity_hole_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
         self.sigma0 = kwargs.get("sigma0")
         self.gamma = kwargs.get("gamma")
@@ -174,7 +287,11 @@ class similarity_hole_disk(object):
     def evaluate(self,R):
         return np.maximum(self.floor,similarity_hole_sigma(R,self.sigma0,self.gamma,self.Rc,self.Rhole))
 
-class similarity_zerotorque_disk(object):
+    def dlnsigma_dlnR(self,R):
+        x = np.asarray(R,dtype=float)/self.Rc
+        return self._floored(R,self.gamma * (dlng3_dlnR(R,self.Rhole) + 6) - (2.0 - self.gamma) * x**(2.0 - self.gamma))
+
+class similarity_zerotorque_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
         self.sigma0 = kwargs.get("sigma0")
         self.gamma = kwargs.get("gamma")
@@ -196,8 +313,12 @@ class similarity_zerotorque_disk(object):
 
     def evaluate(self,R):
         return np.maximum(self.floor,similarity_zerotorque_sigma(R,self.sigma0,self.gamma,self.Rc,self.Rin))
+
+    def dlnsigma_dlnR(self,R):
+        x, y = np.asarray(R,dtype=float)/self.Rc, np.sqrt(self.Rin/np.asarray(R,dtype=float))
+        return self._floored(R,0.5 * y/(1 - y) - self.gamma - (2.0 - self.gamma) * x**(2.0 - self.gamma))
     
-class powerlaw_cavity_disk(object):
+class powerlaw_cavity_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
 
         self.sigma0 = kwargs.get("sigma0")
@@ -219,10 +340,25 @@ class powerlaw_cavity_disk(object):
             self.floor = 0.0
             
     def evaluate(self,R):
-        return np.maximum(self.floor,powerlaw_cavity_sigma(R,self.sigma0,self.p,self.R_cav,self.xi))
+        return np.maximum(self.floor,powerlaw_cavity_sigma(R,self.sigma0,self.p,self.xi,self.R_cav))
+
+    def dlnsigma_dlnR(self,R):
+        y = self.R_cav/np.asarray(R,dtype=float)
+        return self._floored(R,-self.p + self.xi * y**self.xi)
+
+    @property
+    def has_analytic_mass(self):
+        return self.floor == 0
 
+    def cumulative_mass(self,R):
+        # with y = (R_cav/R)^xi the mass integral becomes an upper incomplete gamma function
+        R = np.asarray(R,dtype=float)
+        y = (self.R_cav/np.where(R > 0,R,1.0))**self.xi
+        mass = 2 * np.pi * self.sigma0 * self.R_cav**2 / self.xi * upper_incomplete_gamma((self.p - 2.0)/self.xi,y)
+        return np.where(R > 0,mass,0.0)
 
-class similarity_cavity_disk(object):
+
+class similarity_cavity_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
 
         self.sigma0 = kwargs.get("sigma0")
@@ -249,7 +385,11 @@ class similarity_cavity_disk(object):
         return np.maximum(self.floor,similarity_cavity_sigma(R,self.sigma0,self.gamma,self.Rc,self.R_cav,self.xi))
         #return similarity_cavity_sigma(R,self.sigma0,self.gamma,self.Rc,self.R_cav,self.xi)
 
-class ring_disk(object):
+    def dlnsigma_dlnR(self,R):
+        x, y = np.asarray(R,dtype=float)/self.Rc, self.R_cav/np.asarray(R,dtype=float)
+        return self._floored(R,-self.gamma - (2.0 - self.gamma) * x**(2.0 - self.gamma) + self.xi * y**self.xi)
+
+class ring_disk(sigma_profile):
     def __init__(self, *args, **kwargs):
 
         self.sigma0 = kwargs.get("sigma0")
@@ -272,3 +412,149 @@ class ring_disk(object):
     def evaluate(self,R):
         return np.maximum(self.floor,ring_sigma(R,self.sigma0,self.gamma,self.Rinner,self.Router))
 
+    def dlnsigma_dlnR(self,R):
+        R = np.asarray(R,dtype=float)
+        return self._floored(R,-self.gamma + 3.0 * (self.Rinner/R)**3 - 4.0 * (R/self.Router)**4)
+
+
+
+class tabulated_disk(sigma_profile):
+    """
+    Surface density profile given by a table, e.g. the output of a 1D
+    viscous evolution code.
+
+    The table is stored as a monotone (Fritsch-Carlson) cubic in ln R on a
+    uniform grid, so that evaluation only needs an index computed from
+    ln R rather than a binary search. The cumulative mass of the cubic
+    and its logarithmic slope are available in closed form. Outside the
+    tabulated range the surface density is set to the floor.
+
+    Parameters
+    ----------
+    sigma_table : str or array_like
+    a .npy file (or text file) or an array holding two columns (or rows)
+    with the radii and the surface densities
+    sigma0 : float, optional
+    scaling factor applied to the tabulated surface densities
+    Ntable : int, optional
+    number of points of the uniform ln R grid, by default that of the table
+    R0 : float, optional
+    reference radius, used for the sound speed profile
+    """
+    def __init__(self, *args, **kwargs):
+
+        self.sigma_table = kwargs.get("sigma_table")
+        self.sigma0 = kwargs.get("sigma0")
+        self.Ntable = kwargs.get("Ntable")
+        self.R0 = kwargs.get("R0")
+        self.floor = kwargs.get("floor")
+
+        #set default values
+        if (self.sigma0 is None):
+            self.sigma0 = 1.0
+        if (self.R0 is None):
+            self.R0 = 1.0
+        if (self.floor is None):
+            self.floor = 0.0
+
+        if (self.sigma_table is None):
+            print("ERROR: tabulated surface density requires a sigma_table")
+            exit()
+        if isinstance(self.sigma_table,str):
+            if self.sigma_table.endswith('.npy'):
+                table = np.load(self.sigma_table)
+            else:
+                table = np.loadtxt(self.sigma_table)
+        else:
+            table = np.asarray(self.sigma_table,dtype=float)
+        if (table.shape[0] == 2) & (table.ndim == 2) & (table.shape[-1] != 2):
+            table = table.T
+        self._set_table(table[:,0],table[:,1])
+
+    def _set_table(self,R,sigma):
+        order = np.argsort(R)
+        lnR, sigma = np.log(R[order]), sigma[order]
+        N = lnR.shape[0] if (self.Ntable is None) else self.Ntable
+        self.lnR = np.linspace(lnR[0],lnR[-1],N)
+        self.dlnR = self.lnR[1] - self.lnR[0]
+        if (N != lnR.shape[0]) or not np.allclose(self.lnR,lnR):
+            sigma = interpolate.PchipInterpolator(lnR,sigma)(self.lnR)
+        # strictly positive tables are interpolated in ln(sigma), which
+        # follows exponential tails and gives accurate logarithmic slopes
+        self.logarithmic = np.all(sigma > 0)
+        if (self.logarithmic):
+            sigma = np.log(sigma)
+        self.coeffs = monotone_cubic_coefficients(sigma,self.dlnR)
+
+        # mass of each ln R interval, int 2 pi R^2 sigma dlnR, by Gauss-Legendre quadrature
+        t, weights = np.polynomial.legendre.leggauss(6)
+        t, weights = 0.5 * (t + 1), 0.5 * weights
+        cell_mass = np.sum(weights * self._cell_mass_integrand(np.arange(N - 1)[:,None],t[None,:]),axis=1) * self.dlnR
+        self.cumulative_cell_mass = np.append(0,np.cumsum(cell_mass))
+        self.gauss = (t, weights)
+
+    def _locate(self,R):
+        # O(1) lookup of the interval and of the position t in [0,1] within it
+        u = (np.log(R) - self.lnR[0]) * (1.0 / self.dlnR)
+        index = np.clip(u.astype(int),0,self.lnR.shape[0] - 2)
+        inside = (u >= 0) & (u <= self.lnR.shape[0] - 1)
+        return index, u - index, inside
+
+    def _cubic(self,index,t):
+        c0, c1, c2, c3 = np.take(self.coeffs,index,axis=1)
+        y = c0 + t * (c1 + t * (c2 + t * c3))
+        return np.exp(y) if self.logarithmic else y
+
+    def _cubic_slope(self,index,t):
+        # d(ln sigma)/dlnR, or dsigma/dlnR for tables with zeros
+        c0, c1, c2, c3 = np.take(self.coeffs,index,axis=1)
+        return (c1 + t * (2 * c2 + t * 3 * c3)) / self.dlnR
+
+    def _cell_mass_integrand(self,index,t):
+        return 2 * np.pi * np.exp(2 * (self.lnR[index] + t * self.dlnR)) * self._cubic(index,t)
+
+    def evaluate(self,R):
+        index, t, inside = self._locate(np.asarray(R,dtype=float))
+        return np.maximum(self.floor,np.where(inside,self.sigma0 * self._cubic(index,t),0.0))
+
+    def dlnsigma_dlnR(self,R):
+        index, t, inside = self._locate(np.asarray(R,dtype=float))
+        slope = self._cubic_slope(index,t)
+        if not self.logarithmic:
+            sigma = self._cubic(index,t)
+            slope = np.where(sigma > 0,slope / np.where(sigma > 0,sigma,1.0),0.0)
+        return self._floored(R,np.where(inside,slope,0.0))
+
+    @property
+    def has_analytic_mass(self):
+        return self.floor == 0
+
+    def cumulative_mass(self,R):
+        R = np.asarray(R,dtype=float)
+        index, t, inside = self._locate(np.maximum(R,np.exp(self.lnR[0])))
+        t = np.clip(t,0,1)
+        nodes, weights = self.gauss
+        partial = np.sum(weights * self._cell_mass_integrand(index[...,None],t[...,None] * nodes),axis=-1) * t * self.dlnR
+        mass = self.cumulative_cell_mass[index] + partial
+        mass = np.where(R >= np.exp(self.lnR[-1]),self.cumulative_cell_mass[-1],mass)
+        return self.sigma0 * np.where(R > np.exp(self.lnR[0]),mass,0.0)
+
+
+def monotone_cubic_coefficients(y,h):
+    """
+    Coefficients (c0, c1, c2, c3) of the monotone cubic Hermite
+    interpolant (Fritsch & Carlson 1980) of values y on a uniform grid of
+    spacing h, such that on interval i it reads
+    c0 + c1 t + c2 t^2 + c3 t^3 with t in [0, 1].
+    """
+    y = np.asarray(y,dtype=float)
+    delta = np.diff(y) / h
+    slopes = np.empty(y.shape[0])
+    slopes[0], slopes[-1] = delta[0], delta[-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        harmonic = 2.0 / (1.0 / delta[:-1] + 1.0 / delta[1:])
+    slopes[1:-1] = np.where(same_sign,harmonic,0.0)
+
+    y0, y1, m0, m1 = y[:-1], y[1:], slopes[:-1] * h, slopes[1:] * h
+    return np.array([y0, m0, 3 * (y1 - y0) - 2 * m0 - m1, 2 * (y0 - y1) + m0 + m1])
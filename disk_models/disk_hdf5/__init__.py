@@ -1,7 +1,9 @@
 __all__ = ['snapshot_header',
            'read_block',
            'writeheader',
-           'write_block']
+           'write_block',
+           'create_block',
+           'write_block_slice']
 
 from .snapHDF5 import snapshot_header, read_block,\
-    writeheader, write_block
+    writeheader, write_block, create_block, write_block_slice
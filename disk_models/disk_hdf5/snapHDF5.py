@@ -457,3 +457,36 @@ def write_block(f, block, parttype, data):
             print("I/O block already written")
     else:
         print("Unknown I/O block")
+
+
+#######################
+#WRITE BLOCKS BY PARTS#
+#######################
+
+
+def create_block(f, block, parttype, nrows, dtype="float64"):
+    # empty dataset of nrows entries, filled in parts by write_block_slice
+    part_name = "PartType"+str(parttype)
+    if (f.__contains__(part_name) == False):
+        group = f.create_group(part_name)
+    else:
+        group = f.__getitem__(part_name)
+
+    if (block in datablocks):
+        block_name = datablocks[block][0]
+        dim2 = datablocks[block][1]
+        if (group.__contains__(block_name) == False):
+            shape = (nrows,) if (dim2 == 1) else (nrows, dim2)
+            chunks = (min(max(nrows, 1), 65536),) + shape[1:]
+            table = group.create_dataset(block_name, shape=shape, dtype=dtype, chunks=chunks)
+        else:
+            print("I/O block already written")
+    else:
+        print("Unknown I/O block")
+
+
+def write_block_slice(f, block, parttype, data, offset):
+    # rows offset:offset+len(data) of a block made by create_block
+    block_name = datablocks[block][0]
+    table = f["PartType"+str(parttype)][block_name]
+    table[offset:offset+data.shape[0]] = data
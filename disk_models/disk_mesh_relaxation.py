@@ -0,0 +1,260 @@
+from __future__ import print_function
+"""
+Lloyd relaxation and clean-up of distributions of mesh-generating points
+
+
+"""
+
+import multiprocessing
+
+import numpy as np
+import numpy.random as rd
+from scipy.spatial import cKDTree
+
+
+def mass_sampler(rvals,mvals,table=None):
+    """
+    Sampler of the mass distribution of a disk restricted to an annular
+    sector, for lloyd_relaxation. Radii follow the enclosed mass
+    mvals(rvals), azimuths are uniform, and heights (if a vertical
+    structure table is given) follow the vertical mass of the columns.
+    Each sample carries the weight rho^(2/d), with rho the surface density
+    in 2D (d = 2) and the density in 3D (d = 3): the centroidal Voronoi
+    tessellation of the weighted samples has a density of points
+    proportional to rho, i.e. cells of equal mass, whereas that of the
+    plain mass distribution would only follow rho^(d/(d+2)).
+
+    Parameters
+    ----------
+    rvals, mvals : ndarray
+    enclosed mass of the disk, as returned by evaluate_enclosed_mass
+    table : VerticalStructureTable, optional
+    vertical structure of a 3D disk
+
+    Returns
+    -------
+    sample : function
+    sample(N, Rlim, philim) returns R, phi, z (None in 2D) and the weights
+    of N points with Rlim[0] <= R <= Rlim[1] and philim[0] <= phi <= philim[1]
+    """
+    sigma = np.gradient(mvals,rvals)/(2*np.pi*rvals)
+    sigma_R = rvals
+    rvals, mvals = np.append([0],rvals), np.append([0],mvals)
+
+    def sample(N,Rlim,philim):
+        mlim = np.interp(Rlim,rvals,mvals)
+        R = np.interp(mlim[0] + (mlim[1] - mlim[0]) * rd.random_sample(N),mvals,rvals)
+        phi = philim[0] + (philim[1] - philim[0]) * rd.random_sample(N)
+        if (table is None): return R,phi,None,np.interp(R,sigma_R,sigma)
+        side = 2*rd.random_sample(N) - 1
+        z = table.sample_heights(R,np.abs(side)) * np.where(side < 0,-1,1)
+        return R,phi,z,table.density(R,z)**(2.0/3)
+
+    return sample
+
+
+def lloyd_relaxation(R,phi,z,sampler,steps,region=None,n_workers=1,samples_per_point=50,
+                     halo=3.0,block_size=100000):
+    """
+    Move the points with radii inside `region` towards the mass-weighted
+    centroids of their Voronoi cells, in `steps` Lloyd iterations.
+
+    Centroids are estimated by Monte Carlo: at each step, points drawn from
+    the mass distribution of the disk are assigned to their nearest
+    mesh-generating point, and every point moves to the weighted mean
+    position of the samples it received, so that the relaxed mesh keeps following the
+    density of the disk while its cells become rounder and more regular.
+    Points on the surface of the sample, whose cells reach into the
+    low-density tails of the disk, are drawn in towards the disk.
+    The region is split into azimuthal sectors of at most `block_size`
+    points, each relaxed with the points of a surrounding halo held fixed
+    (and with samples drawn over the sector and its halo), so that memory
+    use is bounded and sectors can be relaxed by `n_workers` processes.
+
+    Parameters
+    ----------
+    R, phi : ndarray
+    cylindrical coordinates of the points
+    z : ndarray or None
+    heights of the points, None for a 2D mesh
+    sampler : function
+    weighted sampler of the mass distribution, see mass_sampler
+    steps : int
+    number of Lloyd iterations
+    region : tuple, optional
+    radial range (Rmin, Rmax) of the points that move, all points by default
+    n_workers : int, optional
+    number of processes relaxing the sectors
+    samples_per_point : int, optional
+    number of Monte Carlo samples per point at each step
+    halo : float, optional
+    width of the halos in units of the typical point separation
+    block_size : int, optional
+    largest number of points moved in one sector
+
+    Returns
+    -------
+    R, phi, z : ndarray
+    relaxed coordinates (z is None in 2D)
+    """
+    if (region is None): region = (0,np.inf)
+    if (n_workers is None): n_workers = 1
+    pos = np.column_stack([R * np.cos(phi),R * np.sin(phi)] + ([] if z is None else [z]))
+    movable = np.where((R >= region[0]) & (R < region[1]))[0]
+    if (movable.shape[0] == 0) | (steps <= 0):
+        return R,phi,z
+
+    # halo width from the separation of the points that move
+    separation = cKDTree(pos).query(pos[movable],k=2)[0][:,1]
+    width = halo * np.percentile(separation,90)
+    Nblocks = max(n_workers,int(np.ceil(movable.shape[0]*1.0/block_size)))
+    print("Relaxing %i mesh-generating points in %i sectors (%i Lloyd steps)" %
+          (movable.shape[0],Nblocks,steps))
+
+    pool = None
+    if (n_workers > 1): pool = multiprocessing.Pool(n_workers)
+    try:
+        for step in range(steps):
+            Rpos, phipos = np.sqrt(pos[:,0]**2 + pos[:,1]**2), np.arctan2(pos[:,1],pos[:,0])
+            sector = (np.mod(phipos[movable],2*np.pi) * Nblocks/(2*np.pi)).astype(int) % Nblocks
+            # sectors are relaxed against the positions of the previous step,
+            # n_workers sectors at a time
+            relaxed, shift = pos.copy(), 0.0
+            for first in range(0,Nblocks,n_workers):
+                blocks = range(first,min(first + n_workers,Nblocks))
+                tasks = [_sector_task(pos,Rpos,phipos,movable[sector == k],k,Nblocks,region,
+                                      width,sampler,samples_per_point) for k in blocks]
+                if (pool is None):
+                    moved = [_relax_sector(task) for task in tasks]
+                else:
+                    moved = pool.map(_relax_sector,tasks)
+                for k, new in zip(blocks,moved):
+                    inds = movable[sector == k]
+                    shift += np.sum(np.sqrt(np.sum((new - pos[inds])**2,axis=1)))
+                    relaxed[inds] = new
+            pos = relaxed
+            print("....step %i: mean displacement %g (point separation %g)" %
+                  (step + 1,shift/movable.shape[0],np.median(separation)))
+    finally:
+        if (pool is not None):
+            pool.close()
+            pool.join()
+
+    R, phi = np.sqrt(pos[:,0]**2 + pos[:,1]**2), np.arctan2(pos[:,1],pos[:,0])
+    if (z is not None): z = pos[:,2]
+    return R,phi,z
+
+
+def _sector_task(pos,R,phi,inds,k,Nblocks,region,width,sampler,samples_per_point):
+    """
+    Points (the ones that move first) and Monte Carlo samples of sector k
+    out of Nblocks; points lying within twice the halo width of the sector
+    surround it, and samples are drawn within one halo width
+    """
+    half = np.pi/Nblocks
+    center = (k + 0.5) * 2 * half
+
+    def within(Rv,phiv,dist):
+        inside = (Rv >= region[0] - dist) & (Rv <= region[1] + dist)
+        if (Nblocks > 1):
+            dphi = np.mod(phiv - center + np.pi,2*np.pi) - np.pi
+            inside &= (np.abs(dphi) <= half + dist/np.maximum(Rv,1.0e-30))
+        return inside
+
+    near = within(R,phi,2 * width)
+    near[inds] = False
+    points = np.concatenate([pos[inds],pos[near]])
+
+    Rlim = np.array([max(region[0] - width,0.0),min(region[1] + width,R.max() + width)])
+    philim = (0.0,2*np.pi)
+    if (Nblocks > 1) & (Rlim[0] > 0):
+        spread = half + width/Rlim[0]
+        if (spread < np.pi): philim = (center - spread,center + spread)
+
+    # draw until the sector and its halo hold the wanted number of samples
+    Nsamples = samples_per_point * points.shape[0]
+    samples, weights, Nkept = [], [], 0
+    for attempt in range(20):
+        Rs, phis, zs, ws = sampler(max(Nsamples - Nkept,1000),Rlim,philim)
+        keep = within(Rs,phis,width)
+        new = [Rs[keep] * np.cos(phis[keep]),Rs[keep] * np.sin(phis[keep])]
+        if (zs is not None): new.append(zs[keep])
+        samples.append(np.column_stack(new))
+        weights.append(ws[keep])
+        Nkept += np.count_nonzero(keep)
+        if (Nkept >= Nsamples): break
+
+    return points, inds.shape[0], np.concatenate(samples), np.concatenate(weights)
+
+
+def _relax_sector(task):
+    """
+    Centroids of the first Nmove points of a sector, from the weighted
+    samples assigned to each point; points without samples stay put
+    """
+    points, Nmove, samples, weights = task
+    nearest = cKDTree(points).query(samples)[1]
+    total = np.bincount(nearest,weights=weights,minlength=points.shape[0])[:Nmove]
+    moved = points[:Nmove].copy()
+    filled = total > 0
+    for dim in range(points.shape[1]):
+        centroid = np.bincount(nearest,weights=weights * samples[:,dim],minlength=points.shape[0])[:Nmove]
+        moved[filled,dim] = centroid[filled]/total[filled]
+    return moved
+
+
+def remove_close_points(R,phi,z=None,min_separation=0.05,Nngb=None):
+    """
+    Points that can be kept so that no two of them lie closer than
+    min_separation times their local spacing, the distance to the Nngb-th
+    nearest neighbour divided by Nngb^(1/d). Of each pair of points that
+    are too close, the later one is removed, so that points appended to
+    the disk sample (background, center and box fill) give way to it.
+    Neighbours are found with a KD-tree, in O(N log N) operations. Groups
+    of more than Nngb nearly coincident points set their own local
+    spacing, and are not thinned.
+
+    Parameters
+    ----------
+    R, phi : ndarray
+    cylindrical coordinates of the points
+    z : ndarray, optional
+    heights of the points, None for a 2D mesh
+    min_separation : float, optional
+    smallest allowed separation in units of the local spacing
+    Nngb : int, optional
+    neighbour defining the local spacing, 2^d by default
+
+    Returns
+    -------
+    keep : ndarray of bool
+    points that are kept
+    """
+    pos = np.column_stack([R * np.cos(phi),R * np.sin(phi)] + ([] if z is None else [z]))
+    dims = pos.shape[1]
+    if (Nngb is None): Nngb = 2**dims
+    keep = np.ones(pos.shape[0],dtype=bool)
+
+    # pairs left behind by the removal of a point are found by the next pass
+    while True:
+        inds = np.where(keep)[0]
+        if (inds.shape[0] <= Nngb): break
+        N = inds.shape[0]
+        dist, ngb = cKDTree(pos[inds]).query(pos[inds],k=Nngb + 1)
+        spacing = dist[:,-1]/Nngb**(1.0/dims)
+        # leave out the match of each point with itself, which need not be
+        # the first column when points coincide
+        close = (dist < min_separation * np.minimum(spacing[:,None],spacing[ngb])) & \
+                (ngb != np.arange(N)[:,None])
+        row = np.nonzero(close)[0]
+        first, second = np.minimum(row,ngb[close]), np.maximum(row,ngb[close])
+        # each pair once, closest pairs first
+        _, unique = np.unique(first * N + second,return_index=True)
+        pairs = unique[np.argsort(dist[close][unique],kind='mergesort')]
+        removed = np.zeros(N,dtype=bool)
+        for i, j in zip(first[pairs],second[pairs]):
+            if not (removed[i] or removed[j]): removed[j] = True
+        if not removed.any(): break
+        keep[inds[removed]] = False
+
+    return keep
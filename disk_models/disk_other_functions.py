@@ -1,4 +1,5 @@
 import time, sys
+import numpy as np
 
 # update_progress() : Displays or updates a console progress bar
 ## Accepts a float between 0 and 1. Any int will be converted to a float.
@@ -24,3 +25,316 @@ def update_progress(completed,total):
     if (total-completed == 1): text = text+"\n"
     sys.stdout.write(text)
     sys.stdout.flush()
+
+
+def cumulative_integral(func,xvals,x0=0.0,order=8,rtol=1.0e-8,max_levels=30):
+    """
+    Cumulative integral F(x) = int_{x0}^{x} func(x') dx' evaluated at every
+    x in `xvals` in a single vectorized pass.
+
+    The intervals between consecutive (sorted) values of `xvals` are
+    integrated with Gauss-Legendre quadrature of the given order, all at
+    once, and the results summed cumulatively. Intervals with x > 0 are
+    integrated in log(x), which suits the logarithmic radial grids used
+    for disk profiles, and the innermost interval starting at x = 0 is
+    integrated in sqrt(x), which removes integrable power-law
+    singularities like those of sigma*R for sigma ~ R^(-p), p < 2. The
+    error of each interval is estimated by comparing the quadrature on
+    the whole interval with the sum over its two halves; intervals above
+    the tolerance are bisected, again all at once, until they converge
+    or `max_levels` bisections are reached.
+
+    Parameters
+    ----------
+    func : callable
+    integrand, must accept and return numpy arrays
+    xvals : array_like
+    upper limits of integration, all >= x0
+    x0 : float, optional
+    common lower limit of integration
+    order : int, optional
+    number of Gauss-Legendre nodes per interval
+    rtol : float, optional
+    relative tolerance, measured with respect to the interval's own
+    integral or to the mean interval contribution, whichever is larger
+
+    Returns
+    -------
+    F : ndarray
+    cumulative integral at each value of `xvals`, in the input order
+    """
+
+    xvals = np.asarray(xvals,dtype=float)
+    shape = xvals.shape
+    xvals = xvals.flatten()
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+
+    def transform(x,uselog,usesqrt):
+        # integration variable u(x) of each interval
+        u = np.where(usesqrt,np.sqrt(np.abs(x)),x)
+        return np.where(uselog,np.log(np.where(uselog,x,1.0)),u)
+    
+    def gauss(a,b):
+        uselog, usesqrt = a > 0, a == 0
+        ua, ub = transform(a,uselog,usesqrt), transform(b,uselog,usesqrt)
+        half, mid = 0.5 * (ub - ua), 0.5 * (ub + ua)
+        u = mid[:,None] + half[:,None] * nodes[None,:]
+        x = np.where(uselog[:,None],np.exp(u),np.where(usesqrt[:,None],u * u,u))
+        jacobian = np.where(uselog[:,None],x,np.where(usesqrt[:,None],2 * u,1.0))
+        fvals = np.asarray(func(x.flatten()),dtype=float).reshape(x.shape)
+        return half * (fvals * jacobian * weights[None,:]).sum(axis=1)
+
+    order_x = np.argsort(xvals)
+    edges = np.append(x0,xvals[order_x])
+    a, b = edges[:-1], edges[1:]
+    owner = np.arange(a.shape[0])
+    segments = np.zeros(a.shape[0])
+    
+    coarse = gauss(a,b)
+    scale = np.abs(coarse).sum() / max(a.shape[0],1)
+    for level in range(max_levels + 1):
+        if (a.shape[0] == 0): break
+        mid = np.where(a > 0,np.sqrt(np.abs(a * b)),np.where(a == 0,0.25 * b,0.5 * (a + b)))
+        left, right = gauss(a,mid), gauss(mid,b)
+        fine = left + right
+        done = np.abs(fine - coarse) <= rtol * np.maximum(np.abs(fine),scale)
+        if (level == max_levels): done[:] = True
+        np.add.at(segments,owner[done],fine[done])
+        todo = np.invert(done)
+        a, b = np.append(a[todo],mid[todo]), np.append(mid[todo],b[todo])
+        coarse = np.append(left[todo],right[todo])
+        owner = np.append(owner[todo],owner[todo])
+
+    F = np.empty(xvals.shape[0])
+    F[order_x] = np.cumsum(segments)
+    return F.reshape(shape)
+
+
+def evaluate_callable(func,xvals,vectorized=None,chunksize=4096):
+    """
+    Evaluate a user-supplied function of one variable on an array.
+
+    Functions that accept arrays (numpy expressions, interp1d tables, ...)
+    are called once on the whole array. Scalar-only functions are called
+    point by point, one chunk of `chunksize` values at a time.
+
+    Parameters
+    ----------
+    func : callable
+    function of one variable
+    xvals : array_like
+    values at which to evaluate the function
+    vectorized : bool or None, optional
+    whether `func` accepts arrays. If None, this is detected by calling
+    it on the whole array and checking the shape of the result
+    chunksize : int, optional
+    number of values per chunk for scalar-only functions
+
+    Returns
+    -------
+    fvals : ndarray
+    function values, with the shape of `xvals`
+    vectorized : bool
+    whether `func` was called on the whole array, to be passed to
+    subsequent calls
+    """
+
+    xvals = np.asarray(xvals,dtype=float)
+    if (vectorized is None) | (vectorized is True):
+        try:
+            fvals = np.asarray(func(xvals),dtype=float)
+        except (TypeError,ValueError):
+            fvals = None
+        if (fvals is not None) and (fvals.shape == xvals.shape):
+            return fvals, True
+        if (vectorized is True):
+            raise ValueError("function declared vectorized does not return an array of the input shape")
+
+    flat = xvals.flatten()
+    fvals = np.empty(flat.shape[0])
+    for start in range(0,flat.shape[0],chunksize):
+        chunk = flat[start:start+chunksize]
+        fvals[start:start+chunksize] = np.fromiter((func(x) for x in chunk),dtype=float,count=chunk.shape[0])
+    return fvals.reshape(xvals.shape), False
+
+
+def cumulative_trapezoid(y,x,axis=-1):
+    """
+    Cumulative trapezoidal integral of y(x) along `axis`, starting at zero,
+    so that the result has the shape of y. Works on stacks of profiles,
+    e.g. y and x of shape (N_R, N_z) integrated along z.
+    """
+    y, x = np.asarray(y,dtype=float), np.asarray(x,dtype=float)
+    y, x = np.moveaxis(y,axis,-1), np.moveaxis(np.broadcast_to(x,y.shape),axis,-1)
+    segments = 0.5 * (y[...,1:] + y[...,:-1]) * np.diff(x,axis=-1)
+    integral = np.concatenate([np.zeros(y.shape[:-1] + (1,)),np.cumsum(segments,axis=-1)],axis=-1)
+    return np.moveaxis(integral,-1,axis)
+
+
+def cumulative_simpson(y,ymid,x):
+    """
+    Cumulative Simpson integral of y(x) along the last axis, starting at
+    zero, given y at the points x and ymid at the midpoints between them.
+    The integral is also returned at the midpoints, from the quadratic
+    through the three values of each interval.
+
+    Returns
+    -------
+    integral, integral_mid : ndarray
+    integral at the points x, shape of y, and at the midpoints, shape of ymid
+    """
+    y, ymid = np.asarray(y,dtype=float), np.asarray(ymid,dtype=float)
+    h = np.diff(np.broadcast_to(x,y.shape),axis=-1)
+    segments = h/6.0 * (y[...,:-1] + 4 * ymid + y[...,1:])
+    integral = np.concatenate([np.zeros(y.shape[:-1] + (1,)),np.cumsum(segments,axis=-1)],axis=-1)
+    return integral, integral[...,:-1] + h/24.0 * (5 * y[...,:-1] + 8 * ymid - y[...,1:])
+
+
+def rowwise_interp(xq,rows,xgrid,ygrid):
+    """
+    Linear interpolation of many tabulated functions at once: the value at
+    xq[i] of the function tabulated in row rows[i] of (xgrid, ygrid).
+    Rows of xgrid must be sorted; queries outside a row take its end values.
+
+    Parameters
+    ----------
+    xq : array_like
+    query points
+    rows : array_like of int
+    row of the table for each query point
+    xgrid, ygrid : array_like, shape (N_rows, N_x)
+    tabulated abscissae and values
+
+    Returns
+    -------
+    yq : ndarray
+    interpolated values, with the shape of xq
+    """
+    xq, rows = np.asarray(xq,dtype=float), np.asarray(rows,dtype=int)
+    xgrid, ygrid = np.asarray(xgrid,dtype=float), np.asarray(ygrid,dtype=float)
+    Nrows, Nx = xgrid.shape
+
+    # sort table and query points together by (row, x); the number of
+    # table points preceding a query within its row is its interval index
+    keys_row = np.append(np.repeat(np.arange(Nrows),Nx),rows.ravel())
+    keys_x = np.append(xgrid.ravel(),xq.ravel())
+    is_query = np.append(np.zeros(Nrows * Nx,dtype=bool),np.ones(xq.size,dtype=bool))
+    order = np.lexsort((is_query,keys_x,keys_row))
+    preceding = np.cumsum(np.invert(is_query[order]))
+    index = np.empty(xq.size,dtype=int)
+    index[order[is_query[order]] - Nrows * Nx] = preceding[is_query[order]]
+    index = index - rows.ravel() * Nx
+
+    right = np.clip(index,1,Nx - 1)
+    left = right - 1
+    r = rows.ravel()
+    x0, x1 = xgrid[r,left], xgrid[r,right]
+    y0, y1 = ygrid[r,left], ygrid[r,right]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        weight = np.clip(np.where(x1 > x0,(xq.ravel() - x0)/(x1 - x0),0.0),0,1)
+    return (y0 + weight * (y1 - y0)).reshape(xq.shape)
+
+
+class PointBins(object):
+    """
+    Grouping of points into the bins of np.digitize(x, edges), computed
+    with a single stable sort, so that per-bin counts, sums, means, maxima
+    and member indices cost O(N log N) in total instead of one pass over
+    all points per bin.
+
+    Bin k holds the points with edges[k-1] <= x < edges[k]; bins 0 and
+    len(edges) hold the points below and above the edges.
+
+    Parameters
+    ----------
+    x : array_like
+    coordinate of the points
+    edges : array_like
+    increasing bin edges
+    """
+
+    def __init__(self,x,edges):
+        self.edges = np.asarray(edges)
+        self.Nbins = self.edges.shape[0] + 1
+        self.index = np.digitize(x,self.edges)
+        self.counts = np.bincount(self.index,minlength=self.Nbins)
+        self.order = np.argsort(self.index,kind='mergesort')
+        self.offsets = np.append(0,np.cumsum(self.counts))
+
+    def members(self,k):
+        """
+        Indices of the points in bin k
+        """
+        return self.order[self.offsets[k]:self.offsets[k+1]]
+
+    def groups(self):
+        """
+        List of the indices of the points in each bin
+        """
+        return np.split(self.order,self.offsets[1:-1])
+
+    def sum(self,values):
+        return np.bincount(self.index,weights=values,minlength=self.Nbins)
+
+    def mean(self,values):
+        """
+        Mean of the values in each bin, nan for empty bins
+        """
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.sum(values)/self.counts
+
+    def max(self,values):
+        """
+        Largest value in each bin, -inf for empty bins
+        """
+        maxima = np.full(self.Nbins,-np.inf)
+        filled = self.counts > 0
+        if filled.any():
+            maxima[filled] = np.maximum.reduceat(np.asarray(values)[self.order],self.offsets[:-1][filled])
+        return maxima
+
+
+def halton_sequence(N,dims,skip=0,random_state=None):
+    """
+    Scrambled Halton sequence: points skip, ..., skip+N-1 of the
+    low-discrepancy sequence in the unit cube with prime bases 2, 3, 5, ...
+    Every digit position of every dimension has its own random permutation
+    of the digits (including the trailing zeros of the index), which
+    breaks the correlations between dimensions of the plain sequence while
+    keeping its low discrepancy. The permutations depend only on
+    random_state, so consecutive chunks of one sequence can be generated
+    separately by passing the same seed for each of them.
+
+    Parameters
+    ----------
+    N : int
+    number of points
+    dims : int
+    number of dimensions, at most 10
+    skip : int, optional
+    index of the first point
+    random_state : int or array_like, optional
+    seed of the permutations, drawn once from numpy.random by default
+
+    Returns
+    -------
+    u : ndarray, shape (N, dims)
+    points in [0, 1)
+    """
+    primes = [2,3,5,7,11,13,17,19,23,29]
+    if (random_state is None): random_state = np.random.randint(2**31 - 1)
+    random = np.random.RandomState(random_state)
+
+    u = np.zeros((N,dims))
+    for dim in range(dims):
+        base = primes[dim]
+        # enough digits to resolve double precision
+        ndigits = int(np.ceil(53 * np.log(2)/np.log(base)))
+        perms = np.array([random.permutation(base) for digit in range(ndigits)])
+        index = np.arange(skip,skip + N,dtype=np.int64)
+        scale = 1.0
+        for digit in range(ndigits):
+            scale /= base
+            u[:,dim] += perms[digit][index % base] * scale
+            index //= base
+    return np.minimum(u,1 - np.finfo(float).eps/2)
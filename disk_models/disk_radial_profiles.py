@@ -0,0 +1,137 @@
+from __future__ import print_function
+"""
+Radial profiles of a disk model tabulated on a single radial grid
+
+
+"""
+
+import numpy as np
+
+
+class RadialProfileTable(object):
+    """
+    Table of the radial profiles (surface density, sound speed,
+    pressure, angular frequency, viscosity, enclosed mass, ...) of a
+    disk model on one radial grid.
+
+    Each quantity is computed the first time it is requested by calling
+    the `_profile_<name>` method of the disk model, and stored for
+    subsequent requests. Quantities that depend on other quantities
+    (e.g. the pressure on the surface density and the sound speed) read
+    them from the same table, so every profile is evaluated at most once
+    per (Rin, Rout, Nvals, scale) grid. The table records the parameter
+    fingerprint of the disk, and starts afresh if the parameters have
+    changed when a new quantity is requested.
+
+    Parameters
+    ----------
+    disk : disk3d or disk2d
+    the disk model providing the `_profile_<name>` methods
+    Rin, Rout : float
+    radial limits of the grid
+    Nvals : int, optional
+    number of radial zones
+    scale : {'log', 'linear'}, optional
+    spacing of the radial zones
+    radii_list : array_like, optional
+    explicit list of radii, overrides the grid parameters
+
+    """
+
+    def __init__(self,disk,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        self.disk = disk
+        self.Rin = Rin
+        self.Rout = Rout
+        self.Nvals = Nvals
+        self.scale = scale
+        self.radii_list = radii_list
+        self.rvals = disk.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
+        self.values = {}
+        self.fingerprint = getattr(disk,'fingerprint',None)
+
+    def __getitem__(self,name):
+        if name not in self.values:
+            # profiles computed before a change of the disk parameters are discarded
+            if (self.fingerprint is not None):
+                fingerprint = self.disk.fingerprint
+                if (fingerprint != self.fingerprint):
+                    self.values, self.fingerprint = {}, fingerprint
+            self.values[name] = getattr(self.disk,'_profile_'+name)(self)
+        return self.values[name]
+
+    def __contains__(self,name):
+        return name in self.values
+
+    def evaluate(self,name):
+        """
+        Return copies of the radii and of the tabulated quantity `name`,
+        in the `rvals, quantity` form used by the disk `evaluate_*` methods.
+        """
+        return np.array(self.rvals,dtype=float), np.array(self[name],dtype=float)
+
+    def gradient(self,quantity):
+        _, dQdR = self.disk.evaluate_radial_gradient(quantity,self.Rin,self.Rout,self.Nvals,
+                                                     scale=self.scale,radii_list=self.rvals)
+        return dQdR
+
+
+def adaptive_radial_zones(disk,Rin,Rout,rtol=1.0e-3,Ninit=33,Nmax=1000,
+                          quantities=('sigma','pressure','omega_sq_gravity')):
+    """
+    Radial grid refined until the radial profiles of the disk are
+    reproduced by linear interpolation to a relative tolerance.
+
+    Starting from a logarithmic grid of `Ninit` zones, every interval is
+    tested at its logarithmic midpoint: if any of the `quantities`
+    differs there from the linear interpolation between the interval
+    ends by more than `rtol` (relative to the local value, or to 1e-10
+    of the largest value for quantities that vanish), the midpoint is
+    added to the grid. Intervals are bisected until all pass or the grid
+    reaches `Nmax` zones, in which case the worst intervals are refined
+    first. Smooth power-law stretches thus keep few zones, while steep
+    features such as cavity edges are resolved.
+
+    Parameters
+    ----------
+    disk : disk3d or disk2d
+    the disk model
+    Rin, Rout : float
+    radial limits of the grid
+    rtol : float, optional
+    relative interpolation tolerance
+    Ninit, Nmax : int, optional
+    initial and maximum number of radial zones
+    quantities : sequence of str, optional
+    names of the profiles (as in RadialProfileTable) to be resolved
+
+    Returns
+    -------
+    rvals : ndarray
+    the refined radii, to be passed on as `radii_list`
+    """
+
+    rvals = np.logspace(np.log10(Rin),np.log10(Rout),Ninit)
+    while (True):
+        mid = np.sqrt(rvals[:-1] * rvals[1:])
+        grid = np.empty(2 * rvals.shape[0] - 1)
+        grid[0::2], grid[1::2] = rvals, mid
+        table = RadialProfileTable(disk,Rin,Rout,radii_list=grid)
+
+        weight = (mid - rvals[:-1])/(rvals[1:] - rvals[:-1])
+        error = np.zeros(mid.shape[0])
+        for name in quantities:
+            q = np.asarray(table[name],dtype=float)
+            q_lin = q[0:-1:2] + (q[2::2] - q[0:-1:2]) * weight
+            scale = np.maximum(np.abs(q[1::2]),1.0e-10 * np.abs(q).max())
+            error = np.maximum(error,np.abs(q[1::2] - q_lin)/scale/rtol)
+
+        refine = error > 1
+        budget = Nmax - rvals.shape[0]
+        if (refine.sum() > budget):
+            refine = np.zeros(mid.shape[0],dtype=bool)
+            refine[np.argsort(error)[::-1][:max(budget,0)]] = True
+        if not refine.any():
+            break
+        rvals = np.sort(np.append(rvals,mid[refine]))
+
+    return rvals
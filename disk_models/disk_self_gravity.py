@@ -0,0 +1,228 @@
+from __future__ import print_function
+"""
+Rotation curves of razor-thin, self-gravitating disks
+
+
+"""
+
+import numpy as np
+import scipy.special as special
+
+
+def legendre_coefficients(kmax):
+    """
+    Coefficients alpha_k = pi * P_2k(0)^2 of the Legendre series of the
+    potential of a razor-thin disk, for k = 1,...,kmax
+    """
+    c = np.cumprod((2.0 * np.arange(1,kmax+1) - 1)/(2.0 * np.arange(1,kmax+1)))
+    return np.pi * c**2
+
+
+def legendre_selfgravity_vcirc_sq(radii,rvals,sigma,G=1.0,kmax=40,abstol=1.0e-7,reltol=1.0e-6):
+    """
+    Multipole (k >= 1) contribution to the squared circular velocity in
+    the plane of a razor-thin disk, from the Legendre series
+
+    delta v^2(r) = G sum_k 2 alpha_k [(2k+1) r^-(2k+1) int_0^r sigma R^(2k+1) dR
+                                      - 2k r^(2k) int_r^inf sigma R^(-2k) dR]
+
+    All radii and all orders are evaluated at once. The integrals are
+    cumulative trapezoidal sums over the surface density table, computed
+    in logarithmic form (np.logaddexp.accumulate) so that the large
+    powers of R neither overflow nor underflow. The series is truncated
+    independently at each radius, at the first order where the change of
+    the partial sum falls below the absolute (for large sums) or relative
+    tolerance.
+
+    Parameters
+    ----------
+    radii : array_like
+    radii where the circular velocity is requested
+    rvals, sigma : array_like
+    surface density table, the integrals are restricted to its extent;
+    radii not in the table are inserted by linear interpolation
+    G : float, optional
+    gravitational constant
+    kmax : int, optional
+    maximum order of the series
+
+    Returns
+    -------
+    delta_vcirc_sq : ndarray
+    multipole contribution to v^2 at `radii`; the monopole, G M(<r)/r,
+    must be added separately
+    """
+
+    # add the requested radii to the table
+    radii = np.asarray(radii,dtype=float)
+    grid = np.union1d(rvals,radii)
+    sigma, rvals = np.interp(grid,rvals,sigma), grid
+
+    with np.errstate(divide='ignore'):
+        lnR, lnsigma = np.log(rvals), np.log(sigma)
+    lnhalfdR = np.log(0.5 * np.diff(rvals))
+
+    k = np.arange(1,kmax+1)[:,None]
+    empty = np.full((kmax,1),-np.inf)
+
+    # inner integrals, int_R0^R sigma R^(2k+1) dR, divided by R^(2k+1)
+    lnf = lnsigma[None,:] + (2 * k + 1) * lnR[None,:]
+    lnseg = np.logaddexp(lnf[:,:-1],lnf[:,1:]) + lnhalfdR[None,:]
+    lnint1 = np.append(empty,np.logaddexp.accumulate(lnseg,axis=1),axis=1)
+    term1 = (2 * k + 1) * np.exp(lnint1 - (2 * k + 1) * lnR[None,:])
+
+    # outer integrals, int_R^R1 sigma R^-2k dR, multiplied by R^2k
+    lnf = lnsigma[None,:] - 2 * k * lnR[None,:]
+    lnseg = np.logaddexp(lnf[:,:-1],lnf[:,1:]) + lnhalfdR[None,:]
+    lnint2 = np.append(np.logaddexp.accumulate(lnseg[:,::-1],axis=1)[:,::-1],empty,axis=1)
+    term2 = 2 * k * np.exp(lnint2 + 2 * k * lnR[None,:])
+
+    partial_sums = np.cumsum(2.0 * legendre_coefficients(kmax)[:,None] * G * (term1 - term2),axis=0)
+
+    # truncate the series independently at each radius
+    previous = np.append(np.full((1,rvals.shape[0]),1.0e20),partial_sums[:-1,:],axis=0)
+    abserr = np.abs(partial_sums - previous)
+    relerr = abserr/np.abs(previous)
+    converged = np.where(np.abs(partial_sums) > abstol/reltol,abserr < abstol,relerr < reltol)
+    converged[-1,:] = True
+    order = np.argmax(converged,axis=0)
+    delta_vcirc_sq = partial_sums[order,np.arange(rvals.shape[0])]
+
+    return delta_vcirc_sq[np.searchsorted(rvals,radii)]
+
+
+
+
+def razor_thin_force_kernel(w):
+    """
+    Radial force kernel of a razor-thin disk in logarithmic radius,
+
+    k(w) = s^2 int_0^2pi (1 - s cos phi)/(1 + s^2 - 2 s cos phi)^3/2 dphi
+
+    with s = R'/R = exp(-w), such that the in-plane angular frequency is
+    Omega^2(R) = G/R int sigma(R') k(ln R - ln R') dln R'. The kernel
+    behaves as 2/w + O(ln|w|) for w -> 0, and decays as exp(-2w) and
+    exp(w) for w -> +inf and -inf.
+    """
+    w = np.asarray(w,dtype=float)
+    s = np.exp(-w)
+    # with m = 4s/(1+s)^2, the angular integrals reduce to complete
+    # elliptic integrals; 1 - m = tanh(w/2)^2 is passed explicitly to keep
+    # the precision close to the singularity
+    p = np.tanh(0.5 * w)**2
+    return 2.0 * s**2 * (special.ellipe(1 - p) / (-np.expm1(-w)) + special.ellipkm1(p) / (1 + s))
+
+
+def _hat_integral(func,n,order=16):
+    """
+    Integral of func(t) against the hat function 1 - |t - n| over
+    [n-1, n+1], with the substitution t = v^2 on the halves that end at
+    t = 0, where func may have an integrable logarithmic singularity
+    """
+    x, wx = np.polynomial.legendre.leggauss(order)
+    x, wx = 0.5 * (x + 1), 0.5 * wx
+    total = 0.0
+    for lo, hi in ((n - 1,n),(n,n + 1)):
+        if (lo == 0) | (hi == 0):
+            start = hi if lo == 0 else lo
+            t, jac = start * x**2, 2.0 * x
+        else:
+            t, jac = lo + x, 1.0
+        total += np.sum(wx * jac * (1 - np.abs(t - n)) * func(t))
+    return total
+
+
+def _force_kernel_weights(N,du,order=16):
+    """
+    Weights K_n = du int k(t du) (1 - |t - n|) dt of the force kernel
+    against the hat functions of a piecewise-linear surface density, for
+    lags n = -N,...,N-1. Around t = 0 the 2/w part of the kernel is
+    integrated analytically, as a principal value.
+    """
+    x, wx = np.polynomial.legendre.leggauss(order)
+    x, wx = 0.5 * (x + 1), 0.5 * wx
+    lags = np.arange(-N,N)[:,None]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        weights = np.sum(wx * x * razor_thin_force_kernel((lags - 1 + x) * du) +
+                         wx * (1 - x) * razor_thin_force_kernel((lags + x) * du),axis=1) * du
+
+    def residual(t):
+        return razor_thin_force_kernel(t * du) - 2.0/(t * du)
+    for n in (-1,0,1):
+        principal_value = 2.0 * n * np.log(4.0)
+        weights[N + n] = du * _hat_integral(residual,n,order) + principal_value
+    return weights
+
+
+def _edge_weights(N,du,order=16):
+    """
+    Weights of the outer halves of the hat functions at the first and last
+    grid points, which lie outside the disk; the singular self-terms at
+    the edges are left out
+    """
+    x, wx = np.polynomial.legendre.leggauss(order)
+    x, wx = 0.5 * (x + 1), 0.5 * wx
+    lags = np.arange(1,N)[:,None] + x
+    lower = np.append(0,np.sum(wx * (1 - x) * razor_thin_force_kernel(lags * du),axis=1) * du)
+    upper = np.append(np.sum(wx * (1 - x) * razor_thin_force_kernel(-lags * du),axis=1)[::-1] * du,0)
+    return lower, upper
+
+
+_kernel_cache = {}
+
+def _force_kernel_transform(N,du):
+    """
+    Real FFT of the kernel weights, wrapped for a circular convolution of
+    length 2N (zero-padded), and edge weights, cached per (N, du)
+    """
+    key = (N,round(du,12))
+    if key not in _kernel_cache:
+        if (len(_kernel_cache) > 16): _kernel_cache.clear()
+        kernel_ft = np.fft.rfft(np.fft.ifftshift(_force_kernel_weights(N,du)))
+        _kernel_cache[key] = (kernel_ft,) + _edge_weights(N,du)
+    return _kernel_cache[key]
+
+
+def logconvolution_selfgravity_omega_sq(rvals,sigma,G=1.0):
+    """
+    Squared angular frequency in the plane of a razor-thin disk due to
+    its own gravity, computed as a convolution of the surface density
+    with the force kernel in ln R (Kalnajs 1971). The surface density is
+    taken as piecewise linear in ln R and the convolution is carried out
+    with zero-padded FFTs, so the cost is O(N log N). The kernel transform
+    is cached, so repeated calls on the same grid only transform the
+    surface density.
+
+    Parameters
+    ----------
+    rvals, sigma : array_like
+    surface density table; the disk is truncated at the table limits.
+    Grids that are not uniform in ln R are interpolated onto one with the
+    same number of points
+    G : float, optional
+    gravitational constant
+
+    Returns
+    -------
+    omega_sq : ndarray
+    self-gravity contribution to Omega^2 at `rvals`
+    """
+    rvals, sigma = np.asarray(rvals,dtype=float), np.asarray(sigma,dtype=float)
+    N = rvals.shape[0]
+    lnR = np.log(rvals)
+    du = (lnR[-1] - lnR[0])/(N - 1)
+    uniform = np.allclose(np.diff(lnR),du,rtol=1.0e-6,atol=0)
+    if uniform:
+        lngrid = lnR
+    else:
+        lngrid = np.linspace(lnR[0],lnR[-1],N)
+        sigma = np.interp(lngrid,lnR,sigma)
+
+    kernel_ft, lower, upper = _force_kernel_transform(N,du)
+    force = np.fft.irfft(np.fft.rfft(sigma,2 * N) * kernel_ft,2 * N)[:N]
+    force -= sigma[0] * lower + sigma[-1] * upper
+    omega_sq = G * force / np.exp(lngrid)
+
+    if not uniform:
+        omega_sq = np.interp(lnR,lngrid,omega_sq)
+    return omega_sq
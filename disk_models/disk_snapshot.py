@@ -16,6 +16,7 @@ import scipy.integrate as integ
 
 from .disk_parameter_files import *
 from .disk_particles import *
+from .disk_other_functions import PointBins
 
 
 STAR_PARTTYPE = 4
@@ -88,9 +89,6 @@ class snapshot():
 
     def obtain_parameters(self, disk, disk_mesh,R,phi,z,dens,press):
     
-        # Obtain target masses and allowed volumes
-        self.params.reference_gas_part_mass = disk.compute_disk_mass(disk_mesh.Rin,disk_mesh.Rout)/disk_mesh.Ncells
-
         ff = 1.0
         ind = (R < ff * 1.2 * disk_mesh.Rout) & ((R > disk_mesh.Rout))
         while (R[ind].shape[0] < 10):
@@ -99,13 +97,24 @@ class snapshot():
             
         self.params.max_volume = 4.0/3*np.pi * disk_mesh.Rout**3 * (1.2**3-1.0)/ R[ind].shape[0]
         ind = (R > disk_mesh.Rin) & ((R < disk_mesh.Rout))
-        self.params.max_volume = self.params.reference_gas_part_mass/dens[ind].min()
-        self.params.min_volume = self.params.reference_gas_part_mass/dens[ind].max()
 
         # Obtain the temperature balance far from the disk
+        press_background, dens_background = None, None
         if (disk.__class__.__name__ == 'disk3d'):
             press_background = press[dens == dens[R >= disk_mesh.Rout].min()].mean()
             dens_background = dens[dens == dens[R >= disk_mesh.Rout].min()].mean()
+
+        self.set_parameters(disk,disk_mesh,dens[ind].min(),dens[ind].max(),dens_background,press_background)
+
+    def set_parameters(self,disk,disk_mesh,dens_min,dens_max,dens_background=None,press_background=None):
+
+        # Obtain target masses and allowed volumes
+        self.params.reference_gas_part_mass = disk.compute_disk_mass(disk_mesh.Rin,disk_mesh.Rout)/disk_mesh.Ncells
+        self.params.max_volume = self.params.reference_gas_part_mass/dens_min
+        self.params.min_volume = self.params.reference_gas_part_mass/dens_max
+
+        # Obtain the temperature balance far from the disk
+        if (dens_background is not None):
             self.params.limit_u_below_this_density = dens_background
             self.params.limit_u_below_this_density_to_this_value = press_background / (disk.adiabatic_gamma - 1.0) / dens_background 
         
@@ -398,6 +407,97 @@ class snapshot():
 
         ws.closefile(f)
         
+    def write_snapshot_streaming(self,disk,disk_mesh,filename="./disk.dat.hdf5",time=0,
+                                 chunk_size=1000000,seed=42):
+        """
+        Create the snapshot of a 3D disk and write it to `filename` chunk by
+        chunk, for initial conditions too large to be held in memory.
+
+        The mesh-generating points are produced by disk_mesh.create_chunks;
+        the primitive variables of each chunk are assigned and written into
+        pre-sized datasets of the file, so that only the arrays of one chunk
+        are held at a time. The parameters of obtain_parameters are derived
+        from running extrema over the chunks. The gas arrays of the snapshot
+        are left empty.
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+        largest number of cells per chunk
+        seed : int, optional
+        seed of the random streams of the chunks of mc meshes
+        """
+        if (disk.__class__.__name__ != 'disk3d'):
+            print("ERROR: streaming snapshots are only available for disk3d models.")
+            exit()
+
+        self.BoxSize = disk_mesh.BoxSize
+        Ngas, Rmin, chunks = disk_mesh.create_chunks(disk,chunk_size=chunk_size,seed=seed)
+        setup = primitive_variables_3d_setup(disk,disk_mesh,Rmin)
+
+        if (disk.central_particle):
+            central_particle = particle_data()
+            central_particle.add_particle(x = (0.5 * self.BoxSize), y = (0.5 * self.BoxSize),
+                                          z = (0.5 * self.BoxSize), vx=0, vy=0, vz=0,
+                                          m = disk.Mcentral, ID=(Ngas+1))
+            self.load_particles(central_particle)
+        Nparticle = 1 if (disk.central_particle) else 0
+
+        f=ws.openfile(filename)
+        npart=np.array([Ngas,0,0,0,0,0], dtype="uint32")
+        npart[STAR_PARTTYPE] = Nparticle
+        massarr=np.array([0,0,0,0,0,0], dtype="float64")
+        header=ws.snapshot_header(npart=npart, nall=npart, massarr=massarr, time=time,
+                              boxsize=self.BoxSize, double = np.array([1], dtype="int32"))
+        ws.writeheader(f, header)
+        blocks = ["POS ","VEL ","RHO ","U   ","ID  "]
+        for block in blocks:
+            ws.create_block(f, block, 0, Ngas, dtype="int64" if (block == "ID  ") else "float64")
+
+        # running extrema for the parameter file and the enclosed mass check
+        radial_bins = disk.evaluate_radial_mass_bins(disk_mesh.Rin,disk_mesh.Rout,200)
+        counts, Rsum, zmax = np.zeros(radial_bins.shape[0] + 1,dtype=int), \
+                             np.zeros(radial_bins.shape[0] + 1), np.full(radial_bins.shape[0] + 1,-np.inf)
+        dens_min, dens_max = np.inf, -np.inf
+        dens_background, press_sum, dens_sum, Nbackground = np.inf, 0.0, 0.0, 0
+
+        offset = 0
+        for R, phi, z in chunks:
+            ids = np.arange(offset+1,offset+R.shape[0]+1,1)
+            dens, vphi, vr, press = primitive_variables_3d_chunk(disk,disk_mesh,R,phi,z,ids,setup)
+            self.load(R,phi,z,dens,None,vphi,vr,press,ids,dims=3,adiabatic_gamma=disk.adiabatic_gamma)
+            for block, data in zip(blocks,[self.gas.pos,self.gas.vel,self.gas.dens,self.gas.utherm,self.gas.ids]):
+                ws.write_block_slice(f, block, 0, data, offset)
+
+            bins = PointBins(R,radial_bins)
+            counts, Rsum, zmax = counts + bins.counts, Rsum + bins.sum(R), np.maximum(zmax,bins.max(z))
+            ind = (R > disk_mesh.Rin) & (R < disk_mesh.Rout)
+            if ind.any():
+                dens_min, dens_max = min(dens_min,dens[ind].min()), max(dens_max,dens[ind].max())
+            ind = R >= disk_mesh.Rout
+            if ind.any() and (dens[ind].min() <= dens_background):
+                if (dens[ind].min() < dens_background):
+                    dens_background, press_sum, dens_sum, Nbackground = dens[ind].min(), 0.0, 0.0, 0
+                ind = dens == dens_background
+                press_sum, dens_sum, Nbackground = press_sum + press[ind].sum(), dens_sum + dens[ind].sum(), \
+                                                   Nbackground + np.count_nonzero(ind)
+            offset += R.shape[0]
+            print("....written %i of %i cells" % (offset,Ngas))
+
+        if (Nparticle > 0):
+            ws.write_block(f, "POS ", STAR_PARTTYPE, self.particle.pos)
+            ws.write_block(f, "VEL ", STAR_PARTTYPE, self.particle.vel)
+            ws.write_block(f, "MASS", STAR_PARTTYPE, self.particle.mass)
+            ws.write_block(f, "ID  ", STAR_PARTTYPE, self.particle.ids)
+        ws.closefile(f)
+        self.gas = gas_data()
+
+        report_enclosed_vertical_mass(setup,radial_bins,counts,Rsum,zmax)
+        if (Nbackground > 0):
+            self.set_parameters(disk,disk_mesh,dens_min,dens_max,dens_sum/Nbackground,press_sum/Nbackground)
+        else:
+            self.set_parameters(disk,disk_mesh,dens_min,dens_max)
+
     def write_parameter_file(self,disk,disk_mesh,filename="./param.txt",time=0):
         self.params.write(filename)
         
@@ -412,11 +512,12 @@ def assign_primitive_variables_2d(disk,disk_mesh):
         R,phi = disk_mesh.create(disk=disk)
         
         R1,R2 = 0.99*R.min(),1.01*R.max()
-        radii, density = disk.evaluate_sigma(R1,R2)
+        profiles = disk.profile_table(R1,R2)
+        radii, density = profiles.rvals, profiles['sigma']
 
-        _, angular_frequency = disk.evaluate_rotation_curve(R1,R2)
-        _, radial_velocity = disk.evaluate_radial_velocity(R1,R2)
-        _, pressure = disk.evaluate_pressure(R1,R2)
+        angular_frequency = profiles['rotation_curve']
+        radial_velocity = profiles['radial_velocity']
+        pressure = profiles['pressure']
         
         dens_profile = interp1d(radii,density,kind='linear')
         vphi_profile = interp1d(radii,angular_frequency*radii,kind='linear')
@@ -500,113 +601,58 @@ def assign_primitive_variables_2d(disk,disk_mesh):
 def assign_primitive_variables_3d(disk,disk_mesh):
 
     R, phi, z = disk_mesh.create(disk=disk)
+    ids = np.arange(1,R.shape[0]+1,1)
 
+    setup = primitive_variables_3d_setup(disk,disk_mesh,R.min())
+    dens, vphi, vr, press = primitive_variables_3d_chunk(disk,disk_mesh,R,phi,z,ids,setup)
 
-    x = R*np.cos(phi)
-    y = R*np.sin(phi)
-    points = np.array([x,y,z]).T
-    #vor = Voronoi(points)
-        
-    R1,R2 = min(1e-4,0.9*R.min()),1.5*disk_mesh.Rout
-    #obtain density of cells
-    dens, radii, midplane_dens = disk.solve_vertical_structure(R,phi,z,R1,R2,disk_mesh.Ncells)
-    dens_cut = max(midplane_dens[-1],midplane_dens[midplane_dens > 0].min())/100
-    if (midplane_dens[0] < dens_cut): dens_cut /= 1000
-
-
-    #radii = np.append(radii,R2)
-    #midplane_dens = np.append(midplane_dens,dens_cut)
-    dens[dens < dens_cut] = dens_cut
-    #midplane_dens[midplane_dens < dens_cut] = dens_cut
-    print("Density cutoff is:", dens_cut)
-    #window_length = 20
-    #weights = np.exp(np.linspace(-1., 0., window_length))
-    #midplane_dens = np.convolve(midplane_dens,weights/np.sum(weights),mode='same')
-    logdens0_profile =  interp1d(radii,np.log(midplane_dens),kind='linear',fill_value=np.log(dens_cut),bounds_error=False)
+    # Checking enclosed mass
+    radial_bins = disk.evaluate_radial_mass_bins(disk_mesh.Rin,disk_mesh.Rout,200)
+    bins = PointBins(R,radial_bins)
+    report_enclosed_vertical_mass(setup,radial_bins,bins.counts,bins.sum(R),bins.max(z))
 
+    print("Done.")
     
+    return R,phi,z,dens,vphi,vr,press,ids
 
-    #evaluate other quantities
-    Nvals = 1200 # this number being large can be critical when steep pressure gradients are present
 
-    if (disk_mesh.NR is not None):
-        Nvals = disk_mesh.NR        
-        scale = 'log'
-        R1, R2 = disk_mesh.Rin,disk_mesh.Rout
-    else:
-        Nvals = 1200
-        scale = 'log'
-        R1,R2 = 0.99*R.min(),disk_mesh.Rout
+def primitive_variables_3d_setup(disk,disk_mesh,Rmin):
+    """
+    Quantities shared by all the cells of a 3D disk: the radial range of
+    the density evaluation, the density cutoff and the vertical structure
+    table, for a mesh whose smallest radius is Rmin
+    """
+    R1,R2 = min(1e-4,0.9*Rmin),1.5*disk_mesh.Rout
+    radii, midplane_dens = disk.midplane_density_profile(R1,R2)
+    dens_cut = max(midplane_dens[-1],midplane_dens[midplane_dens > 0].min())/100
+    if (midplane_dens[0] < dens_cut): dens_cut /= 1000
+    print("Density cutoff is:", dens_cut)
 
-    
-    try_count = 0
-    Nvals = 200
+    # rotation velocity balancing gravity and the radial pressure gradient
+    # at each height, read from the vertical structure table
+    table = disk.vertical_structure_table(disk_mesh.Rin,disk_mesh.Rout)
+    return {'R1':R1,'R2':R2,'dens_cut':dens_cut,'table':table}
 
-    spinner = itertools.cycle(['-', '/', '|', '\\'])
 
-    while (True):
-        sys.stdout.write(spinner.next()) 
-        sys.stdout.flush()               
-        sys.stdout.write('\b')    
-        
-        radii, angular_frequency_sq = disk.evaluate_angular_freq_gravity(R1,R2,Nvals=Nvals,
-                                                                         scale=scale)
-
-        _, sound_speed = disk.evaluate_soundspeed(R1,R2,Nvals=Nvals,scale=scale)
-        pressure_midplane = np.exp(logdens0_profile(radii)) * sound_speed**2
-
-        _,pressure_midplane_gradient =  disk.evaluate_radial_gradient(pressure_midplane,R1,R2,Nvals=Nvals,
-                                                                      scale=scale)
-        _,soundspeed_sq_gradient =  disk.evaluate_radial_gradient(sound_speed**2,R1,R2,Nvals=Nvals,
-                                                                  scale=scale)
-
-        pressure_buffer = sound_speed**2 * disk.evaluate_radial_gradient(logdens0_profile(radii),R1,R2,Nvals=Nvals, scale=scale)[1] / radii + soundspeed_sq_gradient / radii
-        print(pressure_buffer)
-        omega_sq = (angular_frequency_sq + pressure_buffer)
-        print(R1,R2,disk_mesh.Rin,disk_mesh.Rout)
-        plt.plot(radii,angular_frequency_sq,color='b')
-        plt.plot(radii,pressure_midplane_gradient/np.exp(logdens0_profile(radii))/radii,color='r')
-        plt.plot(radii,pressure_buffer,'g+')
-        plt.plot(radii,omega_sq,color='orange')
-        plt.plot(radii,(0.5*soundspeed_sq_gradient+sound_speed**2*(disk.evaluate_radial_gradient(np.log(disk.sigma_vals(radii)),R1,R2,Nvals=Nvals, scale=scale)[1]-1.5/radii))/radii,color='magenta')
-        #plt.plot(radii,omega)
-        #plt.plot(radii,np.exp(logdens0_profile(radii)),color='purple',marker='+')
-        #plt.plot(radii,
-        #         disk.evaluate_sigma(R1,R2,Nvals=Nvals,scale=scale)[1]/np.sqrt(2*np.pi)/sound_speed*np.sqrt(angular_frequency_sq),\
-        #         color='orange')
-        plt.xscale('log')
-        #plt.yscale('log')
-        plt.show()
-        if np.all(omega_sq > 0):
-            break
-        else:
-            R1,R2 = 1.0001 * R1, 0.999 * R2
-            Nvals = int(0.999 * (Nvals-1))
-        if (Nvals < 100):
-            print("Error: Disk TOO THICK or number of cells TOO LOW to capture rotation curve accurately. Try again")
-            exit()
-        try_count+=1
+def primitive_variables_3d_chunk(disk,disk_mesh,R,phi,z,ids,setup):
+    """
+    Density, velocities and pressure of a set of cells of a 3D disk, with
+    the shared quantities of primitive_variables_3d_setup
+    """
+    R1, R2, dens_cut, table = setup['R1'], setup['R2'], setup['dens_cut'], setup['table']
 
-        if (try_count > 30):
-            plt.show()
-            print("We are stuck trying to fix a rotation curve that can turn negative due to steep pressure gradients. Try new profile or more cells.")
-        
-            
-    angular_frequency_midplane = np.sqrt(angular_frequency_sq + pressure_buffer)
-            
-    #update mesh radial limits
-    disk_mesh.Rin, disk_mesh.Rout = radii.min(),radii.max()
-        
-    #interpolate mid-plane quantities
-    vphi_profile = interp1d(radii,angular_frequency_midplane*radii,kind='linear')
-    soundspeedsq_profile = interp1d(radii,sound_speed**2,kind='linear')
-    soundspeedsq_gradient_profile = interp1d(radii,soundspeed_sq_gradient,kind='linear')
+    #obtain density of cells
+    dens, _, _ = disk.solve_vertical_structure(R,phi,z,R1,R2,disk_mesh.Ncells)
+    dens[dens < dens_cut] = dens_cut
 
     # primitive variables inside the disk
     ind_in = (R > disk_mesh.Rin) & (R < disk_mesh.Rout) & (np.abs(z) < 1.5 * disk_mesh.zmax)
     vphi, press = np.zeros(R.shape),np.zeros(R.shape)
-    vphi[ind_in] = np.sqrt(vphi_profile(R[ind_in])**2 -  R[ind_in] * soundspeedsq_gradient_profile(R[ind_in]) * np.log(dens[ind_in]/dens0_profile(R[ind_in])))
-    press[ind_in] = dens[ind_in] * soundspeedsq_profile(R[ind_in])
+    vphi[ind_in] = table.rotation_velocity(R[ind_in],z[ind_in])
+    press[ind_in] = dens[ind_in] * table.soundspeed_sq(R[ind_in],z[ind_in])
+    Nunbound = np.count_nonzero(vphi[ind_in] == 0)
+    if (Nunbound > 0):
+        print("[warning] pressure support exceeds gravity in %i cells, their rotation is set to zero" % Nunbound)
 
     # behavior outside the disk
     ind_out = ((R >= disk_mesh.Rout) & (ids != -2 ))| (np.abs(z) >= 1.5 * disk_mesh.zmax) | (R <= disk_mesh.Rin) 
@@ -625,22 +671,17 @@ def assign_primitive_variables_3d(disk,disk_mesh):
     press[ind] = press_cut
     vphi[ind] = 0.0
     
-    
     vr = np.zeros(R.shape)
-    ids = np.arange(1,R.shape[0]+1,1)
 
-    plt.plot(R,vphi,'b.')
-    plt.show()
-    
-    # Checking enclosed mass
-    radial_bins = disk.evaluate_radial_mass_bins(disk_mesh.Rin,disk_mesh.Rout,200)
-    bin_inds=np.digitize(R,radial_bins)
-    for kk in range(0,radial_bins.shape[0]):
-        if (R[bin_inds == kk].shape[0] == 0): continue
-        bin_radius = R[bin_inds == kk].mean()
-        _, zmvals = disk.evaluate_enclosed_vertical(bin_radius,0,z[bin_inds == kk].max(),Nzvals=300)
-    
-    print("Done.")
-    
-    return R,phi,z,dens,vphi,vr,press,ids
+    return dens, vphi, vr, press
+
 
+def report_enclosed_vertical_mass(setup,radial_bins,counts,Rsum,zmax):
+    """
+    Print the smallest fraction of the vertical mass of the disk within
+    the highest cell of a radial bin, given the number of cells, the sum of
+    their radii and their largest height in each bin of radial_bins
+    """
+    filled = np.where(counts[:radial_bins.shape[0]] > 0)[0]
+    enclosed = setup['table'].vertical_mass_fraction(Rsum[filled]/counts[filled],np.maximum(zmax[filled],0))
+    print("Smallest fraction of the vertical mass within the sampled heights: %.4f" % enclosed.min())
@@ -226,7 +226,43 @@ def g4(R,h):
                 
     return fac/3
 
-    
+
+def piecewise_power_log_slopes(u,pieces):
+    """
+    First and second logarithmic derivatives, dlnf/dlnu and d2lnf/dlnu2,
+    of a function defined piecewise as a sum of powers sum_n c_n u^n.
+
+    Parameters
+    ----------
+    u : array_like
+    positive values of the argument
+    pieces : list of (u_max, {n: c_n})
+    the pieces in increasing order of u_max, each valid up to u_max
+
+    Returns
+    -------
+    slope, curvature : ndarray
+    """
+    u = np.asarray(u,dtype=float)
+    slope, curvature = np.zeros(u.shape), np.zeros(u.shape)
+    u_min = 0.0
+    for u_max, coeffs in pieces:
+        ind = (u >= u_min) & (u < u_max)
+        f = sum(c * u[ind]**n for n, c in coeffs.items())
+        d1 = sum(n * c * u[ind]**n for n, c in coeffs.items())
+        d2 = sum(n * n * c * u[ind]**n for n, c in coeffs.items())
+        slope[ind] = d1 / f
+        curvature[ind] = d2 / f - (d1 / f)**2
+        u_min = u_max
+    return slope, curvature
+
+
+def dlng3_dlnR(R,h):
+    return piecewise_power_log_slopes(R / h,[(0.5,{-1: -96.0}),
+                                             (1.0,{-1: 32.0, -7: 1.0, -3: -48.0}),
+                                             (np.inf,{-7: -15.0})])[0]
+
+
 if __name__ == '__main__':
 
     r = np.linspace(0.001,2.0,100)
@@ -8,19 +8,34 @@ from math import factorial
 from .disk_density_profiles import *
 from .disk_external_potentials import *
 from .disk_other_functions import *
+from .disk_cache import LRUCache, parameter_fingerprint, array_fingerprint
+from .disk_radial_profiles import RadialProfileTable, adaptive_radial_zones
+from .disk_self_gravity import logconvolution_selfgravity_omega_sq
 from .disk_snapshot import *
+from .disk_mesh_relaxation import lloyd_relaxation, mass_sampler, remove_close_points
+from .disk_background_mesh import graded_box_fill
 
 
 def soundspeed(R,csnd0,l,R0):
     return csnd0 * (R/R0)**(-l*0.5)
 
+def dlnsoundspeed_dlnR(R,l):
+    return -0.5 * l * np.ones(np.shape(R))
+
 
 class disk2d(object):
+
+    # settings that do not change the model, left out of its fingerprint
+    _fingerprint_exclude = ('sigma_function_vectorized',)
+
     def __init__(self, *args, **kwargs):
+        self._profile_cache = LRUCache(maxsize=32)
+
         #define the properties of the axi-symmetric disk model
         self.sigma_type = kwargs.get("sigma_type")
         self.sigma_disk =  None
         self.sigma_function =  kwargs.get("sigma_function")
+        self.sigma_function_vectorized = kwargs.get("sigma_function_vectorized")
         self.sigma_cut = kwargs.get("sigma_cut")
         self.sigma_back = kwargs.get("sigma_back")
         self.sigma_floor = kwargs.get("sigma_floor")
@@ -112,6 +127,11 @@ class disk2d(object):
             if (self.csndR0 is None):
                 self.csndR0 = self.sigma_disk.Rc
 
+        if (self.sigma_type == "tabulated"):
+            self.sigma_disk = tabulated_disk(**kwargs)
+            if (self.csndR0 is None):
+                self.csndR0 = self.sigma_disk.R0
+
                 
         if (self.sigma_type is None):
             if (self.sigma_function is not None):
@@ -162,180 +182,218 @@ class disk2d(object):
 
     def sigma_vals(self,rvals):
         if (self.sigma_function is not None) & callable(self.sigma_function):
-            sigma = np.vectorize(self.sigma_function)(rvals)
+            sigma, self.sigma_function_vectorized = evaluate_callable(self.sigma_function,rvals,
+                                                                      self.sigma_function_vectorized)
         else:
             sigma = self.sigma_disk.evaluate(rvals)
 
         return sigma
             
-    def evaluate_sigma(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        sigma = self.sigma_vals(rvals)
-        if (self.add_gap):
-            sigma = sigma * gap_profile(rvals,self.gap_center,self.gap_width,self.gap_depth,self.gap_steep)
-        try:
-            sigma[sigma < self.sigma_floor] = self.sigma_floor
-        except TypeError:
-            None
-        return rvals,sigma
+    @property
+    def fingerprint(self):
+        """
+        Hash of the disk parameters, changes whenever any of them changes;
+        None if they cannot be hashed reliably, and then nothing is cached.
+        """
+        return parameter_fingerprint(self)
+
+    def clear_cache(self):
+        self._profile_cache.clear()
+
+    def profile_table(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        """
+        Radial profiles of the disk on one grid, each evaluated at most once.
+        Tables are kept in a least-recently-used cache keyed by the parameter
+        fingerprint and the grid, so repeated evaluations are free.
+        """
+        fingerprint = self.fingerprint
+        if (fingerprint is None): return RadialProfileTable(self,Rin,Rout,Nvals,scale,radii_list)
+        key = (fingerprint,Rin,Rout,Nvals,scale,array_fingerprint(radii_list))
+        table = self._profile_cache.get(key)
+        if (table is None) or (table.fingerprint != fingerprint):
+            table = RadialProfileTable(self,Rin,Rout,Nvals,scale,radii_list)
+            self._profile_cache.put(key,table)
+        return table
+
+    def evaluate_sigma(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('sigma')
     
-    def evaluate_soundspeed(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        return rvals,soundspeed(rvals,self.csnd0,self.l,self.csndR0)
-
-    def evaluate_pressure(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals,sigma = self.evaluate_sigma(Rin,Rout,Nvals,scale=scale)
-        return rvals, sigma**(self.effective_gamma) * \
-            self.evaluate_soundspeed(Rin,Rout,Nvals,scale=scale)[1]**2
-
-    def evaluate_viscosity(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals,csnd =  self.evaluate_soundspeed(Rin,Rout,Nvals,scale=scale)
-        Omega_sq = self.Mcentral/rvals**3 #* (1 + 3 * self.quadrupole_correction/rvals**2)
-        nu = self.alphacoeff * csnd * csnd / np.sqrt(Omega_sq)
-        return rvals, nu
+    def evaluate_soundspeed(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('soundspeed')
+
+    def evaluate_pressure(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('pressure')
+
+    def evaluate_viscosity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('viscosity')
     
-    def evaluate_pressure_gradient(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals, press = self.evaluate_pressure(Rin,Rout,Nvals,scale=scale)
-        _, dPdR = self.evaluate_radial_gradient(press,Rin,Rout,Nvals,scale=scale)
-        return rvals,dPdR
-
-    def evaluate_angular_freq_self_gravity(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals, mvals = self.evaluate_enclosed_mass(Rin,Rout,Nvals=2000)
-        _ ,sigma = self.evaluate_sigma(Rin,Rout,Nvals,scale=scale)
-        '''
-        # First guess at the squared angular velocity
-        vcircsquared_0 = mvals/rvals
-        delta_vcirc,delta_vcirc_old  = 0.0, 1.0e20
-        k1 = 1
-        x , y = np.meshgrid(rvals,rvals)/Rout
-        x[x < y] = 0 # only upper component of the matrix
-        while(True):
-            integrand1 = sigma[:,None] * x**(2.0*k1+1)
-            integrand2 = sigma[:,None] / x**(2.0*k1)
-            alpha_k1 = np.pi * (factorial(2*k1)/2.0**(2*k1)/factorial(k1)**2)**2
-                
-            integral1 = trapz(integrand1,x=xx)
-            integral2 = trapz(integrand2,radius/R_disk,1.0)
-                
-                delta_vcirc+=2.0 * alpha_k1 * G * R_disk *((2*k1+1.0)/(radius/R_disk)**(2*k1+1)* integral1 - 2.0*k1 *(radius/R_disk)**(2*k1) *integral2)
-              
-                if (k1 > 30):  break
-                abstol,reltol = 1.0e-6,1.0e-5
-                abserr,relerr = np.abs(delta_vcirc_old-delta_vcirc),np.abs(delta_vcirc_old-delta_vcirc)/np.abs(delta_vcirc_old+vcircsquared_0)
-                if (np.abs(delta_vcirc) > abstol/reltol):
-                    if (abserr < abstol): break
-                else:
-                    if (relerr < reltol): break
-                    
-                delta_vcirc_old = delta_vcirc
-                k1 = k1 + 1
-     
-            selfgravity_vcirc_in_plane = np.append(selfgravity_vcirc_in_plane,vcircsquared_0+delta_vcirc)
-        '''
-        return rvals, None
+    def evaluate_pressure_gradient(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('pressure_gradient')
 
-    def evaluate_angular_freq_central_gravity(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        if (self.Mcentral_soft > 0):
-            if (self.softening_type == 'spline'):
-                Omega_sq = self.Mcentral * SplineDerivative(rvals,self.Mcentral_soft*2.8) * (1 + 3 * self.quadrupole_correction/rvals**2)
-            elif (self.softening_type == 'plummer'):
-                Omega_sq = self.Mcentral / (rvals**2 + self.Mcentral_soft**2)**1.5 * (1 + 3 * self.quadrupole_correction/rvals**2)
-        else:
-            Omega_sq = self.Mcentral / rvals**3 * (1 + 3 * self.quadrupole_correction/rvals**2)
-            
-        return rvals, Omega_sq
+    def evaluate_angular_freq_self_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_self_gravity')
+
+    def evaluate_angular_freq_central_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_central')
     
-    def evaluate_angular_freq_external_gravity(self,Rin,Rout,Nvals=1000,scale='log'):
-        return self.evaluate_angular_freq_central_gravity(Rin,Rout,Nvals,scale)
+    def evaluate_angular_freq_external_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_external')
     
     
-    def evaluate_angular_freq_gravity(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals, Omega_sq = self.evaluate_angular_freq_external_gravity(Rin,Rout,Nvals,scale)
-        if (self.self_gravity):
-            _, Omega_sq_sg = self.evaluate_angular_freq_self_gravity(Rin,Rout,Nvals,scale)
-            Omega_sq += Omega_sq_sg
-
-        return rvals, Omega_sq 
+    def evaluate_angular_freq_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_gravity')
 
     
-    def evaluate_rotation_curve(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals, Omega_sq  = self.evaluate_angular_freq_gravity(Rin,Rout,Nvals,scale)
-        
-        #rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        #Omega_sq = self.Mcentral/rvals**3 * (1 + 3 * self.quadrupole_correction/rvals**2)
-        #if (self.self_gravity):
-        #    _, Omega_sq_sg = self.evaluate_angular_freq_self_gravity(Rin,Rout,Nvals,scale)
-        #    Omega_sq += Omega_sq_sg 
-            
-        return rvals, np.sqrt(Omega_sq + self.evaluate_pressure_gradient(Rin,Rout,Nvals,scale=scale)[1] / \
-            self.evaluate_sigma(Rin,Rout,Nvals,scale=scale)[1]/ rvals)
-
-    def evaluate_radial_velocity(self,Rin,Rout,Nvals=1000,scale='log'):
-        if (self.constant_accretion):
-            rvals,sigma = self.evaluate_sigma(Rin,Rout,Nvals,scale=scale)
-            rvel = -self.constant_accretion / 2.0 / np.pi / rvals / sigma
-            # correct for extremely high values
-            rvel[rvals < 3 * Rin] *= np.exp(-(2*Rin/rvals[rvals < 3 * Rin])**6)
-            return rvals, rvel
-        else:
-            return self.evaluate_radial_velocity_viscous(Rin,Rout,Nvals,scale=scale)
+    def evaluate_rotation_curve(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('rotation_curve')
 
-    def evaluate_radial_velocity_viscous(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        Omega = np.sqrt(self.Mcentral/rvals**3 * (1 + 3 * self.quadrupole_correction/rvals**2))
-        sigma = (self.evaluate_sigma(Rin,Rout,Nvals,scale)[1])
-        _, dOmegadR = self.evaluate_radial_gradient(Omega,Rin,Rout,Nvals,scale=scale)
-        
-        func1 = (self.evaluate_viscosity(Rin,Rout,Nvals,scale)[1])*\
-            (self.evaluate_sigma(Rin,Rout,Nvals,scale)[1])*\
-            rvals**3*dOmegadR
-        _, dfunc1dR = self.evaluate_radial_gradient(func1,Rin,Rout,Nvals,scale=scale)
-        func2 = rvals**2 * Omega
-        _, dfunc2dR = self.evaluate_radial_gradient(func2,Rin,Rout,Nvals,scale=scale)
-
-        velr = dfunc1dR / rvals / sigma / dfunc2dR
-        if (self.sigma_floor is not None):
-            velr[sigma <= self.sigma_floor] = 0
+    def evaluate_radial_velocity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('radial_velocity')
 
-
-        return rvals,velr
+    def evaluate_radial_velocity_viscous(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('radial_velocity_viscous')
 
         
-    def evaluate_radial_gradient(self,quantity,Rin,Rout,Nvals=1000,scale='log'):
-        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        if (scale == 'log'):
+    def evaluate_radial_gradient(self,quantity,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
+        if (scale == 'log') | (scale == 'adaptive'):
             dQdlogR = np.gradient(quantity)/np.gradient(np.log10(rvals))
             dQdR = dQdlogR/rvals/np.log(10)
         elif (scale == 'linear'):
             dQdR = np.gradient(quantity)/np.gradient(rvals)
         return rvals,dQdR
 
-    def evaluate_radial_zones(self,Rin,Rout,Nvals=1000,scale='log'):
+    def evaluate_radial_zones(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        if (radii_list is not None):
+            return radii_list
+        
         if (scale == 'log'):
             rvals = np.logspace(np.log10(Rin),np.log10(Rout),Nvals)
         elif (scale == 'linear'):
             rvals = np.linspace(Rin,Rout,Nvals)
+        elif (scale == 'adaptive'):
+            rvals = adaptive_radial_zones(self,Rin,Rout,Nmax=Nvals)
         else: 
             print("[error] scale type ", scale, "not known!")
             sys.exit()
         return rvals
 
-    def evaluate_enclosed_mass(self,Rin,Rout,Nvals=1000,scale='log'):
-        rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale)
-        def mass_integrand(R):
-            sigma = self.sigma_vals(R)
-            if (self.sigma_floor is not None):
-                if (sigma < self.sigma_floor) : sigma = self.sigma_floor
-            return sigma * R * 2 * np.pi
-        mass = [quad(mass_integrand,0.0,R)[0] for R in rvals]
-        return rvals, mass
+    def evaluate_enclosed_mass(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+        return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('enclosed_mass')
 
     
     def compute_disk_mass(self,Rin,Rout):
         __, mass =  self.evaluate_enclosed_mass(Rin,Rout,Nvals=2)
         return mass[1]
 
+    # Radial profiles, computed once per RadialProfileTable
+    def _profile_sigma(self,table):
+        rvals = table.rvals
+        sigma = self.sigma_vals(rvals)
+        if (self.add_gap):
+            sigma = sigma * gap_profile(rvals,self.gap_center,self.gap_width,self.gap_depth,self.gap_steep)
+        try:
+            sigma[sigma < self.sigma_floor] = self.sigma_floor
+        except TypeError:
+            None
+        return sigma
+
+    def _profile_soundspeed(self,table):
+        return soundspeed(table.rvals,self.csnd0,self.l,self.csndR0)
+
+    def _profile_pressure(self,table):
+        return table['sigma']**(self.effective_gamma) * table['soundspeed']**2
+
+    def _profile_viscosity(self,table):
+        Omega_sq = self.Mcentral/table.rvals**3 #* (1 + 3 * self.quadrupole_correction/rvals**2)
+        return self.alphacoeff * table['soundspeed']**2 / np.sqrt(Omega_sq)
+
+    def _profile_dlnsigma_dlnR(self,table):
+        if (self.sigma_function is None) & (not self.add_gap):
+            slope = self.sigma_disk.dlnsigma_dlnR(table.rvals)
+        else:
+            slope = table.gradient(np.log(table['sigma'])) * table.rvals
+        if (self.sigma_floor is not None):
+            slope = np.where(table['sigma'] > self.sigma_floor,slope,0.0)
+        return slope
+
+    def _profile_dlnsoundspeed_dlnR(self,table):
+        return dlnsoundspeed_dlnR(table.rvals,self.l)
+
+    def _profile_pressure_gradient(self,table):
+        # P = sigma^gamma_eff cs^2, differentiated analytically
+        return table['pressure'] / table.rvals * (self.effective_gamma * table['dlnsigma_dlnR'] +
+                                                  2 * table['dlnsoundspeed_dlnR'])
+
+    def _profile_omega_sq_self_gravity(self,table):
+        # convolution of sigma with the razor-thin disk kernel in ln R (G = 1)
+        return logconvolution_selfgravity_omega_sq(table.rvals,table['sigma'])
+
+    def _profile_omega_sq_central(self,table):
+        rvals = table.rvals
+        if (self.Mcentral_soft > 0):
+            if (self.softening_type == 'spline'):
+                Omega_sq = self.Mcentral * SplineDerivative(rvals,self.Mcentral_soft*2.8) * (1 + 3 * self.quadrupole_correction/rvals**2)
+            elif (self.softening_type == 'plummer'):
+                Omega_sq = self.Mcentral / (rvals**2 + self.Mcentral_soft**2)**1.5 * (1 + 3 * self.quadrupole_correction/rvals**2)
+        else:
+            Omega_sq = self.Mcentral / rvals**3 * (1 + 3 * self.quadrupole_correction/rvals**2)
+            
+        return Omega_sq
+
+    def _profile_omega_sq_external(self,table):
+        return table['omega_sq_central']
+
+    def _profile_omega_sq_gravity(self,table):
+        Omega_sq = table['omega_sq_external']
+        if (self.self_gravity):
+            Omega_sq = Omega_sq + table['omega_sq_self_gravity']
+        return Omega_sq
+
+    def _profile_omega_sq_rotation(self,table):
+        return table['omega_sq_gravity'] + table['pressure_gradient'] / table['sigma'] / table.rvals
+
+    def _profile_rotation_curve(self,table):
+        return np.sqrt(table['omega_sq_rotation'])
+
+    def _profile_radial_velocity(self,table):
+        if (self.constant_accretion):
+            rvals, Rin = table.rvals, table.rvals.min()
+            rvel = -self.constant_accretion / 2.0 / np.pi / rvals / table['sigma']
+            # correct for extremely high values
+            rvel[rvals < 3 * Rin] *= np.exp(-(2*Rin/rvals[rvals < 3 * Rin])**6)
+            return rvel
+        else:
+            return table['radial_velocity_viscous']
+
+    def _profile_radial_velocity_viscous(self,table):
+        # v_R = d/dR(nu sigma R^3 dOmega/dR) / (R sigma d/dR(R^2 Omega)), written in
+        # terms of the logarithmic derivatives q = dlnOmega/dlnR and dq/dlnR
+        rvals, sigma = table.rvals, table['sigma']
+        correction = 1 + 3 * self.quadrupole_correction/rvals**2
+        q = 0.5 * (-3 - 2 * (correction - 1) / correction)
+        dqdlnR = 2 * (correction - 1) / correction**2
+        dlnviscosity = 2 * table['dlnsoundspeed_dlnR'] + 1.5
+
+        dlntorque = dlnviscosity + table['dlnsigma_dlnR'] + 2 + q
+        velr = table['viscosity'] * (q * dlntorque + dqdlnR) / rvals / (2 + q)
+        if (self.sigma_floor is not None):
+            velr[sigma <= self.sigma_floor] = 0
+
+        return velr
+
+    def _profile_enclosed_mass(self,table):
+        if (self.sigma_function is None) & (not self.add_gap) & \
+           getattr(self.sigma_disk,'has_analytic_mass',False):
+            # closed form (neglects the sigma_floor, a correction below pi * sigma_floor * R^2)
+            return self.sigma_disk.cumulative_mass(table.rvals)
+        def mass_integrand(R):
+            sigma = self.sigma_vals(R)
+            if (self.sigma_floor is not None):
+                sigma = np.maximum(sigma,self.sigma_floor)
+            return sigma * R * 2 * np.pi
+        return cumulative_integral(mass_integrand,table.rvals)
+
 
     def add_perturbation(self,function):
         if callable(function):
@@ -367,6 +425,7 @@ class disk_mesh2d(object):
         self.fill_box = kwargs.get("fill_box")
         self.fill_center = kwargs.get("fill_center")
         self.fill_box_Nmax = kwargs.get("fill_box_Nmax")
+        self.min_separation = kwargs.get("min_separation")
 
         
         # set default values
@@ -414,6 +473,8 @@ class disk_mesh2d(object):
 
         if (self.fill_box_Nmax is None):
             self.fill_box_Nmax = int(self.Ncells * 0.1)
+        if (self.min_separation is None):
+            self.min_separation = 0
 
                 
         print("Nphi",self.Nphi)
@@ -550,13 +611,22 @@ class disk_mesh2d(object):
                 
         #end of "polar"
         
-        elif (self.mesh_type == "mc"):
-            R,phi = mc_sample(disk, self.Ncells, self.Rin, self.Rout)
+        elif (self.mesh_type == "mc") | (self.mesh_type == "qmc"):
+            if (self.mesh_type == "mc"):
+                R,phi = mc_sample(disk, self.Ncells, self.Rin, self.Rout)
+            else:
+                R,phi = qmc_sample(disk, self.Ncells, self.Rin, self.Rout)
+            lloyd_steps = kwargs.get("lloyd_steps")
+            if (lloyd_steps is not None) and (lloyd_steps > 0):
+                # relax the sample towards the mass-weighted centroids of its cells
+                rvals,mvals = disk.evaluate_enclosed_mass(self.Rin, self.Rout)
+                R,phi,_ = lloyd_relaxation(R,phi,None,mass_sampler(rvals,mvals),lloyd_steps,
+                                           kwargs.get("region"),kwargs.get("n_workers"))
             print("Disk discretized into %i cells" % R.shape[0])
             bins = np.logspace(np.log10(self.Rin), np.log10(self.Rout),0.7*np.sqrt(self.Ncells))
-            digitized = np.digitize(R, bins)
-            rvals = np.array([(R[digitized == i]).sum() for i in range(1, len(bins))])
-            numbervals = np.array([(R[digitized == i]).shape[0] for i in range(1, len(bins))])
+            binned = PointBins(R, bins)
+            rvals = binned.sum(R)[1:len(bins)]
+            numbervals = binned.counts[1:len(bins)]
             numbervals = numbervals[rvals>0]
             rvals = rvals[rvals>0]/numbervals
             self.deltaRin,self.deltaRout = rvals[1]-rvals[0],rvals[-1]-rvals[-2]
@@ -566,63 +636,21 @@ class disk_mesh2d(object):
                 print("Adding %i background cells" % Rback.shape[0])
                 R = np.append(R,Rback)
                 phi = np.append(phi,phiback)  
+
+        if (self.min_separation > 0):
+            # points closer than min_separation local spacings give degenerate cells
+            keep = remove_close_points(R,phi,None,self.min_separation)
+            print("Removed %i mesh-generating points closer than %g local spacings to another point" %
+                  (np.count_nonzero(~keep),self.min_separation))
+            R, phi = R[keep], phi[keep]
                 
         return R,phi
     
 
     def fill_box2d(self,radius_max):
-        # First layer of cells
-        rvals = np.array([radius_max+ 1.5 * self.deltaRout,radius_max+ 3* self.deltaRout])
-        if (rvals[-1] < (0.5*self.BoxSize-rvals[-1]) ):
-            rvals = np.append(rvals,min(radius_max+ 5 * self.deltaRout,0.5*self.BoxSize-rvals[-1]))
-        if (rvals[-1] < (0.5*self.BoxSize-rvals[-1]) ):
-            rvals = np.append(rvals,min(radius_max+10* self.deltaRout,0.5*self.BoxSize-rvals[-1]))
-        phivals = np.arange(0,2*np.pi,2.0/int(radius_max/2.0 / self.deltaRout))
-        Rback,phiback = np.meshgrid(rvals,phivals)
-        phiback[1:,::2] = phiback[0:-1,::2] + 0.5 * np.diff(phiback[:,::2],axis=0)
-        phiback[0,::2]-= 0.5 * np.diff(phiback[:,::2],axis=0)[0,:]
-        
-        # Additional layers
-        backmax = Rback.max()
-        interval = 8*self.deltaRout
-        count=0
-        old_extent = backmax
-        #return Rback, phiback
-        while (True):
-            if (backmax > 0.5 * self.BoxSize - interval) & (count > 0):
-                break
-            if (count > 10): break
-            #if (count > 0): break
-            
-            if (0.5 * self.BoxSize > 2 * backmax):
-                extent = backmax
-                interval = 0.2 * backmax
-            else:
-                extent = 0.5 * self.BoxSize
-            #interval = 5*self.deltaRout
-            xback,yback = np.meshgrid(np.linspace(-extent + 0.5 * interval, extent- 0.5 * interval,int(2*extent/interval)),
-                                      np.linspace(-extent + 0.5 * interval, extent- 0.5 * interval,int(2*extent/interval)))
-            xback[::2,1:-1] = xback[::2,1:-1] + 0.5 * np.diff(xback[::2,1:],axis=1)
-            yback[1:-1,::2] = yback[1:-1,::2] + 0.5 * np.diff(yback[:-1,::2],axis=0)
-            xback,yback = xback.flatten(),yback.flatten()
-            rtemp = np.sqrt(xback**2 + yback**2)
-            ind = (xback > -0.5 * self.BoxSize) &  (xback < 0.5 * self.BoxSize) &\
-                    (yback > -0.5 * self.BoxSize) &  (yback < 0.5 * self.BoxSize) & \
-                    (rtemp > backmax/np.sqrt(2.))
-
-            xback, yback = xback[ind], yback[ind]
-
-            Rback = np.append(Rback.flatten(),np.sqrt(xback**2+yback**2))
-            phiback = np.append(phiback.flatten(),np.arctan2(yback,xback))
-            backmax = Rback.max()
-            interval*=1.4
-            old_extent = extent
-            count+=1
-        ind = Rback > radius_max + 0.2 * self.deltaRout
-        Rback, phiback = Rback[ind], phiback[ind]
-        if (len(Rback) > self.fill_box_Nmax):
-            ind = rd.choice(np.arange(1,len(Rback)),self.fill_box_Nmax,replace=False)
-            Rback, phiback = Rback[ind],phiback[ind]
+        # graded quadtree fill of the box around the disk, with at most fill_box_Nmax points
+        xback,yback = graded_box_fill(self.BoxSize,radius_max,1.5 * self.deltaRout,Npoints=self.fill_box_Nmax)
+        Rback, phiback = np.sqrt(xback**2 + yback**2), np.arctan2(yback,xback)
         return Rback, phiback
 
 def create_polar_disk(Rin,Rout,NR,Nphi,inner_rings,outer_rings,interleaved=False):
@@ -651,9 +679,15 @@ def create_polar_disk(Rin,Rout,NR,Nphi,inner_rings,outer_rings,interleaved=False
     
     return R, phi
     
-def mc_sample_from_mass(x,m,N):
+def sample_from_mass(x,m,u):
+    # positions enclosing the mass fractions u of the cumulative mass m(x)
     m2x=interp1d(np.append([0],m),np.append([0],x),kind='linear')
-    xran = m2x(rd.random_sample(N)*max(m))
+    return m2x(u*max(m))
+
+def mc_sample_from_mass(x,m,N,random_sample=None):
+    # random_sample: source of uniform random numbers, np.random by default
+    if (random_sample is None): random_sample = rd.random_sample
+    xran = sample_from_mass(x,m,random_sample(N))
     return xran
 
 def mc_sample(disk,Ncells,Rmin,Rmax,**kwargs):
@@ -677,6 +711,32 @@ def mc_sample(disk,Ncells,Rmin,Rmax,**kwargs):
     
     return R,phi
 
+def qmc_sample(disk,Ncells,Rmin,Rmax,**kwargs):
+    """
+    Quasi-random counterpart of mc_sample: a scrambled Halton sequence
+    mapped through the inverse enclosed mass in R and uniformly in phi,
+    with the radii limited to the same completeness radius. The local
+    density of points fluctuates by O(log(N)^2/N) instead of O(N^-1/2).
+
+    Parameters
+    ----------
+    Npoints : int, optional
+    number of points, Ncells by default
+    random_state : int, optional
+    seed of the scrambling, drawn from numpy.random by default
+    """
+    Npoints = kwargs.get("Npoints")
+    if (Npoints is None): Npoints = Ncells
+
+    rvals,mvals = disk.evaluate_enclosed_mass(Rmin, Rmax)
+    mass_lim = mvals[-1]*(1. - 1.2/np.sqrt(Npoints))
+    lim = next( i for i,x in reversed(list(enumerate(mvals))) if x < mass_lim)
+    u = halton_sequence(int(Npoints),2,random_state=kwargs.get("random_state"))
+    R = sample_from_mass(rvals,mvals,u[:,0] * mvals[lim]/mvals[-1])
+    phi = 2.0*np.pi*u[:,1]
+
+    return R,phi
+
 
 
 '''
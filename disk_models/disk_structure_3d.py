@@ -1,25 +1,27 @@
 from __future__ import print_function
+import multiprocessing
+import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 import numpy.random as rd
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, RegularGridInterpolator
 from scipy.integrate import quad, trapz
 from math import factorial
 from scipy.integrate import cumtrapz
 import scipy.integrate as integ
-try:
-  from scipy.spatial import Voronoi
-  VORONOI = True
-  LLOYD_STEPS = 4
-except ImportError:
-  None
 
 
 from .disk_density_profiles import *
 from .disk_external_potentials import *
 from .disk_other_functions import *
+from .disk_cache import LRUCache, parameter_fingerprint, array_fingerprint
+from .disk_radial_profiles import RadialProfileTable, adaptive_radial_zones
+from .disk_vertical_profiles import VerticalStructureTable
+from .disk_self_gravity import legendre_selfgravity_vcirc_sq
 from .disk_snapshot import *
-from .disk_structure_2d import mc_sample, mc_sample_from_mass
+from .disk_structure_2d import mc_sample, mc_sample_from_mass, sample_from_mass
+from .disk_mesh_relaxation import lloyd_relaxation, mass_sampler, remove_close_points
+from .disk_background_mesh import graded_box_fill
 
 
 rd.seed(42)
@@ -30,17 +32,32 @@ def soundspeed(R,csnd0,l,R0,soft=1e-5):
   #return csnd0 * (SplineProfile(R,soft) * R0)**(0.5 * l)
   return csnd0 * (R0/np.sqrt(R**2 + soft**2))**(0.5 * l)
 
+def dlnsoundspeed_dlnR(R,l,soft=1e-5):
+  return -0.5 * l * R**2 / (R**2 + soft**2)
+
+
+def _solve_selfgravity_columns(args):
+  disk, R, zvals, rho0_guess = args
+  return disk.evaluate_vertical_structure_selfgravity_grid(R,None,None,zvals=zvals,rho0_guess=rho0_guess)
+
 
 class disk3d(object):
+
+  # settings that do not change the model, left out of its fingerprint
+  _fingerprint_exclude = ('cache_dir','n_workers','sigma_function_vectorized')
   
   def __init__(self, *args, **kwargs):
     #units
     self.G =  kwargs.get("G")
     
+    self._profile_cache = LRUCache(maxsize=32)
+    self._vertical_cache = LRUCache(maxsize=1024)
+
     #define the properties of the axi-symmetric disk model
     self.sigma_type = kwargs.get("sigma_type")
     self.sigma_disk = None
     self.sigma_function =  kwargs.get("sigma_function")
+    self.sigma_function_vectorized = kwargs.get("sigma_function_vectorized")
     self.sigma_cut = kwargs.get("sigma_cut")
     
     
@@ -48,6 +65,9 @@ class disk3d(object):
     self.csndR0 = kwargs.get("csndR0") #reference radius
     self.csnd0 = kwargs.get("csnd0") # soundspeed scaling
     self.l = kwargs.get("l") # temperature profile index
+    # vertical temperature structure: a function cs(R,z) of the sound speed,
+    # or a table (Rvals, zvals, csvals) with csvals of shape (N_R, N_z)
+    self.soundspeed_field = kwargs.get("soundspeed_field")
     
     #thermodynamic parameters
     self.adiabatic_gamma = kwargs.get("adiabatic_gamma")
@@ -68,6 +88,11 @@ class disk3d(object):
     self.self_gravity = kwargs.get("self_gravity")
     self.central_particle = kwargs.get("central_particle")
     self.sigma_soft = kwargs.get("sigma_soft")
+
+    #directory of the persistent cache of vertical structure tables
+    self.cache_dir = kwargs.get("cache_dir")
+    #number of processes solving self-gravitating vertical structures
+    self.n_workers = kwargs.get("n_workers")
     
     
     
@@ -134,6 +159,11 @@ class disk3d(object):
       self.sigma_disk = ring_disk(**kwargs)
       if (self.csndR0 is None):
         self.csndR0 = self.sigma_disk.Rinner
+
+    if (self.sigma_type == "tabulated"):
+      self.sigma_disk = tabulated_disk(**kwargs)
+      if (self.csndR0 is None):
+        self.csndR0 = self.sigma_disk.R0
         
     if (self.sigma_type is None):
       if (self.sigma_function is not None):
@@ -150,32 +180,73 @@ class disk3d(object):
     if (self.central_particle is None):
       self.central_particle = False
 
+    if (self.n_workers is None):
+      self.n_workers = 1
+
+  def __getstate__(self):
+    # caches are not sent to worker processes
+    state = self.__dict__.copy()
+    state['_profile_cache'], state['_vertical_cache'] = LRUCache(maxsize=32), LRUCache(maxsize=1024)
+    return state
       
   def sigma_vals(self,rvals):
-        if (self.sigma_function is not None) & callable(self.sigma_function):
-            sigma = np.vectorize(self.sigma_function)(rvals)
-        else:
-            sigma = self.sigma_disk.evaluate(rvals)
+    if (self.sigma_function is not None) & callable(self.sigma_function):
+      sigma, self.sigma_function_vectorized = evaluate_callable(self.sigma_function,rvals,
+                                                                self.sigma_function_vectorized)
+    else:
+      sigma = self.sigma_disk.evaluate(rvals)
 
-        return sigma
+    return sigma
       
+  @property
+  def fingerprint(self):
+    """
+    Hash of the disk parameters, changes whenever any of them changes;
+    None if they cannot be hashed reliably, and then nothing is cached.
+    """
+    return parameter_fingerprint(self)
+
+  def clear_cache(self):
+    self._profile_cache.clear()
+    self._vertical_cache.clear()
+
+  def profile_table(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
+    """
+    Radial profiles of the disk on one grid, each evaluated at most once.
+    Tables are kept in a least-recently-used cache keyed by the parameter
+    fingerprint and the grid, so repeated evaluations are free.
+    """
+    fingerprint = self.fingerprint
+    if (fingerprint is None): return RadialProfileTable(self,Rin,Rout,Nvals,scale,radii_list)
+    key = (fingerprint,Rin,Rout,Nvals,scale,array_fingerprint(radii_list))
+    table = self._profile_cache.get(key)
+    if (table is None) or (table.fingerprint != fingerprint):
+      table = RadialProfileTable(self,Rin,Rout,Nvals,scale,radii_list)
+      self._profile_cache.put(key,table)
+    return table
+
+  def vertical_structure_table(self,Rin,Rout,dlnR=0.02,Nzvals=400):
+    """
+    Vertical structure of the disk over [Rin, Rout], solved once per set of
+    parameters and extended as larger radial ranges are requested. Tables
+    are also stored in `cache_dir`, when given, for later runs.
+    """
+    fingerprint = self.fingerprint
+    if (fingerprint is None): return VerticalStructureTable(self,Rin,Rout,dlnR,Nzvals)
+    key = ('table',fingerprint,dlnR,Nzvals)
+    table = self._vertical_cache.get(key)
+    if (table is None):
+      table = VerticalStructureTable(self,Rin,Rout,dlnR,Nzvals,cache_dir=self.cache_dir)
+      self._vertical_cache.put(key,table)
+    else:
+      table.extend(Rin,Rout)
+    return table
+
   def evaluate_sigma(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    sigma = self.sigma_vals(rvals)
-    try:
-      sigma[sigma < self.sigma_cut] = self.sigma_cut
-    except TypeError:
-      None
-    return rvals,sigma
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('sigma')
       
   def evaluate_enclosed_mass(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    def mass_integrand(R):
-      sigma = self.sigma_vals(R)
-      if (sigma < self.sigma_cut) : sigma = self.sigma_cut
-      return sigma * R * 2 * np.pi
-    mass = [quad(mass_integrand,0.0,R)[0] for R in rvals]
-    return rvals, mass
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('enclosed_mass')
 
   def compute_disk_mass(self,Rin,Rout):
     __, mass =  self.evaluate_enclosed_mass(Rin,Rout,Nvals=2)
@@ -183,131 +254,138 @@ class disk3d(object):
         
     
   def evaluate_soundspeed(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    return rvals,soundspeed(rvals,self.csnd0,self.l,self.csndR0,self.Mcentral_soft)
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('soundspeed')
 
   def evaluate_pressure_2d(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    return rvals, self.evaluate_sigma(Rin,Rout,Nvals,scale=scale)[1]**(self.effective_gamma) * \
-      self.evaluate_soundspeed(Rin,Rout,Nvals,scale=scale)[1]**2
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('pressure')
 
   def evaluate_viscosity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals,csnd =  self.evaluate_soundspeed(Rin,Rout,Nvals,scale=scale)
-    Omega_sq = self.Mcentral/rvals**3 * (1 + 3 * self.quadrupole_correction/rvals**2)
-    nu = self.alphacoeff * csnd * csnd / np.sqrt(Omega_sq)
-    return rvals, nu
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('viscosity')
     
   def evaluate_pressure_gradient(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals, press = self.evaluate_pressure_2d(Rin,Rout,Nvals,scale=scale)
-    _, dPdR = self.evaluate_radial_gradient(press,Rin,Rout,Nvals,scale=scale)
-    return rvals,dPdR
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('pressure_gradient')
 
   def evaluate_angular_freq_central_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    Omega_sq = self.Mcentral * SplineDerivative(rvals,self.Mcentral_soft*2.8) * (1 + 3 * self.quadrupole_correction/rvals**2)
-    return rvals, Omega_sq
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_central')
 
   def evaluate_angular_freq_external_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    if (self.potential_type == "keplerian"):
-      return self.evaluate_angular_freq_central_gravity(Rin,Rout,Nvals,scale,radii_list)
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_external')
     
   def evaluate_angular_freq_self_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    
-    rvals, mvals = self.evaluate_enclosed_mass(Rin,Rout,Nvals=Nvals,scale=scale)
-    rvals_fine, sigma_vals = self.evaluate_sigma(Rin,Rout,Nvals = 3 * Nvals,scale=scale)
-    # First guess at the squared angular velocity
-    vcircsquared_0 = mvals/rvals
-    selfgravity_vcirc_in_plane = np.zeros(rvals.shape[0])
-    
-    k1 = 1
-    R_disk = Rout
-    for jj,radius in enumerate(rvals[1:]):
-      delta_vcirc,delta_vcirc_old  = 0.0, 1.0e20
-      while(True):
-        #def integrand1(x): return GasSigma(x * R_disk) * x**(2.0*k1+1)
-        #def integrand2(x): return GasSigma(x * R_disk) / x**(2.0*k1)
-        ind1 = rvals_fine <= radius
-        ind2 = rvals_fine >= radius
-        integrand1 = sigma_vals[ind1] * (rvals_fine[ind1])**(2.0*k1 + 1)
-        integrand2 = sigma_vals[ind2] / (rvals_fine[ind2])**(2.0*k1)
-        alpha_k1 = np.pi*(factorial(2*k1)/2.0**(2*k1)/factorial(k1)**2)**2
-        
-        #integral1 = quad(integrand1,0.0,radius/R_disk,points=np.linspace(0.0,radius/R_disk,10))[0]
-        #integral2 = quad(integrand2,radius/R_disk,np.inf,limit=100)[0]
-        integral1 = trapz(integrand1,x=rvals_fine[ind1])
-        integral2 = trapz(integrand2,x=rvals_fine[ind2])
-        
-        delta_vcirc += 2.0 * alpha_k1 * ((2*k1+1.0)/(radius)**(2*k1+1)* integral1 - 2.0*k1 *(radius)**(2*k1) *integral2)
-
-        if (k1 > 40): break
-        abstol,reltol = 1.0e-7,1.0e-6
-        abserr,relerr = np.abs(delta_vcirc_old-delta_vcirc),np.abs(delta_vcirc_old-delta_vcirc)/np.abs(delta_vcirc_old)#+vcircsquared_0[rvals == radius])
-
-        if (np.abs(delta_vcirc) > abstol/reltol):
-          if (abserr < abstol): break
-        else:
-          if (relerr < reltol): break
-
-        delta_vcirc_old = delta_vcirc
-        k1 = k1 + 1
-     
-      selfgravity_vcirc_in_plane[jj+1] =  vcircsquared_0[jj+1]+delta_vcirc
-
-
-    return rvals, selfgravity_vcirc_in_plane / rvals**2
-
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_self_gravity')
           
   def evaluate_angular_freq_gravity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals, Omega_sq = self.evaluate_angular_freq_external_gravity(Rin,Rout,Nvals,scale,radii_list)
-    if (self.self_gravity):
-      _, Omega_sq_sg = self.evaluate_angular_freq_self_gravity(Rin,Rout,Nvals,scale,radii_list)
-      Omega_sq += Omega_sq_sg
-
-    return rvals, Omega_sq 
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_gravity')
     
   def evaluate_rotation_curve_2d(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals, Omega_sq  = self.evaluate_angular_freq_gravity(Rin,Rout,Nvals,scale,radii_list)
-    
-    return rvals, Omega_sq + self.evaluate_pressure_gradient(Rin,Rout,Nvals,scale=scale)[1] / \
-      self.evaluate_sigma(Rin,Rout,Nvals,scale=scale)[1]/ rvals
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('omega_sq_rotation')
 
   def evaluate_toomreQ(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals, csnd = self.evaluate_soundspeed(Rin,Rout,Nvals,scale,radii_list)
-    _, Omega_sq = self.evaluate_angular_freq_external_gravity(Rin,Rout,Nvals,scale,radii_list)
-    _, Sigma = self.evaluate_sigma(Rin,Rout,Nvals,scale,radii_list)
-
-    return rvals, csnd * np.sqrt(Omega_sq) / Sigma / np.pi / self.G
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('toomreQ')
         
 
   def evaluate_radial_velocity(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    return self.evaluate_radial_velocity_viscous(Rin,Rout,Nvals,scale=scale)
+    return self.evaluate_radial_velocity_viscous(Rin,Rout,Nvals,scale,radii_list)
 
   def evaluate_radial_velocity_viscous(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
-    rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    Omega = np.sqrt(self.Mcentral * SplineDerivative(rvals,self.Mcentral_soft*2.8) * (1 + 3 * self.quadrupole_correction/rvals**2))
-    sigma = (self.evaluate_sigma(Rin,Rout,Nvals,scale,radii_list)[1])
-    _, dOmegadR = self.evaluate_radial_gradient(Omega,Rin,Rout,Nvals,scale=scale)
-    
-    func1 = (self.evaluate_viscosity(Rin,Rout,Nvals,scale,radii_list)[1])*\
-            (self.evaluate_sigma(Rin,Rout,Nvals,scale,radii_list)[1])*\
-            rvals**3*dOmegadR
-    _, dfunc1dR = self.evaluate_radial_gradient(func1,Rin,Rout,Nvals,scale=scale)
-    func2 = rvals**2 * Omega
-    _, dfunc2dR = self.evaluate_radial_gradient(func2,Rin,Rout,Nvals,scale=scale)
-
-    velr = dfunc1dR / rvals / sigma / dfunc2dR
-    velr[sigma <= self.sigma_cut] = 0
-    
-
-    return rvals,velr
+    return self.profile_table(Rin,Rout,Nvals,scale,radii_list).evaluate('radial_velocity_viscous')
 
   def evaluate_radial_velocity_constant_mdot(self,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
         
     return 0
+
+  # Radial profiles, computed once per RadialProfileTable
+  def _profile_sigma(self,table):
+    sigma = self.sigma_vals(table.rvals)
+    try:
+      sigma[sigma < self.sigma_cut] = self.sigma_cut
+    except TypeError:
+      None
+    return sigma
+
+  def _profile_enclosed_mass(self,table):
+    if (self.sigma_function is None) and getattr(self.sigma_disk,'has_analytic_mass',False):
+      # closed form (neglects the sigma_cut floor, a correction below pi * sigma_cut * R^2)
+      return self.sigma_disk.cumulative_mass(table.rvals)
+    def mass_integrand(R):
+      sigma = np.maximum(self.sigma_vals(R),self.sigma_cut)
+      return sigma * R * 2 * np.pi
+    return cumulative_integral(mass_integrand,table.rvals)
+
+  def _profile_soundspeed(self,table):
+    return soundspeed(table.rvals,self.csnd0,self.l,self.csndR0,self.Mcentral_soft)
+
+  def _profile_pressure(self,table):
+    return table['sigma']**(self.effective_gamma) * table['soundspeed']**2
+
+  def _profile_viscosity(self,table):
+    rvals = table.rvals
+    Omega_sq = self.Mcentral/rvals**3 * (1 + 3 * self.quadrupole_correction/rvals**2)
+    return self.alphacoeff * table['soundspeed']**2 / np.sqrt(Omega_sq)
+
+  def _profile_dlnsigma_dlnR(self,table):
+    if (self.sigma_function is None):
+      slope = self.sigma_disk.dlnsigma_dlnR(table.rvals)
+    else:
+      slope = table.gradient(np.log(table['sigma'])) * table.rvals
+    return np.where(table['sigma'] > self.sigma_cut,slope,0.0)
+
+  def _profile_dlnsoundspeed_dlnR(self,table):
+    return dlnsoundspeed_dlnR(table.rvals,self.l,self.Mcentral_soft)
+
+  def _profile_pressure_gradient(self,table):
+    # P = sigma^gamma_eff cs^2, differentiated analytically
+    return table['pressure'] / table.rvals * (self.effective_gamma * table['dlnsigma_dlnR'] +
+                                              2 * table['dlnsoundspeed_dlnR'])
+
+  def _profile_omega_sq_central(self,table):
+    return self.omega_sq_central(table.rvals)
+
+  def _profile_omega_sq_external(self,table):
+    if (self.potential_type == "keplerian"):
+      return table['omega_sq_central']
+
+  def _profile_omega_sq_self_gravity(self,table):
+    rvals, mvals = table.rvals, np.asarray(table['enclosed_mass'])
+    fine_scale = 'linear' if (table.scale == 'linear') else 'log'
+    fine_table = self.profile_table(rvals.min(),rvals.max(),Nvals = 3 * rvals.shape[0],scale=fine_scale)
+    # monopole plus the Legendre series of the higher multipoles
+    vcirc_sq = self.G * mvals/rvals + \
+               legendre_selfgravity_vcirc_sq(rvals,fine_table.rvals,fine_table['sigma'],G=self.G)
+    return vcirc_sq / rvals**2
+
+  def _profile_omega_sq_gravity(self,table):
+    Omega_sq = table['omega_sq_external']
+    if (self.self_gravity):
+      Omega_sq = Omega_sq + table['omega_sq_self_gravity']
+    return Omega_sq
+
+  def _profile_omega_sq_rotation(self,table):
+    return table['omega_sq_gravity'] + table['pressure_gradient'] / table['sigma'] / table.rvals
+
+  def _profile_toomreQ(self,table):
+    return table['soundspeed'] * np.sqrt(table['omega_sq_external']) / table['sigma'] / np.pi / self.G
+
+  def _profile_radial_velocity_viscous(self,table):
+    # v_R = d/dR(nu sigma R^3 dOmega/dR) / (R sigma d/dR(R^2 Omega)), written in
+    # terms of the logarithmic derivatives q = dlnOmega/dlnR and dq/dlnR
+    rvals, sigma = table.rvals, table['sigma']
+    soft = self.Mcentral_soft * 2.8
+    correction = 1 + 3 * self.quadrupole_correction/rvals**2
+    dlncorrection, d2lncorrection = -2 * (correction - 1) / correction, 4 * (correction - 1) / correction**2
+    q = 0.5 * (dlnSplineDerivative_dlnR(rvals,soft) + dlncorrection)
+    dqdlnR = 0.5 * (d2lnSplineDerivative_dlnR2(rvals,soft) + d2lncorrection)
+    dlnviscosity = 2 * table['dlnsoundspeed_dlnR'] + 0.5 * (3 - dlncorrection)
+
+    dlntorque = dlnviscosity + table['dlnsigma_dlnR'] + 2 + q
+    velr = table['viscosity'] * (q * dlntorque + dqdlnR) / rvals / (2 + q)
+    velr[sigma <= self.sigma_cut] = 0
+    
+    return velr
         
   def evaluate_radial_gradient(self,quantity,Rin,Rout,Nvals=1000,scale='log',radii_list=None):
     rvals = self.evaluate_radial_zones(Rin,Rout,Nvals,scale,radii_list)
-    if (scale == 'log'):
+    if (scale == 'log') | (scale == 'adaptive'):
       dQdlogR = np.gradient(quantity,np.log10(rvals))
       dQdR = dQdlogR/rvals/np.log(10)
     elif (scale == 'linear'):
@@ -324,6 +402,8 @@ class disk3d(object):
       rvals = np.logspace(np.log10(Rin),np.log10(Rout),Nvals)
     elif (scale == 'linear'):
       rvals = np.linspace(Rin,Rout,Nvals)
+    elif (scale == 'adaptive'):
+      rvals = adaptive_radial_zones(self,Rin,Rout,Nmax=Nvals)
     else: 
       print("[error] scale type ", scale, "not known!")
       sys.exit()
@@ -336,82 +416,322 @@ class disk3d(object):
     return radial_bins
     
   def evaluate_vertical_structure_selfgravity(self,R,zin,zout,Nzvals=400,G=1):
-        
-    m_enclosed =  self.sigma_vals(R) * np.pi * R**2
+    zvals,zrho,VertProfileNorm,_ = self.evaluate_vertical_structure_selfgravity_grid(R,zin,zout,Nzvals,G)
+    return zvals[0],list(zrho[0]),VertProfileNorm[0]
 
-    if (zin > 0):
-      zvals = np.logspace(np.log10(zin),np.log10(zout),Nzvals)
-    else:
-      zvals = np.append(0,np.logspace(-6,np.log10(zout),Nzvals))
-
-      
-    # First take a guess of the vertical structure        
-    if (m_enclosed < 0.1 * self.Mcentral):
-      zrho0=[np.exp(-self.vertical_potential(R,zz)/soundspeed(R,self.csnd0,self.l,self.csndR0)**2) for zz in zvals]
-      VertProfileNorm = self.sigma_vals(R)/(2.0*cumtrapz(zrho0,zvals))[-1]
-    else:
-      VertProfileNorm = self.sigma_vals(R)**2/soundspeed(R,self.csnd0,self.l,self.csndR0)**2/ 2.0 * np.pi * G
-        
-    VertProfileNorm_old = 1.0e-40
-    if (VertProfileNorm < VertProfileNorm_old): VertProfileNorm = VertProfileNorm_old
+  def evaluate_vertical_structure_selfgravity_grid(self,R,zin,zout,Nzvals=400,G=1,maxiter=200,zvals=None,
+                                                   rho0_guess=None,return_stats=False):
+    """
+    Self-gravitating vertical structure of many columns at once.
 
+    The vertical Poisson equation, d^2Phi/dz^2 = 4 pi G rho0 exp(-(Phi_ext + Phi)/cs^2),
+    is integrated for all columns simultaneously with a classical RK4
+    scheme on the height grid of each column. The normalization rho0 is
+    the root of ln F(rho0) - ln rho0, where F(rho0) = sigma/(2 int rho/rho0 dz)
+    is the normalization implied by the solution for rho0; the root is
+    found by secant steps in ln rho0, falling back to the fixed-point step
+    rho0 -> F(rho0) whenever the secant step is not usable. Columns drop
+    out of the iteration as they converge.
 
-    def VerticalPotentialEq(Phi,z,r,rho0):
-      dPhiGrad_dz =  rho0 * G* 4 * np.pi * np.exp(-(self.vertical_potential(r,z) + Phi[1]) / soundspeed(r,self.csnd0,self.l,self.csndR0)**2)
-      dPhi_dz = Phi[0]
-      return [dPhiGrad_dz,dPhi_dz]
+    Parameters and return values are those of evaluate_vertical_structure_grid,
+    and
 
-    iterate = 0
-    while(True) : #iteration
-      min_step = (zvals[1]-zvals[0])/100.0
-      tol = 1.0e-9
+    Parameters
+    ----------
+    maxiter : int, optional
+    maximum number of iterations
+    rho0_guess : array_like, optional
+    starting normalization of each column, e.g. from neighbouring radii
+    return_stats : bool, optional
+    if True, also return a dictionary with the number of iterations
+    ('iterations') and the final relative residual |F/rho0 - 1|
+    ('residual') of each column
+    """
+    R = np.atleast_1d(np.asarray(R,dtype=float))
+    if (zvals is None): zvals = self._vertical_grid(R,zin,zout,Nzvals)
+    sigma = self.sigma_vals(R)
+    psi_ext, csnd_sq, psi_ext_mid, csnd_sq_mid = self._vertical_exponent(R,zvals)
+    ratio, ratio_mid = csnd_sq[:,:1]/csnd_sq, csnd_sq[:,:1]/csnd_sq_mid
+
+    # First take a guess of the vertical structure
+    zrho0 = ratio * np.exp(-psi_ext)
+    if (rho0_guess is not None):
+      VertProfileNorm = np.array(np.broadcast_to(rho0_guess,R.shape),dtype=float)
+    else:
+      VertProfileNorm = np.where(sigma * np.pi * R**2 < 0.1 * self.Mcentral,
+                                 sigma/(2.0*cumulative_trapezoid(zrho0,zvals)[:,-1]),
+                                 sigma**2/csnd_sq[:,0]/ 2.0 * np.pi * G)
+    VertProfileNorm = np.maximum(VertProfileNorm,1.0e-40)
+
+    lnnorm = np.log(VertProfileNorm)
+    lnnorm_prev, resid_prev = np.zeros(R.shape), np.full(R.shape,np.nan)
+    iterations, residual = np.zeros(R.shape,dtype=int), np.full(R.shape,np.inf)
+    reltol = 1.0e-6
+    active = np.ones(R.shape,dtype=bool)
+    for iterate in range(maxiter):
+      cols = np.where(active)[0]
       # Solve for the vertical potential
-      soln=integ.odeint(VerticalPotentialEq,[0.0,0.0],zvals,args=(R,VertProfileNorm),rtol=tol,
-                        mxords=15,hmin=min_step,printmessg=False)[:,1]
-      zrho0=[np.exp(-(self.vertical_potential(R,zvals[kk])+soln[kk])/soundspeed(R,self.csnd0,self.l,self.csndR0)**2) for kk in range(len(zvals))]
-      VertProfileNorm = self.sigma_vals(R)/(2.0*cumtrapz(zrho0,zvals))[-1]
-      zrho = [VertProfileNorm * r for r in zrho0]
-
-      if (VertProfileNorm * 1.333 * np.pi * R**3 < 1.0e-12 * self.Mcentral): break
-      # Check if vertical structure solution has converged
-      abstol,reltol = 1.0e-9,1.0e-6
-      abserr,relerr = np.abs(VertProfileNorm_old-VertProfileNorm),np.abs(VertProfileNorm_old-VertProfileNorm)/np.abs(VertProfileNorm_old)
-
-      if (np.abs(VertProfileNorm) > abstol/reltol):
-        if (abserr < abstol): break
-      else:
-        if (relerr < reltol): break
-      VertProfileNorm_old = VertProfileNorm
-      iterate += 1
-
-    return zvals,zrho,VertProfileNorm
+      soln = self._integrate_vertical_potential(zvals[cols],psi_ext[cols],psi_ext_mid[cols],
+                                                csnd_sq[cols],csnd_sq_mid[cols],ratio[cols],
+                                                ratio_mid[cols],np.exp(lnnorm[cols]),G)
+      zrho0[cols] = ratio[cols] * np.exp(-(psi_ext[cols] + soln))
+      new = sigma[cols]/(2.0*cumulative_trapezoid(zrho0[cols],zvals[cols])[:,-1])
+      VertProfileNorm[cols] = new
+      resid = np.log(new) - lnnorm[cols]
+      iterations[cols] += 1
+      residual[cols] = np.abs(np.expm1(resid))
+
+      # Check which columns have converged, on the relative residual since
+      # exp(ln rho0) does not round-trip rho0 to an absolute tolerance
+      converged = residual[cols] < reltol
+      converged |= (new * 1.333 * np.pi * R[cols]**3 < 1.0e-12 * self.Mcentral)
+      active[cols[converged]] = False
+
+      # secant step on ln rho0, or a fixed-point step
+      with np.errstate(divide='ignore',invalid='ignore'):
+        step = -resid * (lnnorm[cols] - lnnorm_prev[cols])/(resid - resid_prev[cols])
+      usable = np.isfinite(step) & (np.abs(step) < 2.0)
+      lnnorm_prev[cols], resid_prev[cols] = lnnorm[cols], resid
+      lnnorm[cols] = np.where(usable,lnnorm[cols] + step,np.log(new))
+      if not active.any(): break
+    else:
+      print("[warning] vertical structure not converged in %i of %i columns" % (active.sum(),R.shape[0]))
+
+    if (R.shape[0] > 1):
+      slowest = np.argmax(iterations)
+      print("Vertical structure: %i columns, %.1f iterations on average, %i at most (R=%g), "
+            "largest residual %.2e" % (R.shape[0],iterations.mean(),iterations[slowest],R[slowest],
+                                         residual.max()))
+
+    zrho = VertProfileNorm[:,None] * zrho0
+    zmass = cumulative_trapezoid(zrho,zvals)
+    if (return_stats):
+      return zvals,zrho,VertProfileNorm,zmass,{'iterations':iterations,'residual':residual}
+    return zvals,zrho,VertProfileNorm,zmass
+
+  def _integrate_vertical_potential(self,zvals,psi_ext,psi_ext_mid,csnd_sq,csnd_sq_mid,
+                                    ratio,ratio_mid,rho0,G=1):
+    """
+    RK4 integration of the vertical Poisson equation for a stack of
+    columns, from dPhi/dz = 0 at the first height of each column, for the
+    exponent psi = int (dPhi/dz)/cs^2 dz of the disk's own potential; the
+    density is rho0 ratio exp(-psi_ext - psi), with ratio = cs^2(z0)/cs^2.
+    The external exponent psi_ext, cs^2 and the ratio are given at the grid
+    heights and at the midpoints between them (see _vertical_exponent).
+    """
+    # march along the height index, with the columns as the vector axis
+    coeff = 4 * np.pi * G * rho0
+    dz = np.diff(zvals,axis=1).T
+    psi_ext, psi_ext_mid = psi_ext.T, psi_ext_mid.T
+    csnd_sq, csnd_sq_mid = csnd_sq.T, csnd_sq_mid.T
+    ratio, ratio_mid = coeff * ratio.T, coeff * ratio_mid.T
+    psi = np.zeros(psi_ext.shape)
+    Psi, dPhi = np.zeros(zvals.shape[0]), np.zeros(zvals.shape[0])
+    for kk in range(dz.shape[0]):
+      h = dz[kk]
+      k1g = ratio[kk] * np.exp(-psi_ext[kk] - Psi)
+      k1p = dPhi/csnd_sq[kk]
+      k2g = ratio_mid[kk] * np.exp(-psi_ext_mid[kk] - Psi - 0.5 * h * k1p)
+      k2p = (dPhi + 0.5 * h * k1g)/csnd_sq_mid[kk]
+      k3g = ratio_mid[kk] * np.exp(-psi_ext_mid[kk] - Psi - 0.5 * h * k2p)
+      k3p = (dPhi + 0.5 * h * k2g)/csnd_sq_mid[kk]
+      k4g = ratio[kk+1] * np.exp(-psi_ext[kk+1] - Psi - h * k3p)
+      k4p = (dPhi + h * k3g)/csnd_sq[kk+1]
+      Psi = Psi + h/6.0 * (k1p + 2 * k2p + 2 * k3p + k4p)
+      dPhi = dPhi + h/6.0 * (k1g + 2 * k2g + 2 * k3g + k4g)
+      psi[kk+1] = Psi
+    return psi.T
 
   def evaluate_vertical_structure_no_selfgravity(self,R,zin,zout,Nzvals=400,G=1):
-    if (zin > 0):
-      zvals = np.logspace(np.log10(zin),np.log10(zout),Nzvals)
-    else:
-      zvals = np.append(0,np.logspace(-6,np.log10(zout),Nzvals))
-        
-      #def integrand(z): return np.exp(-self.vertical_potential(R,z)/soundspeed(R,self.csnd0,self.l,self.csndR0)**2)
-      #VertProfileNorm =  self.sigma_vals(R)/(2.0*quad(integrand,0,zout*15)[0])
-    csnd_sq=soundspeed(R,self.csnd0,self.l,self.csndR0)**2
-    zrho0=np.exp(-self.vertical_potential(R,zvals)/csnd_sq)
-    VertProfileNorm = self.sigma_vals(R)/2.0/cumtrapz(zrho0,zvals)[-1]
-    #zrho = [VertProfileNorm * np.exp(-self.vertical_potential(R,zz)/soundspeed(R,self.csnd0,self.l,self.csndR0)**2) for zz in zvals]
-    zrho = [VertProfileNorm * zrho0[kk] for kk in range(len(zrho0))]
-    return zvals,zrho,VertProfileNorm
+    zvals,zrho,VertProfileNorm,_ = self.evaluate_vertical_structure_grid(R,zin,zout,Nzvals)
+    return zvals[0],list(zrho[0]),VertProfileNorm[0]
+
+  def evaluate_midplane_density(self,R,rtol=1.0e-8,nmin=8,nmax=128):
+    """
+    Mid-plane density rho0 = sigma/(2 int_0^inf exp(-dPhi/cs^2) dz) of
+    non-self-gravitating columns, by Gauss-Hermite quadrature.
+
+    The nodes are scaled to the thin-disk solution, a Gaussian of scale
+    height H = cs/Omega_z with Omega_z^2 = d^2Phi/dz^2 at the mid-plane,
+    so that the remaining factor exp(x^2 - dPhi/cs^2) is close to unity
+    and a few nodes suffice. The number of nodes is doubled from `nmin`
+    until two successive estimates agree to `rtol`; the returned relative
+    error is the difference between the last two estimates, which bounds
+    the error of the coarser one and overestimates that of the value
+    returned. Columns that do not converge within `nmax` nodes (thick
+    disks, for which the potential difference saturates at large heights
+    and the integral over all heights diverges) are normalised over
+    0 <= z <= 15 H instead, with a composite Gauss-Legendre rule whose
+    error is estimated in the same way by doubling the number of panels.
+    Disks with a `soundspeed_field` are normalised over the same heights
+    by Simpson's rule over the hydrostatic solution of _vertical_exponent on
+    a logarithmic grid, with the difference from the trapezoidal rule on
+    the same grid as the error estimate.
+
+    Returns
+    -------
+    rho0, relerr : ndarray
+    """
+    R = np.atleast_1d(np.asarray(R,dtype=float))
+    if not (self.vertically_isothermal):
+      zvals = 15.0 * self.vertical_scale_height(R)[:,None] * np.append(0,np.logspace(-5,0,400))[None,:]
+      psi, csnd_sq, psi_mid, csnd_sq_mid = self._vertical_exponent(R,zvals)
+      zrho0 = csnd_sq[:,:1]/csnd_sq * np.exp(-psi)
+      integral = cumulative_simpson(zrho0,csnd_sq[:,:1]/csnd_sq_mid * np.exp(-psi_mid),zvals)[0][:,-1]
+      coarse = cumulative_trapezoid(zrho0,zvals)[:,-1]
+      return self.sigma_vals(R)/2.0/integral, np.abs(integral - coarse)/integral
+
+    csnd_sq = self.soundspeed_sq(R)
+    Hz = np.sqrt(csnd_sq/(self.G * self.Mcentral * SplineDerivative(R,self.Mcentral_soft)))
+
+    def gauss_hermite(cols,n):
+      # half of the symmetric rule, int_0^inf f dz = sqrt(2) H sum_{x>0} w exp(x^2) f(sqrt(2) H x)
+      x, w = np.polynomial.hermite.hermgauss(n)
+      x, w = x[x > 0], w[x > 0]
+      z = np.sqrt(2.0) * Hz[cols,None] * x[None,:]
+      exponent = x[None,:]**2 - self.vertical_potential(R[cols,None],z)/csnd_sq[cols,None]
+      return np.sqrt(2.0) * Hz[cols] * np.sum(w[None,:] * np.exp(exponent),axis=1)
+
+    integral, relerr = np.zeros(R.shape), np.full(R.shape,np.inf)
+    active = np.arange(R.shape[0])
+    previous, n = gauss_hermite(active,nmin), nmin
+    while (active.shape[0] > 0) & (2 * n <= nmax):
+      n *= 2
+      current = gauss_hermite(active,n)
+      integral[active] = current
+      relerr[active] = np.abs(current - previous)/current
+      keep = ~(relerr[active] < rtol)
+      active, previous = active[keep], current[keep]
+
+    def gauss_legendre(cols,npanels,order=8):
+      # composite rule over 0 <= z <= 15 H
+      x, w = np.polynomial.legendre.leggauss(order)
+      x = (np.arange(npanels)[:,None] + 0.5 * (x[None,:] + 1)).ravel()/npanels
+      w = np.tile(0.5 * w,npanels)/npanels
+      z = 15.0 * Hz[cols,None] * x[None,:]
+      integrand = np.exp(-self.vertical_potential(R[cols,None],z)/csnd_sq[cols,None])
+      return 15.0 * Hz[cols] * np.sum(w[None,:] * integrand,axis=1)
+
+    if (active.shape[0] > 0):
+      coarse, integral[active] = gauss_legendre(active,30), gauss_legendre(active,60)
+      relerr[active] = np.abs(integral[active] - coarse)/integral[active]
+
+    return self.sigma_vals(R)/2.0/integral, relerr
 
   def evaluate_vertical_structure(self,R,zin,zout,Nzvals=400):
-    if (self.self_gravity):
-      return self.evaluate_vertical_structure_selfgravity(R,zin,zout,Nzvals)
-    else:
-      return self.evaluate_vertical_structure_no_selfgravity(R,zin,zout,Nzvals)
+    # solutions are cached by parameter fingerprint and grid
+    key = (self.fingerprint,float(R),zin,zout,Nzvals)
+    solution = self._vertical_cache.get(key) if (key[0] is not None) else None
+    if (solution is None):
+      if (self.self_gravity):
+        zvals,zrho,rho0 = self.evaluate_vertical_structure_selfgravity(R,zin,zout,Nzvals)
+      else:
+        zvals,zrho,rho0 = self.evaluate_vertical_structure_no_selfgravity(R,zin,zout,Nzvals)
+      solution = (np.array(zvals),np.array(zrho),rho0)
+      if (key[0] is not None): self._vertical_cache.put(key,solution)
+    zvals,zrho,rho0 = solution
+    return zvals.copy(),list(zrho),rho0
         
   def evaluate_enclosed_vertical(self,R,zin,zout,Nzvals=400):
     zvals, zrho, _ = self.evaluate_vertical_structure(R,zin,zout,Nzvals)
     zmass = np.append(0,cumtrapz(zrho,zvals))
     return zvals, zmass
   
+  def evaluate_vertical_structure_grid(self,R,zin,zout,Nzvals=400,zvals=None,rho0_guess=None):
+    """
+    Vertical structure at many radii at once, on an (N_R, N_z) grid.
+
+    Without self-gravity, the potential, the density and its cumulative
+    integral are evaluated for all radii in a single pass over 2D arrays;
+    with self-gravity, the columns are solved together by
+    evaluate_vertical_structure_selfgravity_grid.
+
+    Parameters
+    ----------
+    R : array_like
+    radii of the columns
+    zin, zout : float or array_like
+    limits of the logarithmic height grid of each column; for zin = 0 the
+    grid starts at z = 0 and its first nonzero height is 1e-6
+    Nzvals : int, optional
+    number of logarithmically spaced heights
+    zvals : array_like, shape (N_R, N_z), optional
+    explicit height grid of each column, overrides zin, zout and Nzvals
+    rho0_guess : array_like, optional
+    starting normalization of the self-gravitating solver
+
+    Returns
+    -------
+    zvals, zrho : ndarray, shape (N_R, N_z)
+    heights and densities
+    rho0 : ndarray, shape (N_R,)
+    density normalization of each column
+    zmass : ndarray, shape (N_R, N_z)
+    cumulative vertical mass (per unit area) from the bottom of the grid
+    """
+    R = np.atleast_1d(np.asarray(R,dtype=float))
+    if (self.self_gravity):
+      if (self.n_workers > 1) & (R.shape[0] >= 2 * self.n_workers):
+        return self._parallel_selfgravity_grid(R,zin,zout,Nzvals,zvals,rho0_guess)
+      return self.evaluate_vertical_structure_selfgravity_grid(R,zin,zout,Nzvals,zvals=zvals,
+                                                               rho0_guess=rho0_guess)
+
+    if (zvals is None): zvals = self._vertical_grid(R,zin,zout,Nzvals)
+    psi, csnd_sq, _, _ = self._vertical_exponent(R,zvals)
+    zrho0 = csnd_sq[:,:1]/csnd_sq * np.exp(-psi)
+    rho0 = self.sigma_vals(R)/2.0/cumulative_trapezoid(zrho0,zvals)[:,-1]
+    zrho = rho0[:,None] * zrho0
+
+    zmass = cumulative_trapezoid(zrho,zvals)
+    return zvals,zrho,rho0,zmass
+
+  def _parallel_selfgravity_grid(self,R,zin,zout,Nzvals,zvals,rho0_guess):
+    """
+    Self-gravitating columns split into `n_workers` contiguous chunks,
+    solved in a process pool. Columns are solved independently, so the
+    result does not depend on the number of workers. Falls back to a
+    serial solve if the disk cannot be sent to other processes (e.g. a
+    lambda as sigma_function).
+    """
+    if (zvals is None): zvals = self._vertical_grid(R,zin,zout,Nzvals)
+    if (rho0_guess is not None): rho0_guess = np.broadcast_to(rho0_guess,R.shape)
+    chunks = np.array_split(np.arange(R.shape[0]),self.n_workers)
+    tasks = [(self,R[c],zvals[c],None if rho0_guess is None else rho0_guess[c]) for c in chunks]
+    # only a disk that cannot be pickled falls back; errors in the workers propagate
+    try:
+      pickle.dumps(self)
+    except (pickle.PicklingError,AttributeError,TypeError) as err:
+      print("[warning] running the vertical structure solver serially:",err)
+      return self.evaluate_vertical_structure_selfgravity_grid(R,None,None,zvals=zvals,rho0_guess=rho0_guess)
+    pool = multiprocessing.Pool(self.n_workers)
+    try:
+      results = pool.map(_solve_selfgravity_columns,tasks)
+    finally:
+      pool.close()
+      pool.join()
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+  def _vertical_grid(self,R,zin,zout,Nzvals):
+    """
+    Logarithmic height grids of shape (N_R, N_z), with a leading z = 0
+    when zin = 0; columns starting at zin > 0 then repeat their first height
+    """
+    zin = np.broadcast_to(np.asarray(zin,dtype=float),R.shape)
+    zout = np.broadcast_to(np.asarray(zout,dtype=float),R.shape)
+    zlow = np.where(zin > 0,zin,1.0e-6)
+    zvals = zlow[:,None] * (zout/zlow)[:,None]**np.linspace(0,1,Nzvals)[None,:]
+    if (zin <= 0).any():
+      zvals = np.append(np.where(zin > 0,zin,0)[:,None],zvals,axis=1)
+    return zvals
+
+  def vertical_scale_height(self,R):
+    """
+    Scale height cs/Omega of the disk in the potential of the central
+    object alone
+    """
+    return R * np.sqrt(self.soundspeed_sq(R))/ \
+           np.sqrt(self.G * self.Mcentral * SplineProfile(R,self.Mcentral_soft*2.8))
+
   def spherical_potential(self,r):
     if (self.potential_type == "keplerian"):
       return -self.G * self.Mcentral * spherical_potential_keplerian(r,self.Mcentral_soft)
@@ -419,8 +739,87 @@ class disk3d(object):
   def vertical_potential(self,R,z):
     return (self.spherical_potential(np.sqrt(R*R + z*z)) - self.spherical_potential(R))
 
+  def omega_sq_central(self,R,z=0.0):
+    """
+    Radial attraction of the central object over R, (1/R) dPhi/dR, at the
+    points (R, z); at z = 0 this is its contribution to the rotation curve
+    """
+    r = np.sqrt(R*R + z*z)
+    return self.G * self.Mcentral * SplineDerivative(r,self.Mcentral_soft*2.8) * \
+           (1 + 3 * self.quadrupole_correction/r**2)
+
+  def vertical_force(self,R,z):
+    """
+    Vertical derivative dPhi/dz of the potential of the central object
+    """
+    return self.G * self.Mcentral * z * SplineDerivative(np.sqrt(R*R + z*z),self.Mcentral_soft)
+
+  @property
+  def vertically_isothermal(self):
+    return self.soundspeed_field is None
+
+  def soundspeed_sq(self,R,z=0.0):
+    """
+    Squared sound speed at the points (R, z): the radial power law of the
+    disk, or the field given as `soundspeed_field`. Tabulated fields are
+    interpolated linearly in (ln R, |z|) on ln cs, and take the values at
+    the edges of the table outside of it.
+    """
+    R, z = np.broadcast_arrays(np.asarray(R,dtype=float),np.abs(np.asarray(z,dtype=float)))
+    field = self.soundspeed_field
+    if (field is None):
+      return soundspeed(R,self.csnd0,self.l,self.csndR0)**2
+    if callable(field):
+      return np.broadcast_to(field(R,z),R.shape)**2
+    Rvals, zvals, csvals = [np.asarray(a,dtype=float) for a in field]
+    interp = RegularGridInterpolator((np.log(Rvals),zvals),np.log(csvals))
+    lnR = np.clip(np.log(R),np.log(Rvals[0]),np.log(Rvals[-1]))
+    return np.exp(2 * interp((lnR,np.clip(z,zvals[0],zvals[-1]))))
+
+  def _vertical_exponent(self,R,zvals):
+    """
+    Hydrostatic balance d(rho cs^2)/dz = -rho dPhi/dz of columns in the
+    potential of the central object, rho = rho(z0) cs^2(z0)/cs^2 exp(-psi),
+    with psi = int_z0^z (dPhi/dz)/cs^2 dz from the first height z0 of each
+    column. For a vertically isothermal disk psi = dPhi/cs^2; otherwise
+    psi is integrated with Simpson's rule on the grid.
+
+    Returns
+    -------
+    psi, csnd_sq : ndarray, shape of zvals
+    psi_mid, csnd_sq_mid : ndarray
+    the same at the midpoints between the grid heights
+    """
+    zmid = 0.5 * (zvals[:,1:] + zvals[:,:-1])
+    if (self.vertically_isothermal):
+      csnd_sq = self.soundspeed_sq(R)[:,None]
+      psi = self.vertical_potential(R[:,None],zvals)/csnd_sq
+      psi_mid = self.vertical_potential(R[:,None],zmid)/csnd_sq
+      return psi, np.broadcast_to(csnd_sq,zvals.shape), psi_mid, np.broadcast_to(csnd_sq,zmid.shape)
+    csnd_sq, csnd_sq_mid = self.soundspeed_sq(R[:,None],zvals), self.soundspeed_sq(R[:,None],zmid)
+    psi, psi_mid = cumulative_simpson(self.vertical_force(R[:,None],zvals)/csnd_sq,
+                                      self.vertical_force(R[:,None],zmid)/csnd_sq_mid,zvals)
+    return psi, csnd_sq, psi_mid, csnd_sq_mid
+
   
       
+  def midplane_density_profile(self,Rin,Rout):
+    """
+    Mid-plane density at the radii exp(0.02 k) in [Rin, Rout], the radial
+    rows of the vertical structure table
+
+    Returns
+    -------
+    radii, mid_plane : ndarray
+    """
+    if not (self.self_gravity) and (self.vertically_isothermal):
+      radii = np.exp(np.arange(np.ceil(np.log(Rin)/0.02),np.floor(np.log(Rout)/0.02) + 1) * 0.02)
+      mid_plane, _ = self.evaluate_midplane_density(radii)
+      return radii, mid_plane
+    table = self.vertical_structure_table(Rin,Rout)
+    ind = (table.rvals >= Rin) & (table.rvals <= Rout)
+    return table.rvals[ind], np.exp(table.lnrho0[ind])
+
   def solve_vertical_structure(self,Rsamples,phisamples,zsamples,Rin,Rout,Ncells):
     
     """
@@ -428,89 +827,38 @@ class disk3d(object):
         
     Parameters
     ----------
-    first : array_like
-    the 1st param name `first`
-    second :
-    the 2nd param
-    third : {'value', 'other'}, optional
-    the 3rd param, by default 'value'
+    Rsamples, phisamples, zsamples : array_like
+    coordinates of the mesh points
+    Rin, Rout : float
+    radial range of the vertical structure table
+    Ncells : int
+    number of mesh points (not used, the resolution of the table is fixed)
     
     Returns
     -------
-    string
-    a value in a string
-    
-    Raises
-    ------
-    KeyError
-    when a key error
-    OtherError
-    when an other error
+    dens : ndarray
+    density at the mesh points
+    radii, mid_plane : ndarray
+    mid-plane density profile, on the radial rows of the table
     """
-      
-      
-    dens = np.zeros(Rsamples.shape[0])
 
-    grided = np.unique(Rsamples).shape[0] < np.sqrt(Rsamples.shape)    # Are the mesh point locations grided?
+    Rsamples = np.clip(Rsamples,Rin,Rout)
+    radii, mid_plane = self.midplane_density_profile(Rin,Rout)
+    if not (self.self_gravity) and (self.vertically_isothermal):
+      # the vertical structure is known in closed form up to its normalization
+      print("Evaluating the density at the sampled locations")
+      rho0, _ = self.evaluate_midplane_density(Rsamples)
+      csnd_sq = self.soundspeed_sq(Rsamples)
+      dens = rho0 * np.exp(-self.vertical_potential(Rsamples,zsamples)/csnd_sq)
+      return dens,radii,mid_plane
 
-    
-    if not (grided):
+    print("Reading the vertical structure table for density evaluation at the sampled locations")
+    table = self.vertical_structure_table(Rin,Rout)
+    print("(using %i radial rows)" % table.rvals.shape[0])
 
-      R_bins = int(60 * np.log10(Ncells)* np.log10(Rout/Rin))
-      radial_bins = self.evaluate_radial_mass_bins(Rin,Rout,R_bins)
-      #radial_bins2 = np.logspace(np.log10(Rin),np.log10(Rout),R_bins)
-      radial_bins2 = np.linspace(Rin,Rout,R_bins)
-      radial_bins =np.sqrt(radial_bins*radial_bins2)
+    dens = table.density(Rsamples,zsamples)
 
-      #fix the bins a bit
-      #dRin = radial_bins[1]-radial_bins[0]
-      #radial_bins = np.append(0,np.append(np.arange(radial_bins[1]/30,radial_bins[1],dRin/30),radial_bins[1:]))
-    else:
-      radial_bins = np.unique(Rsamples)
-      
-    bin_inds=np.digitize(Rsamples,radial_bins)
-    mid_plane = []
-    radii = []
-        
-    zin,zout = 0.99*np.abs(zsamples).min(),1.01*np.abs(zsamples).max()
-
-
-    print("Solving vertical structure AGAIN for density evaluation at the sampled locations")
-    print("(using %i radial bins)" % radial_bins.shape[0])
-
-    reference_H =  radial_bins/np.sqrt(-self.spherical_potential(radial_bins))*soundspeed(radial_bins,self.csnd0,self.l,self.csndR0)
-    #print(reference_sigma)
-    for kk in range(0,radial_bins.shape[0]):
-      update_progress(kk,radial_bins.shape[0])
-      N_in_bin = Rsamples[bin_inds == kk].shape[0]
-      if (N_in_bin == 0):
-        mid_plane.append(0.0)
-        radii.append(radial_bins[kk])
-        continue
-
-      bin_radius = Rsamples[bin_inds == kk].mean()
-      reference_sigma = self.sigma_vals(bin_radius)
-
-      zvals,zrhovals,rho0 = self.evaluate_vertical_structure(bin_radius,zin,zout,Nzvals=800)
-
-      dens_profile = interp1d(zvals,zrhovals,kind='linear')
-      dens[bin_inds == kk] = dens_profile(np.abs(zsamples[bin_inds == kk]))    
-      mid_plane.append(rho0)
-      radii.append(bin_radius)
-
-          
-    '''
-    if VORONOI:
-      # The center of the disk is always tricky. So we try to regularize the mesh
-      # using Lloyd steps
-      xsamples, ysamples = Rsamples * np.cos(phi_samples),Rsamples * np.sin(phi_samples)
-      inner_disk = Rsamples <  5 * Rin 
-      for step in range(LLOYD_STEPS):
-        vor = Voronoi(zip(xsamples[inner_disk],ysample[inner_disk],zsamples[inner_disk]))
-    '''
-
-    ind = np.array(mid_plane) > 0
-    return dens,np.array(radii)[ind],np.array(mid_plane)[ind]
+    return dens,radii,mid_plane
         
     
 class disk_mesh3d():
@@ -533,6 +881,8 @@ class disk_mesh3d():
         self.fill_center = kwargs.get("fill_center")
         self.fill_background = kwargs.get("fill_background")
         self.max_fill_mesh_points =  kwargs.get("max_fill_mesh_points")
+        self.fill_box_fraction = kwargs.get("fill_box_fraction")
+        self.min_separation = kwargs.get("min_separation")
         
         # set default values
         if (self.mesh_type is None):
@@ -569,13 +919,23 @@ class disk_mesh3d():
             self.fill_background = False
         if (self.max_fill_mesh_points is None):
             self.max_fill_mesh_points = 0.15 * self.Ncells
+        if (self.fill_box_fraction is None):
+            self.fill_box_fraction = 0.5
+        if (self.min_separation is None):
+            self.min_separation = 0
 
 
             
-    def create(self,disk=None):
+    def create(self,disk=None,lloyd_steps=0,region=None,n_workers=None):
         
       '''
       Create the distribution of mesh-generating points in 3D
+
+      For mc and qmc meshes, lloyd_steps > 0 relaxes the disk sample
+      towards the mass-weighted centroids of its Voronoi cells (see
+      lloyd_relaxation) before the additional points are added, moving
+      only the points with radii in region = (Rmin, Rmax) if given, using
+      n_workers processes (disk.n_workers by default).
       
       '''
       
@@ -635,7 +995,7 @@ class disk_mesh3d():
             
               
         
-        return R,phi,z
+        return self.enforce_min_separation(R,phi,z)
 
       
       if (self.mesh_type == "cylindrical"):
@@ -700,139 +1060,228 @@ class disk_mesh3d():
 
             z = np.zeros(R.shape[0])
                 
-            return R,phi,z
-
-      if (self.mesh_type == "mc"):
-          R,phi = self.mc_sample_2d(disk)
-          z = self.mc_sample_vertical(R,disk)
-
-          
-          if (self.fill_background | self.fill_center | self.fill_box):
-            Radditional, phiadditional, zadditional = np.empty([0]),np.empty([0]),np.empty([0])
-            print("Adding background mesh...")
-
+            return self.enforce_min_separation(R,phi,z)
+
+      if (self.mesh_type == "mc") | (self.mesh_type == "qmc"):
+          if (self.mesh_type == "mc"):
+            R,phi = self.mc_sample_2d(disk)
+            z = self.mc_sample_vertical(R,disk)
+          else:
+            R,phi,z = self.qmc_sample(disk)
+          if (lloyd_steps > 0):
+            if (n_workers is None): n_workers = disk.n_workers
+            rvals,mvals = disk.evaluate_enclosed_mass(self.Rin, self.Rout)
+            sampler = mass_sampler(rvals,mvals,disk.vertical_structure_table(self.Rin,self.Rout))
+            R,phi,z = lloyd_relaxation(R,phi,z,sampler,lloyd_steps,region,n_workers)
 
           self.zmax = np.abs(z).max()
-          zmax  = np.abs(z).max()
-          Rmin  = R.min()
-          Rmax  = R.max()
-
-
+          zbinmax = None
           if (self.fill_background == True):
-                Rback,phiback = self.mc_sample_2d(disk,Npoints=0.05 * self.Ncells)
-                zback = self.mc_sample_vertical_background(R,Rback,z,disk)
+            zbinmax = PointBins(R,self.background_radial_bins(disk)).max(z)
+          Radditional, phiadditional, zadditional = self.mc_additional_points(disk,R.min(),R.max(),
+                                                                              self.zmax,zbinmax)
+          R = np.append(R,Radditional)
+          phi = np.append(phi,phiadditional)
+          z = np.append(z,zadditional)
 
-                Rbackmax = Rback.max()
-                print("....inserting %i additional mesh-generating points" % (Rback.shape[0]))
-                Radditional = np.append(Radditional,Rback).flatten()
-                phiadditional = np.append(phiadditional,phiback).flatten()
-                zadditional = np.append(zadditional,zback).flatten()
+          print("Added a total of %i extra points\n" % Radditional.shape[0])
+          return self.enforce_min_separation(R,phi,z)
+
+    def enforce_min_separation(self,R,phi,z):
+        '''
+        Remove the points lying closer than min_separation times the local
+        spacing to another point (see remove_close_points), which would
+        give degenerate Voronoi cells; min_separation = 0 keeps all points
+        '''
+        if not (self.min_separation > 0): return R,phi,z
+        keep = remove_close_points(R,phi,z,self.min_separation)
+        print("Removed %i mesh-generating points closer than %g local spacings to another point" %
+              (np.count_nonzero(~keep),self.min_separation))
+        return R[keep],phi[keep],z[keep]
+
+    def mc_additional_points(self,disk,Rmin,Rmax,zmax,zbinmax=None):
+        '''
+        Background, central and box-filling points around an mc sample of
+        the disk with radii in [Rmin, Rmax] and heights |z| <= zmax; zbinmax
+        is the largest height of the sample in each background_radial_bins
+        bin, needed by fill_background. At most max_fill_mesh_points points
+        are added, of which a share fill_box_fraction is kept for fill_box
+
+        '''
+        Radditional, phiadditional, zadditional = np.empty([0]),np.empty([0]),np.empty([0])
+        if (self.fill_background | self.fill_center | self.fill_box):
+            print("Adding background mesh...")
 
-                Lx,Ly,Lz = 2*Rbackmax,2*Rbackmax,np.abs(zback).max()+1.2*(Rbackmax -Rmax)
-                delta = zback.max()/3
-                xback,yback,zback = self.sample_fill_box(0,Lx,0,Ly,0,Lz,delta)
-                Rback = np.sqrt(xback**2+yback**2)
-                phiback = np.arctan2(yback,xback)
-                ind = Rback > Rbackmax
-                Rback, phiback,zback = Rback[ind], phiback[ind],zback[ind]
+        if (self.fill_background == True):
+              Rback,phiback = self.mc_sample_2d(disk,Npoints=0.05 * self.Ncells)
+              zback = self.sample_background_heights(Rback,disk,zbinmax,1.3 * zmax)
+
+              Rbackmax = Rback.max()
+              print("....inserting %i additional mesh-generating points" % (Rback.shape[0]))
+              Radditional = np.append(Radditional,Rback).flatten()
+              phiadditional = np.append(phiadditional,phiback).flatten()
+              zadditional = np.append(zadditional,zback).flatten()
+
+              # corners of the square around Rbackmax, a uniform quadtree fill of
+              # spacing delta repeated over the layers in z, so that only the
+              # points outside Rbackmax are built
+              Lz = np.abs(zback).max()+1.2*(Rbackmax -Rmax)
+              delta = zback.max()/3
+              xback,yback = graded_box_fill(2*Rbackmax,Rbackmax,delta,growth=0)
+              zlayers = np.arange(-(0.5 * Lz)+0.5*delta, (0.5 * Lz),delta)
+              Rback = np.repeat(np.sqrt(xback**2+yback**2),zlayers.shape[0])
+              phiback = np.repeat(np.arctan2(yback,xback),zlayers.shape[0])
+              zback = np.tile(zlayers,xback.shape[0])
+
+              print("....inserting %i additional mesh-generating points" % (Rback.shape[0]))
+              Radditional = np.append(Radditional,Rback)
+              phiadditional = np.append(phiadditional,phiback)
+              zadditional = np.append(zadditional,zback)
 
-                print("....inserting %i additional mesh-generating points" % (Rback.shape[0]))
-                Radditional = np.append(Radditional,Rback)
-                phiadditional = np.append(phiadditional,phiback)
-                zadditional = np.append(zadditional,zback)
-
-                zmax = max(zmax,np.abs(zadditional).max())
-                Rmax = max(Rmax,np.abs(Radditional).max())
-                Rmin = min(Rmin,np.abs(Radditional).min())
+              zmax = max(zmax,np.abs(zadditional).max())
+              Rmax = max(Rmax,np.abs(Radditional).max())
+              Rmin = min(Rmin,np.abs(Radditional).min())
 
-            
-          if (self.fill_center == True):
-                rvals,mvals = disk.evaluate_enclosed_mass(self.Rin, self.Rout,Nvals=200)
-                cellmass = mvals[-1]/self.Ncells
-                #index = np.where(mvals > cellmass)
-                #first_cell = rvals[index][0]
-                m2r=interp1d(np.append([0],mvals),np.append([0],rvals),kind='linear')
-                Rmin = np.asscalar(m2r(cellmass))
-
-                sigma_in = disk.sigma_vals(Rmin)
-                if (sigma_in < disk.sigma_cut): sigma_in = disk.sigma_cut
-                h = Rmin * soundspeed(Rmin,disk.csnd0,disk.l,disk.csndR0)/ \
-                    np.sqrt(disk.Mcentral * SplineProfile(Rmin,disk.Mcentral_soft*2.8))
-                rho_in = sigma_in/h
-                delta = (cellmass/rho_in)**0.333333
-                Lx, Ly, Lz = 2 * Rmin, 2 * Rmin,2*zmax
-                xcenter,ycenter,zcenter =  self.sample_fill_box(0,Lx,0,Ly,0,Lz,delta)
-                Rcenter = np.sqrt(xcenter**2+ycenter**2)
-                phicenter = np.arctan2(ycenter,xcenter)
-                ind = Rcenter < Rmin 
-                Rcenter, phicenter,zcenter = Rcenter[ind], phicenter[ind],zcenter[ind]
+          
+        if (self.fill_center == True):
+              rvals,mvals = disk.evaluate_enclosed_mass(self.Rin, self.Rout,Nvals=200)
+              cellmass = mvals[-1]/self.Ncells
+              #index = np.where(mvals > cellmass)
+              #first_cell = rvals[index][0]
+              m2r=interp1d(np.append([0],mvals),np.append([0],rvals),kind='linear')
+              Rmin = np.asscalar(m2r(cellmass))
+
+              sigma_in = disk.sigma_vals(Rmin)
+              if (sigma_in < disk.sigma_cut): sigma_in = disk.sigma_cut
+              h = Rmin * soundspeed(Rmin,disk.csnd0,disk.l,disk.csndR0)/ \
+                  np.sqrt(disk.Mcentral * SplineProfile(Rmin,disk.Mcentral_soft*2.8))
+              rho_in = sigma_in/h
+              delta = (cellmass/rho_in)**0.333333
+              Lx, Ly, Lz = 2 * Rmin, 2 * Rmin,2*zmax
+              xcenter,ycenter,zcenter =  self.sample_fill_box(0,Lx,0,Ly,0,Lz,delta)
+              Rcenter = np.sqrt(xcenter**2+ycenter**2)
+              phicenter = np.arctan2(ycenter,xcenter)
+              ind = Rcenter < Rmin 
+              Rcenter, phicenter,zcenter = Rcenter[ind], phicenter[ind],zcenter[ind]
+
+              print("....inserting %i additional mesh-generating points" % (Rcenter.shape[0]))
+              Radditional = np.append(Radditional,Rcenter)
+              phiadditional = np.append(phiadditional,phicenter)
+              zadditional = np.append(zadditional,zcenter)
 
-                print("....inserting %i additional mesh-generating points" % (Rcenter.shape[0]))
-                Radditional = np.append(Radditional,Rcenter)
-                phiadditional = np.append(phiadditional,phicenter)
-                zadditional = np.append(zadditional,zcenter)
+              zmax = max(zmax,np.abs(zadditional).max())
+              Rmax = max(Rmax,np.abs(Radditional).max())
+              Rmin = min(Rmin,np.abs(Radditional).min())
 
-                zmax = max(zmax,np.abs(zadditional).max())
-                Rmax = max(Rmax,np.abs(Radditional).max())
-                Rmin = min(Rmin,np.abs(Radditional).min())
+          
+        if (self.fill_background | self.fill_center):
+
+              # Check if we added TOO MANY additional mesh points, leaving
+              # the share of the budget reserved for the box fill
+              Nmax = self.max_fill_mesh_points
+              if (self.fill_box == True): Nmax = (1 - self.fill_box_fraction) * Nmax
+              if (Radditional.shape[0] > Nmax):
+                  print("...removing excessive extra points")
+                  # Randomly select a subsample of size equal to the maximum allowed size
+                  ind = rd.random_sample(Radditional.shape[0]) <  Nmax/Radditional.shape[0]
+                  Radditional = Radditional[ind]
+                  phiadditional = phiadditional[ind]
+                  zadditional = zadditional[ind]
 
-            
-          if (self.fill_box == True):
-                print("Filling computational box of side half-length %f..." % (self.BoxSize/2))
-                zmax0 = zmax
-                Rmax0 = Rmax
-                Nlayers = 0
-                Lx, Ly, Lz = min(2.1 * Rmax0,self.BoxSize), min(2.1 * Rmax0,self.BoxSize), min(2.1 * zmax0,self.BoxSize)
-                delta  = 1.5 * (zmax0/Rmax0)* zmax0
-                xbox,ybox,zbox =  self.sample_fill_box(0,Lx,0,Ly,0,Lz,delta)
-                rbox = np.sqrt(xbox**2+ybox**2)
-                ind = (rbox > Rmax0) | (np.abs(zbox) > zmax0)
-                if (rbox[ind].shape[0] > 0):
-                  print(rbox[ind].shape)
-                  print("....inserting %i additional mesh-generating points out to x=+-%f" % (rbox[ind].shape[0],xbox.max()))
-                  Radditional = np.append(Radditional,rbox[ind])
-                  phiadditional = np.append(phiadditional,np.arctan2(ybox[ind],xbox[ind]))
-                  zadditional=np.append(zadditional,zbox[ind])
-
-                delta*=1.9
-                while (Lx < self.BoxSize-0.5*delta) | (Lz < self.BoxSize- 0.5*delta):
-                #while ((0.5*self.BoxSize > (R.max()/np.sqrt(2) + 1.5*delta))
-                #       | (0.5*self.BoxSize > (np.abs(z).max()+1.5*delta))):
-                    if (Nlayers > 8): break
-                    Nlayers+=1
-                    lmax,zetamax = Radditional.max()/np.sqrt(2), zadditional.max()
-                    Lx, Ly, Lz = min(1.6 * Lx,self.BoxSize), min(1.6 * Ly,self.BoxSize), min(3.8 * Lz,self.BoxSize)
-                    Lx_in, Ly_in, Lz_in = np.abs(Radditional*np.cos(phiadditional)).max(),np.abs(Radditional*np.sin(phiadditional)).max(),zetamax
-
-                    xbox,ybox,zbox =  self.sample_fill_box(Lx_in,Lx,Ly_in,Ly,Lz_in,Lz,delta)
-
-                    print("....inserting %i additional mesh-generating points out to x=+-%f" % (xbox.shape[0],xbox.max()))
-                    Radditional = np.append(Radditional,np.sqrt(xbox**2+ybox**2))
-                    phiadditional = np.append(phiadditional,np.arctan2(ybox,xbox))
-                    zadditional=np.append(zadditional,zbox)
-
-                    delta  = min(max(Lx,Lz)*1.0/16*Nlayers,0.6*min(Lx-Lx_in,Lz-Lz_in))
-
-          if (self.fill_background | self.fill_center | self.fill_box):
-
-                # Check if we added TOO MANY additional mesh points
-                if (Radditional.shape[0] > self.max_fill_mesh_points):
-                    print("...removing excessive extra points")
-                    # Randomly select a subsample of size equal to the maximum allowed size
-                    ind = rd.random_sample(Radditional.shape[0]) <  self.max_fill_mesh_points/Radditional.shape[0]
-                    Radditional = Radditional[ind]
-                    phiadditional = phiadditional[ind]
-                    zadditional = zadditional[ind]
-
-                R = np.append(R,Radditional)
-                phi = np.append(phi,phiadditional)
-                z = np.append(z,zadditional)
+          
+        if (self.fill_box == True):
+              # graded octree fill, with at least fill_box_fraction of the budget
+              # of extra points and whatever the other fills left unused
+              print("Filling computational box of side half-length %f..." % (self.BoxSize/2))
+              delta  = 1.5 * (zmax/Rmax)* zmax
+              Nbox = max(int(self.max_fill_mesh_points) - Radditional.shape[0],0)
+              xbox,ybox,zbox = graded_box_fill(self.BoxSize,Rmax,delta,zmax=zmax,Npoints=Nbox)
+              if (xbox.shape[0] > 0):
+                print("....inserting %i additional mesh-generating points out to x=+-%f" % (xbox.shape[0],np.abs(xbox).max()))
+                Radditional = np.append(Radditional,np.sqrt(xbox**2+ybox**2))
+                phiadditional = np.append(phiadditional,np.arctan2(ybox,xbox))
+                zadditional=np.append(zadditional,zbox)
+
+        return Radditional, phiadditional, zadditional
 
+                             
+    def create_chunks(self,disk,chunk_size=1000000,seed=42):
+        '''
+        Mesh-generating points in chunks of at most chunk_size points, for
+        meshes too large to be held in memory at once.
+
+        For mc meshes, each chunk of the disk sample is drawn from its own
+        random stream, seeded by `seed` and the chunk number, and for qmc
+        meshes it is the matching stretch of the Halton sequence scrambled
+        with `seed`, so that it can be drawn twice: a first pass collects the extent of the sample that
+        the additional points depend on, and the chunks are drawn again as
+        they are consumed. The additional points (at most max_fill_mesh_points)
+        are built in memory and follow the disk chunks; close pairs are only
+        removed among the additional points (see min_separation). Other mesh types are
+        created in full and split into chunks.
+
+        Returns
+        -------
+        Npoints : int
+        total number of points
+        Rmin : float
+        smallest radius of the points
+        chunks : generator
+        R, phi, z of consecutive chunks
+
+        '''
+        if (self.mesh_type != "mc") & (self.mesh_type != "qmc"):
+          R,phi,z = self.create(disk)
+          def split():
+            for start in range(0,R.shape[0],chunk_size):
+              yield R[start:start+chunk_size],phi[start:start+chunk_size],z[start:start+chunk_size]
+          return R.shape[0], R.min(), split()
 
-          print("Added a total of %i extra points\n" % Radditional.shape[0])
+        rvals,mvals = disk.evaluate_enclosed_mass(self.Rin, self.Rout)
+        table = disk.vertical_structure_table(self.Rin,self.Rout)
+        Ndisk = int(self.Ncells)
+        Nchunks = (Ndisk + chunk_size - 1)//chunk_size
+
+        def disk_chunk(k):
+          N = min(chunk_size,Ndisk - k * chunk_size)
+          if (self.mesh_type == "qmc"):
+            return self.qmc_sample(disk,N,skip=k * chunk_size,random_state=seed)
+          random = rd.RandomState([seed,k])
+          R = mc_sample_from_mass(rvals,mvals,N,random.random_sample)
+          phi = 2.0*np.pi*random.random_sample(N)
+          z = table.sample_heights(R,random.random_sample(N))
+          #points below or above the mid-plane
+          z = z * (np.round(random.random_sample(N))*2 - 1)
           return R,phi,z
 
-                             
+        print("Surveying %i disk points in %i chunks" % (Ndisk,Nchunks))
+        Rmin, Rmax, zmax, zbinmax = np.inf, 0.0, 0.0, None
+        if (self.fill_background == True):
+          radial_bins = self.background_radial_bins(disk)
+          zbinmax = np.full(radial_bins.shape[0] + 1,-np.inf)
+        for k in range(Nchunks):
+          R,phi,z = disk_chunk(k)
+          Rmin, Rmax, zmax = min(Rmin,R.min()), max(Rmax,R.max()), max(zmax,np.abs(z).max())
+          if (zbinmax is not None):
+            zbinmax = np.maximum(zbinmax,PointBins(R,radial_bins).max(z))
+
+        self.zmax = zmax
+        Radditional, phiadditional, zadditional = self.mc_additional_points(disk,Rmin,Rmax,zmax,zbinmax)
+        # only the additional points are checked for close pairs, among themselves
+        Radditional, phiadditional, zadditional = self.enforce_min_separation(Radditional,phiadditional,
+                                                                              zadditional)
+        print("Added a total of %i extra points\n" % Radditional.shape[0])
+        if (Radditional.shape[0] > 0): Rmin = min(Rmin,Radditional.min())
+
+        def chunks():
+          for k in range(Nchunks):
+            yield disk_chunk(k)
+          for start in range(0,Radditional.shape[0],chunk_size):
+            yield (Radditional[start:start+chunk_size],phiadditional[start:start+chunk_size],
+                   zadditional[start:start+chunk_size])
+
+        return Ndisk + Radditional.shape[0], Rmin, chunks()
+
     def mc_sample_2d(self,disk,**kwargs):
 
         Npoints = kwargs.get("Npoints")
@@ -850,86 +1299,71 @@ class disk_mesh3d():
 
         return R,phi
 
-    def mc_sample_vertical(self,R,disk):
+    def qmc_sample(self,disk,Npoints=None,skip=0,random_state=None):
+        '''
+        Quasi-random counterpart of mc_sample_2d and mc_sample_vertical:
+        points skip, skip+1, ... of a scrambled Halton sequence, mapped
+        through the inverse enclosed mass in R, uniformly in phi, and through
+        the inverse vertical mass fraction in |z|, the third coordinate
+        u giving |z| from |2u - 1| and the side of the mid-plane from its sign
 
-        if (self.Ncells < 50000): R_bins = 80
-        elif (self.Ncells < 100000): R_bins = 120
-        elif (self.Ncells < 200000): R_bins = 200
-        elif (self.Ncells < 600000): R_bins   = 400
-        else: R_bins = 500
-        
-        #bin radial values (use mass as a guide for bin locations)
-        #radial_bins = disk.evaluate_radial_mass_bins(self.Rin,self.Rout,R_bins)
-        radial_bins = np.logspace(np.log10(self.Rin),np.log10(self.Rout),R_bins)
+        '''
+        if (Npoints is None): Npoints = self.Ncells
 
-        
-        bin_inds=np.digitize(R,radial_bins)
-        z = np.zeros(R.shape[0])
+        rvals,mvals = disk.evaluate_enclosed_mass(self.Rin, self.Rout)
+        table = disk.vertical_structure_table(self.Rin,self.Rout)
+        u = halton_sequence(int(Npoints),3,skip,random_state)
+        R = sample_from_mass(rvals,mvals,u[:,0])
+        phi = 2.0*np.pi*u[:,1]
+        side = 2*u[:,2] - 1
+        z = table.sample_heights(R,np.abs(side)) * np.where(side < 0,-1,1)
 
-        print("Solving vertical structure for point location sampling:")
-        for kk in range(0,R_bins):
-            update_progress(kk,R_bins)
-            
-            N_in_bin = R[bin_inds == kk].shape[0]
-            if (N_in_bin == 0): continue
+        return R,phi,z
 
-            if (N_in_bin < 10):
-                z[bin_inds == kk] = 0.0
-                continue
-            
-            bin_radius = R[bin_inds == kk].mean()
-
-            scale_height_guess = bin_radius * soundspeed(bin_radius,disk.csnd0,disk.l,disk.csndR0)/ \
-                                 np.sqrt(disk.Mcentral * SplineProfile(bin_radius,disk.Mcentral_soft*2.8))
-            zin,zout = 0.0001 * scale_height_guess , 15 * scale_height_guess
-            zvals,zmvals = disk.evaluate_enclosed_vertical(bin_radius,zin,zout,Nzvals=400)
-            zbin = mc_sample_from_mass(zvals,zmvals,int(1.2*N_in_bin))
-            zbinmax = zbin.max()
-
-            '''
-            while (zbin[zbin < zbinmax].shape[0] > 1.04 * N_in_bin):
-              zbin = zbin[zbin< (0.99 * zbinmax)]
-              zbinmax = zbin.max()
-            if (zbin.shape[0] > N_in_bin): zbin = zbin[:N_in_bin]
-            '''
-            zbin1 = zbin[zbin >= (0.95 * zbinmax)]
-            zbin2 = np.random.choice(zbin[zbin < (0.95 * zbinmax)],N_in_bin - zbin1.shape[0])
-            zbin  = np.append(zbin1,zbin2)
-            
-            #points below or above the mid-plane
-            zbin = zbin * (np.round(rd.random_sample(N_in_bin))*2 - 1)
-            z[bin_inds == kk] = zbin
+    def mc_sample_vertical(self,R,disk):
+
+        print("Sampling vertical positions from the vertical structure table")
+        table = disk.vertical_structure_table(self.Rin,self.Rout)
+        z = table.sample_heights(R,rd.random_sample(R.shape[0]))
+
+        #points below or above the mid-plane
+        z = z * (np.round(rd.random_sample(R.shape[0]))*2 - 1)
 
         return z
 
 
     def mc_sample_vertical_background(self,R,Rback,z,disk):
 
-        zmaxglob = 1.3*np.abs(z).max()
-        zback = np.zeros(Rback.shape[0])
-    
+        # highest sampled point of each bin
+        zbinmax = PointBins(R,self.background_radial_bins(disk)).max(z)
+        return self.sample_background_heights(Rback,disk,zbinmax,1.3*np.abs(z).max())
+
+    def background_radial_bins(self,disk):
+
         if (self.Ncells < 50000): R_bins = 80
         elif (self.Ncells < 100000): R_bins = 120
         elif (self.Ncells < 200000): R_bins = 200
         elif (self.Ncells < 600000): R_bins   = 400
         else: R_bins = 500
-        
+
         #bin radial values (use mass as a guide for bin locations)
-        radial_bins = disk.evaluate_radial_mass_bins(self.Rin,self.Rout,R_bins)
-        bin_inds = np.digitize(R,radial_bins)
+        return disk.evaluate_radial_mass_bins(self.Rin,self.Rout,R_bins)
+
+    def sample_background_heights(self,Rback,disk,zbinmax,zmaxglob):
+        '''
+        Heights of background points, between the highest point of the disk
+        sample in their radial bin (zbinmax, -inf for empty bins) and zmaxglob
+        '''
+        zback = np.zeros(Rback.shape[0])
+        radial_bins = self.background_radial_bins(disk)
         backbin_inds = np.digitize(Rback,radial_bins)
 
-        for kk in range(0,R_bins):
-            N_in_bin = R[bin_inds == kk].shape[0]
-            Nback_in_bin = Rback[backbin_inds == kk].shape[0]
-            if (N_in_bin == 0) | (Nback_in_bin == 0) : continue
-            
-            zbinmax = z[bin_inds == kk].max()
-            bin_radius = Rback[backbin_inds == kk].mean()
-            
-            _, zmvals = disk.evaluate_enclosed_vertical(bin_radius,0,zbinmax,Nzvals=300)
-            zbackbin = rd.random_sample(Nback_in_bin)*(zmaxglob - zbinmax) + zbinmax
-            zback[backbin_inds == kk] = zbackbin * (np.round(rd.random_sample(Nback_in_bin))*2 - 1)
+        ind = (backbin_inds < radial_bins.shape[0])
+        ind[ind] = np.isfinite(zbinmax[backbin_inds[ind]])
+        Nback = np.count_nonzero(ind)
+        zbackmin = zbinmax[backbin_inds[ind]]
+        zbackbin = rd.random_sample(Nback)*(zmaxglob - zbackmin) + zbackmin
+        zback[ind] = zbackbin * (np.round(rd.random_sample(Nback))*2 - 1)
 
         return zback
 
@@ -943,13 +1377,16 @@ class disk_mesh3d():
                 
     def sample_fill_box(self,Lx_in,Lx_out,Ly_in,Ly_out,Lz_in,Lz_out,delta):
         
-        xbox,ybox,zbox = np.meshgrid(np.arange(-(0.5 * Lx_out)+0.5*delta, (0.5 * Lx_out),delta),
-                                     np.arange(-(0.5 * Ly_out)+0.5*delta, (0.5 * Ly_out),delta),
-                                     np.arange(-(0.5 * Lz_out)+0.5*delta, (0.5 * Lz_out),delta))
-        xbox,ybox,zbox =  xbox.flatten(),ybox.flatten(),zbox.flatten()
-        ind = (np.abs(xbox) > 0.5* Lx_in) | (np.abs(ybox) > 0.5*Ly_in) | (np.abs(zbox) > 0.5*Lz_in) 
-        
-        xbox,ybox,zbox =  xbox[ind],ybox[ind],zbox[ind]
+        xvals = np.arange(-(0.5 * Lx_out)+0.5*delta, (0.5 * Lx_out),delta)
+        yvals = np.arange(-(0.5 * Ly_out)+0.5*delta, (0.5 * Ly_out),delta)
+        zvals = np.arange(-(0.5 * Lz_out)+0.5*delta, (0.5 * Lz_out),delta)
+        outx, outy, outz = np.abs(xvals) > 0.5* Lx_in, np.abs(yvals) > 0.5*Ly_in, np.abs(zvals) > 0.5*Lz_in
+
+        # only the lattice points outside the inner box are generated, as the
+        # slabs beyond it in z, in y (within it in z) and in x (within it in y and z)
+        slabs = [(xvals,yvals,zvals[outz]),(xvals,yvals[outy],zvals[~outz]),(xvals[outx],yvals[~outy],zvals[~outz])]
+        grids = [[g.flatten() for g in np.meshgrid(*slab)] for slab in slabs]
+        xbox,ybox,zbox = [np.concatenate(coords) for coords in zip(*grids)]
         
         return xbox,ybox,zbox
 
@@ -0,0 +1,316 @@
+from __future__ import print_function
+"""
+Vertical structure of a 3D disk model tabulated over radius and height
+
+
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+from .disk_other_functions import rowwise_interp
+
+
+class VerticalStructureTable(object):
+    """
+    Table of the vertical density structure of a disk3d model, and of
+    its cumulative vertical mass, over radius and height.
+
+    The rows of the table lie on a fixed lattice in ln R, R_k = exp(k dlnR),
+    so that tables requested over different radial ranges share their
+    rows: the table only grows, by solving the columns it is missing.
+    Along each column, heights are tabulated in units of the scale height,
+    zeta = z/H(R), on a logarithmic grid with a leading zeta = 0, which
+    makes the structure nearly independent of radius at fixed zeta.
+    Densities (as ln rho) and vertical mass fractions are read by bilinear
+    interpolation in (ln R, zeta), and heights are drawn from the inverse
+    of the vertical mass fraction by bilinear interpolation in (ln R, u).
+    The rotation velocity vphi(R, z) that balances gravity and the radial
+    pressure gradient of the tabulated density is derived on the same grid,
+    together with the sound speed cs(R, z) of the disk, which may vary
+    with height (see disk3d.soundspeed_field).
+
+    If `cache_dir` is given, the table is stored there as a .npz file
+    named after a hash of the disk parameters and the grid, and is read
+    back by later runs with the same parameters.
+
+    Parameters
+    ----------
+    disk : disk3d
+    the disk model
+    Rin, Rout : float
+    radial range initially covered by the table
+    dlnR : float, optional
+    spacing of the rows in ln R
+    Nzvals : int, optional
+    number of logarithmically spaced heights in each column
+    zeta_in, zeta_out : float, optional
+    smallest nonzero and largest height, in units of the scale height
+    cache_dir : str, optional
+    directory of the persistent cache
+
+    """
+
+    version = 1
+
+    def __init__(self,disk,Rin,Rout,dlnR=0.02,Nzvals=400,zeta_in=1.0e-4,zeta_out=15.0,cache_dir=None):
+        self.disk = disk
+        self.dlnR = dlnR
+        self.Nzvals = Nzvals
+        self.zeta = np.append(0,np.logspace(np.log10(zeta_in),np.log10(zeta_out),Nzvals))
+        self.cache_dir = cache_dir
+        self.fingerprint = disk.fingerprint
+
+        self.kvals = np.zeros(0,dtype=int)
+        self.lnH = np.zeros(0)
+        self.lnrho0 = np.zeros(0)
+        self.lnrho = np.zeros((0,self.zeta.shape[0]))
+        self.mass_fraction = np.zeros((0,self.zeta.shape[0]))
+        self._inverse = None
+        self._rotation = None
+
+        if (self.cache_dir is not None): self.load()
+        self.extend(Rin,Rout)
+
+    @property
+    def rvals(self):
+        return np.exp(self.kvals * self.dlnR)
+
+    @property
+    def filename(self):
+        key = repr((self.version,self.fingerprint,self.dlnR,self.zeta.shape[0],
+                    self.zeta[1],self.zeta[-1]))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.cache_dir,'vertical_structure_%s.npz' % digest)
+
+    def load(self):
+        """
+        Read the rows stored in the cache directory, if any
+        """
+        if not os.path.isfile(self.filename): return
+        with np.load(self.filename) as data:
+            if (data['zeta'].shape != self.zeta.shape) or not np.allclose(data['zeta'],self.zeta): return
+            self.kvals, self.lnH, self.lnrho0 = data['kvals'], data['lnH'], data['lnrho0']
+            self.lnrho, self.mass_fraction = data['lnrho'], data['mass_fraction']
+        self._inverse, self._rotation = None, None
+
+    def save(self):
+        """
+        Store the table in the cache directory
+        """
+        if not os.path.isdir(self.cache_dir): os.makedirs(self.cache_dir)
+        np.savez(self.filename,kvals=self.kvals,zeta=self.zeta,lnH=self.lnH,lnrho0=self.lnrho0,
+                 lnrho=self.lnrho,mass_fraction=self.mass_fraction)
+
+    def extend(self,Rin,Rout):
+        """
+        Add the rows needed to cover the radial range [Rin, Rout]
+        """
+        kin = int(np.floor(np.log(Rin)/self.dlnR))
+        kout = max(int(np.ceil(np.log(Rout)/self.dlnR)),kin + 1)
+        if (self.kvals.shape[0] > 0):
+            below = np.arange(kin,self.kvals[0])
+            above = np.arange(self.kvals[-1] + 1,kout + 1)
+        else:
+            below, above = np.arange(kin,kout + 1), np.zeros(0,dtype=int)
+        if (below.shape[0] + above.shape[0] == 0): return
+
+        rows_below, rows_above = self._solve_rows(below,self._neighbour_guess(below)), \
+                                 self._solve_rows(above,self._neighbour_guess(above))
+        self.kvals = np.concatenate([below,self.kvals,above])
+        self.lnH, self.lnrho0, self.lnrho, self.mass_fraction = \
+            [np.concatenate([lo,old,hi]) for lo, old, hi in
+             zip(rows_below,(self.lnH,self.lnrho0,self.lnrho,self.mass_fraction),rows_above)]
+        self._inverse, self._rotation = None, None
+        if (self.cache_dir is not None): self.save()
+
+    def _neighbour_guess(self,kvals):
+        """
+        Normalizations of new rows extrapolated from the existing rows, as
+        starting points of the self-gravitating solver
+        """
+        if (self.kvals.shape[0] < 2) or (kvals.shape[0] == 0) or not self.disk.self_gravity:
+            return None
+        if (kvals[0] < self.kvals[0]):
+            k, lnrho0 = self.kvals[:2], self.lnrho0[:2]
+        else:
+            k, lnrho0 = self.kvals[-2:], self.lnrho0[-2:]
+        slope = (lnrho0[1] - lnrho0[0])/(k[1] - k[0])
+        return np.exp(lnrho0[0] + slope * (kvals - k[0]))
+
+    def _solve_rows(self,kvals,rho0_guess=None):
+        Nz = self.zeta.shape[0]
+        if (kvals.shape[0] == 0):
+            return np.zeros(0), np.zeros(0), np.zeros((0,Nz)), np.zeros((0,Nz))
+        R = np.exp(kvals * self.dlnR)
+        H = self.disk.vertical_scale_height(R)
+        zvals, zrho, rho0, zmass = self.disk.evaluate_vertical_structure_grid(R,None,None,
+                                                                              zvals=H[:,None] * self.zeta[None,:],
+                                                                              rho0_guess=rho0_guess)
+        tiny = np.finfo(float).tiny
+        return (np.log(H), np.log(np.maximum(rho0,tiny)), np.log(np.maximum(zrho,tiny)),
+                zmass/zmass[:,-1:])
+
+    def _locate_radius(self,R):
+        if (R.size > 0): self.extend(np.min(R),np.max(R))
+        x = np.log(R)/self.dlnR - self.kvals[0]
+        row = np.clip(np.floor(x).astype(int),0,self.kvals.shape[0] - 2)
+        return row, np.clip(x - row,0,1)
+
+    def _interpolate_rows(self,values,row,weight):
+        return (1 - weight) * values[row] + weight * values[row + 1]
+
+    def _bilinear(self,name,R,z):
+        # the table is extended before the tabulated quantity is read
+        R, z = np.broadcast_arrays(np.asarray(R,dtype=float),np.asarray(z,dtype=float))
+        row, wR = self._locate_radius(R)
+        values = getattr(self,name)
+        zeta = np.abs(z) * np.exp(-self._interpolate_rows(self.lnH,row,wR))
+        col = np.clip(np.searchsorted(self.zeta,zeta,side='right') - 1,0,self.zeta.shape[0] - 2)
+        wz = np.clip((zeta - self.zeta[col])/(self.zeta[col + 1] - self.zeta[col]),0,1)
+        return ((1 - wR) * ((1 - wz) * values[row,col] + wz * values[row,col + 1]) +
+                wR * ((1 - wz) * values[row + 1,col] + wz * values[row + 1,col + 1]))
+
+    def scale_height(self,R):
+        row, weight = self._locate_radius(np.asarray(R,dtype=float))
+        return np.exp(self._interpolate_rows(self.lnH,row,weight))
+
+    def midplane_density(self,R):
+        row, weight = self._locate_radius(np.asarray(R,dtype=float))
+        return np.exp(self._interpolate_rows(self.lnrho0,row,weight))
+
+    def density(self,R,z):
+        """
+        Density at the points (R, z)
+        """
+        return np.exp(self._bilinear('lnrho',R,z))
+
+    def vertical_mass_fraction(self,R,z):
+        """
+        Fraction of the mass of the column at radius R (on one side of the
+        mid-plane) that lies between the mid-plane and |z|
+        """
+        return self._bilinear('mass_fraction',R,z)
+
+    def columns(self,R):
+        """
+        Heights, densities and vertical mass fractions of the columns at
+        the radii R, interpolated between the rows of the table
+
+        Returns
+        -------
+        zvals, zrho, mass_fraction : ndarray, shape (N_R, N_z)
+        """
+        row, weight = self._locate_radius(np.atleast_1d(np.asarray(R,dtype=float)))
+        weight = weight[:,None]
+        zvals = np.exp(self._interpolate_rows(self.lnH,row,weight[:,0]))[:,None] * self.zeta[None,:]
+        zrho = np.exp(self._interpolate_rows(self.lnrho,row,weight))
+        return zvals, zrho, self._interpolate_rows(self.mass_fraction,row,weight)
+
+    @property
+    def inverse_mass_fraction(self):
+        """
+        Heights zeta(ln R, u) below which a fraction u of the column mass
+        lies, on mass-fraction nodes shared by all rows: uniform in u, and
+        refined logarithmically towards u = 1 to follow the tails
+        """
+        if (self._inverse is None):
+            unodes = np.concatenate([np.linspace(0,1 - 1.0e-3,1000),1 - np.logspace(-3.05,-15,100),[1.0]])
+            Nrows = self.kvals.shape[0]
+            rows = np.repeat(np.arange(Nrows),unodes.shape[0])
+            zeta = rowwise_interp(np.tile(unodes,Nrows),rows,self.mass_fraction,
+                                  np.broadcast_to(self.zeta,self.mass_fraction.shape))
+            self._inverse = (unodes,zeta.reshape(Nrows,unodes.shape[0]))
+        return self._inverse
+
+    def sample_heights(self,R,u=None):
+        """
+        Heights |z| distributed as the vertical mass of the columns at the
+        radii R, by inversion of the vertical mass fraction
+
+        Parameters
+        ----------
+        R : array_like
+        radii of the points
+        u : array_like, optional
+        mass fractions to invert, uniform random numbers by default
+
+        Returns
+        -------
+        z : ndarray
+        heights above the mid-plane
+        """
+        R = np.asarray(R,dtype=float)
+        if (u is None): u = np.random.random_sample(R.shape)
+        row, wR = self._locate_radius(R)
+        unodes, zeta = self.inverse_mass_fraction
+        col = np.clip(np.searchsorted(unodes,u,side='right') - 1,0,unodes.shape[0] - 2)
+        wu = np.clip((u - unodes[col])/(unodes[col + 1] - unodes[col]),0,1)
+        zeta = ((1 - wR) * ((1 - wu) * zeta[row,col] + wu * zeta[row,col + 1]) +
+                wR * ((1 - wu) * zeta[row + 1,col] + wu * zeta[row + 1,col + 1]))
+        return zeta * np.exp(self._interpolate_rows(self.lnH,row,wR))
+
+    @property
+    def vphi_sq(self):
+        """
+        Squared rotation velocity vphi^2(ln R, zeta).
+
+        The radial force balance at height z,
+
+        vphi^2 = R dPhi/dR + cs^2 (dln rho/dln R + dln cs^2/dln R),
+
+        is evaluated with the local sound speed cs(R, z) of the disk and the
+        pressure gradient of the tabulated density at fixed z,
+        dln rho/dln R = (dln rho/dln R)_zeta - zeta (dln rho/dzeta) dln H/dln R,
+        and likewise for cs^2. It is written as the mid-plane rotation curve
+        of the disk plus the changes of the central attraction and of the
+        pressure support with height, so that vphi(R, 0) follows the rotation
+        curve; the contributions of the disk and external potentials are
+        taken as independent of height.
+        """
+        return self._rotation_table()[0]
+
+    @property
+    def lncsnd_sq(self):
+        """
+        Logarithm of the squared sound speed ln cs^2(ln R, zeta)
+        """
+        return self._rotation_table()[1]
+
+    def _derivative_lnR(self,values):
+        # derivative along ln R at fixed z of a quantity tabulated in (ln R, zeta)
+        return (np.gradient(values,self.dlnR,axis=0) -
+                self.zeta[None,:] * np.gradient(values,self.zeta,axis=1) *
+                np.gradient(self.lnH,self.dlnR)[:,None])
+
+    def _rotation_table(self):
+        if (self._rotation is None):
+            disk, R = self.disk, self.rvals
+            profiles = disk.profile_table(R[0],R[-1],radii_list=R)
+
+            zvals = np.exp(self.lnH)[:,None] * self.zeta[None,:]
+            lncsnd_sq = np.log(disk.soundspeed_sq(R[:,None],zvals))
+            central = R[:,None]**2 * (disk.omega_sq_central(R[:,None],zvals) -
+                                      disk.omega_sq_central(R)[:,None])
+            pressure = np.exp(lncsnd_sq) * (self._derivative_lnR(self.lnrho) +
+                                            self._derivative_lnR(lncsnd_sq))
+
+            vphi_sq = (R**2 * profiles['omega_sq_rotation'])[:,None] + central + \
+                      pressure - pressure[:,:1]
+            self._rotation = (vphi_sq,lncsnd_sq)
+        return self._rotation
+
+    def rotation_velocity(self,R,z):
+        """
+        Rotation velocity at the points (R, z), zero where the pressure
+        gradient exceeds the gravitational attraction
+        """
+        return np.sqrt(np.maximum(self._bilinear('vphi_sq',R,z),0))
+
+    def soundspeed_sq(self,R,z=0.0):
+        """
+        Squared sound speed at the points (R, z)
+        """
+        return np.exp(self._bilinear('lncsnd_sq',R,z))
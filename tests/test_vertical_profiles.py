@@ -0,0 +1,15 @@
+import numpy as np
+
+import disk_models as dm
+
+
+def test_midplane_rotation_velocity_follows_rotation_curve():
+    # softened central potential and G != 1, where the two gravity terms used to disagree
+    disk = dm.disk3d(sigma_type="powerlaw",sigma0=1.0e-3,p=1.0,G=2.0,Mcentral_soft=0.3,
+                     csnd0=0.05,l=1.0)
+    table = disk.vertical_structure_table(0.5,5.0)
+    R = table.rvals[2:-2]
+    omega_sq_rotation = disk.profile_table(table.rvals[0],table.rvals[-1],
+                                           radii_list=table.rvals)['omega_sq_rotation'][2:-2]
+    np.testing.assert_allclose(table.rotation_velocity(R,np.zeros(R.shape)),
+                               np.sqrt(R**2 * omega_sq_rotation),rtol=1.0e-10)